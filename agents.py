@@ -1,81 +1,169 @@
-from typing import Dict, Literal
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Literal, Optional
 
 from langgraph.graph import StateGraph, END
 
+from cache import ResponseCache
+from checkpoint import RunJournal
+from compaction import HistoryCompactor
+from dedup import EvaluationIndex
+from evaluation import EvaluationConfig
+from instrumentation import Instrumentation
+from memory import StrategyMemory
+from ratelimit import RateLimiter, RetryPolicy
+from routing import ModelRouter
+from policy import AdaptivePolicy, RoutingPolicy
 from state import AgentState
+from templates import ContextCacheRegistry
 from tools import P3RO_Agent_Tools
 
 
 class P3RO_Graph:
     """Constructs and compiles the LangGraph for the P³RO agent."""
 
-    def __init__(self):
+    # Unconditional successor of each node; decide_next_step is routed by `_router` instead
+    NEXT_NODE = {
+        "decompose_goal": "formulate_strategy",
+        "formulate_strategy": "generate_prompt",
+        "generate_prompt": "evaluate_prompt",
+        "evaluate_prompt": "synthesize_reflection",
+        "synthesize_reflection": "decide_next_step",
+        "decide_next_step": None,
+    }
+    ROUTES = {
+        "CONTINUE_PROBING": "generate_prompt",
+        "REVISE_STRATEGY": "formulate_strategy",
+        "FINISH": END,
+    }
+    # Runs whose usage is tracked between rounds at the same time
+    MAX_TRACKED_RUNS = 10_000
+
+    def __init__(self, cache: Optional[ResponseCache] = None, beam_width: int = 1, beam_top_k: int = 1,
+                 history_token_budget: Optional[int] = 1500, journal: Optional[RunJournal] = None,
+                 instrumentation: Optional[Instrumentation] = None, model=None, backend: str = "gemini",
+                 evaluation: Optional[EvaluationConfig] = None,
+                 rate_limiter: Optional[RateLimiter] = None, retry_policy: Optional[RetryPolicy] = None,
+                 model_router: Optional[ModelRouter] = None, models: Optional[Dict] = None,
+                 dedup_index: Optional[EvaluationIndex] = None, strategy_memory: Optional[StrategyMemory] = None,
+                 context_caches: Optional[ContextCacheRegistry] = None, policy: Optional[RoutingPolicy] = None):
         self.workflow = StateGraph(AgentState)
-        self.tools = P3RO_Agent_Tools(llm_model_name="gemini-2.5-flash")
+        self.policy = policy or AdaptivePolicy()
+        # Usage totals seen at each run's previous decision, so only what happened since is added to its state
+        self._usage_marks: "OrderedDict[str, Dict]" = OrderedDict()
+        self._usage_lock = threading.Lock()
+        self.journal = journal
+        self.strategy_memory = strategy_memory
+        self.instrumentation = instrumentation or Instrumentation()
+        history_compactor = HistoryCompactor(token_budget=history_token_budget) if history_token_budget else None
+        # Every node runs on the fast model by default; evaluations it cannot score reliably go to the strong one
+        model_router = model_router or ModelRouter(default_model="gemini-2.5-flash",
+                                                   escalation_model="gemini-2.5-pro")
+        self.tools = P3RO_Agent_Tools(llm_model_name=model_router.default_model, cache=cache, beam_width=beam_width,
+                                      beam_top_k=beam_top_k, history_compactor=history_compactor,
+                                      instrumentation=self.instrumentation, model=model, backend=backend,
+                                      evaluation=evaluation,
+                                      rate_limiter=rate_limiter, retry_policy=retry_policy,
+                                      model_router=model_router, models=models, dedup_index=dedup_index,
+                                      strategy_memory=strategy_memory, context_caches=context_caches,
+                                      decision_thresholds=self.policy.decision_thresholds)
         self._build_graph()
 
     def _build_graph(self):
         """Defines all nodes and edges for the agent's control flow."""
         # Add nodes
-        self.workflow.add_node("decompose_goal", self.tools.decompose_goal)
-        self.workflow.add_node("formulate_strategy", self.tools.formulate_strategy)
-        self.workflow.add_node("generate_prompt", self.tools.generate_prompt)
-        self.workflow.add_node("evaluate_prompt", self.tools.evaluate_prompt)
-        self.workflow.add_node("synthesize_reflection", self.tools.synthesize_reflection)
-        self.workflow.add_node("decide_next_step", self._decide_next_step)
-
-        # Define edges
-        self.workflow.set_entry_point("decompose_goal")
-        self.workflow.add_edge("decompose_goal", "formulate_strategy")
-        self.workflow.add_edge("formulate_strategy", "generate_prompt")
-        self.workflow.add_edge("generate_prompt", "evaluate_prompt")
-        self.workflow.add_edge("evaluate_prompt", "synthesize_reflection")
-        self.workflow.add_edge("synthesize_reflection", "decide_next_step")
+        self.workflow.add_node("decompose_goal", self._node("decompose_goal", self.tools.decompose_goal))
+        self.workflow.add_node("formulate_strategy", self._node("formulate_strategy", self.tools.formulate_strategy))
+        self.workflow.add_node("generate_prompt", self._node("generate_prompt", self.tools.generate_prompt))
+        self.workflow.add_node("evaluate_prompt", self._node("evaluate_prompt", self.tools.evaluate_prompt))
+        self.workflow.add_node("synthesize_reflection",
+                               self._node("synthesize_reflection", self.tools.synthesize_reflection))
+        self.workflow.add_node("decide_next_step", self._node("decide_next_step", self._decide_next_step))
 
-        # Define conditional edges
-        self.workflow.add_conditional_edges(
-            "decide_next_step",
-            self._router,
-            {
-                "CONTINUE_PROBING": "generate_prompt",
-                "REVISE_STRATEGY": "formulate_strategy",
-                "FINISH": END
-            }
+        # Define edges; a resumed run enters at the node after its last completed one
+        self.workflow.set_conditional_entry_point(
+            lambda state: state.get("resume_node") or "decompose_goal",
+            list(self.NEXT_NODE),
         )
+        for node, next_node in self.NEXT_NODE.items():
+            if next_node is not None:
+                self.workflow.add_edge(node, next_node)
+
+        # Define conditional edges
+        self.workflow.add_conditional_edges("decide_next_step", self._router, self.ROUTES)
+
+    def _node(self, name: str, fn: Callable[[AgentState], Dict]) -> Callable[[AgentState], Dict]:
+        """Wraps a node so that it is timed and, when a journal is configured, its state update is journaled."""
+        def run(state: AgentState) -> Dict:
+            run_id = state.get("run_id", "")
+            journaled = self.journal is not None and bool(run_id)
+            with self.instrumentation.node(name, run_id):
+                # A run is journaled from its first node on, unless it continues one rebuilt from the journal
+                if journaled and not state.get("resume_node") and not self.journal.is_open(run_id):
+                    self.journal.start_run(run_id, state)
+                update = fn(state)
+                if journaled:
+                    self.journal.record_step(run_id, name, update)
+                return update
+
+        return run
+
+    def resume_state(self, run_id: str) -> Optional[AgentState]:
+        """Rebuilds a journaled run's state, positioned to continue after its last completed node.
+
+        Returns None when the run had already reached FINISH.
+        """
+        if self.journal is None:
+            raise ValueError("Resuming requires the graph to be built with a journal.")
+        state, last_node = self.journal.load(run_id)
+        if last_node is None:
+            resume_node = "decompose_goal"
+        elif last_node == "decide_next_step":
+            resume_node = self.ROUTES[self._router(state)]
+            if resume_node == END:
+                return None
+        else:
+            resume_node = self.NEXT_NODE[last_node]
+        print(f"--- Resuming run {run_id} at node: {resume_node} ---")
+        state["run_id"] = run_id
+        state["resume_node"] = resume_node
+        return state
 
     def _decide_next_step(self, state: AgentState) -> Dict:
-        """A simple node to increment the iteration count before routing."""
+        """Increments the iteration count, tallies the run's usage and lets the policy choose the next route."""
         print("\n>>> EXECUTING NODE: DecideNextStep")
         iteration_count = state.get("iteration_count", 0) + 1
         print(f"Iteration {iteration_count} complete.")
-        return {"iteration_count": iteration_count}
+        update = {"iteration_count": iteration_count, "run_usage": self._run_usage(state)}
+        route, reason, stats = self.policy.decide({**state, **update})
+        update.update({"route": route, "route_reason": reason, "policy_stats": stats})
+        return update
+
+    def _run_usage(self, state: AgentState) -> Dict:
+        """Returns the run's cumulative LLM calls, tokens and node time, including work done before a resume."""
+        run_id = state.get("run_id", "")
+        totals = self.instrumentation.run_totals(run_id)
+        with self._usage_lock:
+            mark = self._usage_marks.pop(run_id, None) or {"llm_calls": 0, "tokens": 0, "elapsed_s": 0.0}
+            if run_id:
+                self._usage_marks[run_id] = totals
+                while len(self._usage_marks) > self.MAX_TRACKED_RUNS:
+                    self._usage_marks.popitem(last=False)
+        usage = dict(state.get("run_usage") or {"llm_calls": 0, "tokens": 0, "elapsed_s": 0.0})
+        for key in ("llm_calls", "tokens", "elapsed_s"):
+            usage[key] = usage.get(key, 0) + max(totals[key] - mark[key], 0)
+        usage["elapsed_s"] = round(usage["elapsed_s"], 3)
+        return usage
 
     def _router(self, state: AgentState) -> Literal:
-        """The routing logic based on the agent's state."""
+        """Routes on the decision made by decide_next_step."""
         print("--- Routing ---")
-        iteration_count = state["iteration_count"]
-        history = state["prompt_history"]
-
-        # Condition 1: FINISH
-        latest_eval = history[-1]["evaluation"]
-        avg_score = sum(s["score"] for s in latest_eval["scores"]) / len(latest_eval["scores"])
-        print(f"Average score for last iteration: {avg_score:.2f}")
-
-        if avg_score >= 8.5 or iteration_count >= 5:
-            print("Decision: FINISH (score threshold met or max iterations reached)")
-            return "FINISH"
-
-        # Condition 2: REVISE_STRATEGY
-        if iteration_count >= 2:
-            prev_eval = history[-2]["evaluation"]
-            prev_avg_score = sum(s["score"] for s in prev_eval["scores"]) / len(prev_eval["scores"])
-            if avg_score <= prev_avg_score:
-                print(f"Decision: REVISE_STRATEGY (progress stalled: {avg_score:.2f} <= {prev_avg_score:.2f})")
-                return "REVISE_STRATEGY"
-
-        # Condition 3: CONTINUE
-        print("Decision: CONTINUE_PROBING")
-        return "CONTINUE_PROBING"
+        route, reason = state["route"], state.get("route_reason", "")
+        print(f"Decision: {route} ({reason})")
+        if route == "FINISH":
+            with self._usage_lock:
+                self._usage_marks.pop(state.get("run_id", ""), None)
+        return route
 
     def compile_graph(self):
         """Compiles the graph into a runnable object."""
@@ -0,0 +1,43 @@
+BACKENDS = ("gemini", "fake")
+
+
+def create_chat_model(llm_model_name: str, temperature: float, backend: str = "gemini", **model_kwargs):
+    """Builds the chat model used by the agent's tools.
+
+    Any object exposing LangChain's `with_structured_output(schema, include_raw=True)` can serve as a backend.
+    Provider packages are imported lazily so that the offline backend needs no network dependencies.
+    `model_kwargs` are passed to the model's constructor, e.g. `cached_content` to reference a context cache.
+    """
+    if backend == "gemini":
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        return ChatGoogleGenerativeAI(model=llm_model_name, temperature=temperature, **model_kwargs)
+    if backend == "fake":
+        from fake_llm import FakeChatModel
+        return FakeChatModel(model=llm_model_name, temperature=temperature, **model_kwargs)
+    raise ValueError(f"Unknown model backend '{backend}'. Expected one of {BACKENDS}.")
+
+
+def close_chat_model(model):
+    """Closes the HTTP client of a model built by `create_chat_model`, if it holds one."""
+    close = getattr(model, "close", None)
+    if close is None:
+        # ChatGoogleGenerativeAI keeps its google-genai `Client`, which owns the connection pool, on `client`
+        close = getattr(getattr(model, "client", None), "close", None)
+    if callable(close):
+        close()
+
+
+def gemini_context_cache_factory(ttl_seconds: int = 3600):
+    """Returns a `ContextCacheRegistry` handle factory that stores template prefixes in Gemini's context cache."""
+    from google import genai
+    from google.genai import types
+
+    client = genai.Client()
+
+    def create_handle(model_name: str, template) -> str:
+        cached = client.caches.create(model=model_name, config=types.CreateCachedContentConfig(
+            display_name=f"p3ro-{template.name}-{template.fingerprint}", contents=[template.static],
+            ttl=f"{ttl_seconds}s"))
+        return cached.name
+
+    return create_handle
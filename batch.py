@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+
+from backends import BACKENDS
+from state import create_initial_state, find_best_prompt
+
+if TYPE_CHECKING:
+    from agents import P3RO_Graph
+    from evaluation import EvaluationConfig
+
+
+def validate_job(job) -> Dict:
+    """Checks that a job can run, raising ValueError otherwise, and returns it."""
+    if not isinstance(job, dict):
+        raise ValueError("A job must be a JSON object.")
+    for key in ("initial_prompt", "goal"):
+        if not isinstance(job.get(key), str) or not job[key].strip():
+            raise ValueError(f"A job needs a non-empty '{key}' string.")
+    if job.get("stop_policy") is not None and not isinstance(job["stop_policy"], dict):
+        raise ValueError("A job's 'stop_policy' must be an object.")
+    return job
+
+
+def read_jobs(jobs_path: str) -> Iterator[Dict]:
+    """Yields refinement jobs from a JSONL file.
+
+    Each line must hold an object with `initial_prompt` and `goal` keys. An optional `job_id` is used to
+    correlate results; the line number is used when it is missing. An optional `run_id` names the journaled
+    run, so re-running the same file after a crash resumes unfinished jobs instead of restarting them. An
+    optional `stop_policy` object overrides routing policy settings for the job, e.g. `{"token_budget": 20000}`.
+    A line that is not a valid job yields its error result instead, `{"job_id", "line", "status": "error",
+    "error"}`, so one bad line does not stop the others from running.
+    """
+    with open(jobs_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = validate_job(json.loads(line))
+            except ValueError as e:
+                print(f"Line {line_number} of {jobs_path} is not a valid job: {e}")
+                yield {"job_id": str(line_number), "line": line_number, "status": "error",
+                       "error": f"{type(e).__name__}: {e}"}
+                continue
+            job.setdefault("job_id", str(line_number))
+            yield job
+
+
+class BatchRunner:
+    """Runs many (initial_prompt, goal) jobs concurrently through a single compiled P³RO graph."""
+
+    def __init__(self, graph: Optional["P3RO_Graph"] = None, concurrency: int = 4):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1.")
+        if graph is None:
+            # LangGraph is slow to import, so it is only loaded once a graph is actually needed
+            from agents import P3RO_Graph
+            graph = P3RO_Graph()
+        self.graph = graph
+        self.app = self.graph.compile_graph()
+        self.concurrency = concurrency
+
+    async def _run_job(self, job: Dict, semaphore: asyncio.Semaphore) -> Dict:
+        """Runs a single job once a concurrency slot is free."""
+        if job.get("status") == "error":
+            # A line `read_jobs` could not turn into a job; its result is already known
+            return job
+        enqueued_at = time.perf_counter()
+        async with semaphore:
+            return await self.run_job(job, enqueued_at)
+
+    async def run_job(self, job: Dict, enqueued_at: Optional[float] = None) -> Dict:
+        """Runs a single job, converting any failure into an error record instead of raising.
+
+        `enqueued_at` is the `time.perf_counter()` at which the job was queued, to report how long it waited.
+        """
+        started_at = time.perf_counter()
+        queue_wait = started_at - (enqueued_at if enqueued_at is not None else started_at)
+        record = {"job_id": job["job_id"], "run_id": job.get("run_id") or uuid.uuid4().hex,
+                  "queue_wait_s": round(queue_wait, 3)}
+        self.graph.instrumentation.record_queue_wait(record["run_id"], queue_wait)
+        try:
+            final_state = await self._invoke(job, record["run_id"])
+            best_prompt, best_score = find_best_prompt(final_state.get("prompt_history"),
+                                                       final_state.get("candidates"))
+            record.update({
+                "status": "ok",
+                "best_prompt": best_prompt,
+                "best_score": best_score,
+                "iterations": final_state.get("iteration_count", 0),
+                "attempts": len(final_state.get("prompt_history", [])),
+                "stop_reason": final_state.get("route_reason", ""),
+            })
+        except Exception as e:
+            print(f"Job {job['job_id']} failed: {e}")
+            record.update({"status": "error", "error": f"{type(e).__name__}: {e}"})
+        record["elapsed_s"] = round(time.perf_counter() - started_at, 3)
+        return record
+
+    async def _invoke(self, job: Dict, run_id: str) -> Dict:
+        """Runs a job to completion, resuming its journaled run when one exists."""
+        journal = self.graph.journal
+        if journal is not None and journal.has_run(run_id):
+            initial_state = self.graph.resume_state(run_id)
+            if initial_state is None:
+                journal.finish_run(run_id)
+                return journal.load(run_id)[0]
+        else:
+            initial_state = create_initial_state(job["initial_prompt"], job["goal"], run_id=run_id,
+                                                 stop_policy=job.get("stop_policy"))
+
+        try:
+            final_state = await self.app.ainvoke(initial_state)
+        except BaseException:
+            if journal is not None:
+                journal.finish_run(run_id, status="failed")
+            raise
+        if journal is not None:
+            journal.finish_run(run_id)
+        if self.graph.strategy_memory is not None:
+            self.graph.strategy_memory.record(run_id, final_state)
+        return final_state
+
+    async def run(self, jobs: List[Dict], results_path: str) -> Dict:
+        """Runs all jobs and streams each result to `results_path` as soon as it completes."""
+        loop = asyncio.get_running_loop()
+        # Graph nodes are synchronous, so `ainvoke` runs them in the loop's default executor. Size it to the
+        # concurrency limit so throughput is not capped by the much smaller default pool.
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.concurrency))
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        summary = {"total": len(jobs), "ok": 0, "error": 0}
+        started_at = time.perf_counter()
+        tasks = [asyncio.create_task(self._run_job(job, semaphore)) for job in jobs]
+        with open(results_path, "w", encoding="utf-8") as out:
+            for finished in asyncio.as_completed(tasks):
+                record = await finished
+                summary[record["status"]] += 1
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+        summary["elapsed_s"] = round(time.perf_counter() - started_at, 3)
+        return summary
+
+    def close(self):
+        """Releases the shared model client."""
+        self.graph.tools.close()
+
+
+def add_graph_arguments(parser: argparse.ArgumentParser):
+    """Adds the options that configure the shared graph, its model clients and its stores."""
+    parser.add_argument("--cache-db", help="Enable the LLM response cache, persisted to this SQLite file.")
+    parser.add_argument("--cache-ttl", type=float, help="Expire cached responses after this many seconds.")
+    parser.add_argument("--checkpoint-db", help="Journal every run to this SQLite file so jobs can be resumed.")
+    parser.add_argument("--backend", choices=BACKENDS, default="gemini",
+                        help="Model backend; 'fake' runs offline with a deterministic stand-in.")
+    parser.add_argument("--trace", help="Write a JSON trace of per-node and per-call metrics to this file.")
+    parser.add_argument("--metrics", help="Write a Prometheus text dump of the aggregated metrics to this file.")
+    parser.add_argument("--beam-width", type=int, default=1, help="Candidates generated per iteration.")
+    parser.add_argument("--beam-top-k", type=int, default=1, help="Candidates kept for the next iteration.")
+    parser.add_argument("--eval-batch-size", type=int, default=1,
+                        help="Pack up to this many concurrent evaluations into one LLM request (not with "
+                             "--eval-samples or --eval-max-samples).")
+    parser.add_argument("--eval-max-wait", type=float, default=0.05,
+                        help="Seconds an evaluation waits for its batch to fill.")
+    parser.add_argument("--eval-samples", type=int, default=1,
+                        help="Evaluator samples drawn concurrently per candidate and aggregated.")
+    parser.add_argument("--eval-max-samples", type=int,
+                        help="Draw more samples, up to this many, while a score is too close to a routing "
+                             "threshold to call (needs --eval-samples of at least 2).")
+    parser.add_argument("--eval-temperature", type=float, help="Sampling temperature of the evaluator.")
+    parser.add_argument("--eval-aggregate", choices=("mean", "median"), default="mean",
+                        help="How evaluator samples are combined per criterion.")
+    parser.add_argument("--history-token-budget", type=int, default=1500,
+                        help="Token budget for the compacted history given to the strategist (0 sends it raw).")
+    parser.add_argument("--rpm", type=float, help="Provider request quota per minute shared by all jobs.")
+    parser.add_argument("--tpm", type=float, help="Provider token quota per minute shared by all jobs.")
+    parser.add_argument("--max-llm-concurrency", type=int, default=16,
+                        help="Upper bound for the adaptive number of LLM calls in flight.")
+    parser.add_argument("--max-attempts", type=int, default=5, help="Attempts per LLM call on retryable errors.")
+    parser.add_argument("--model", default="gemini-2.5-flash", help="Model for nodes without a --node-model.")
+    parser.add_argument("--node-model", action="append", default=[], metavar="NODE=MODEL",
+                        help="Model for one node, e.g. evaluate_prompt=gemini-2.5-pro; repeatable.")
+    parser.add_argument("--escalation-model", default="gemini-2.5-pro",
+                        help="Stronger model that retries unparseable or inconsistent evaluations ('' disables).")
+    parser.add_argument("--escalation-stdev", type=float, default=2.5,
+                        help="Escalate sampled evaluations whose samples score a criterion with a larger standard "
+                             "deviation.")
+    parser.add_argument("--memory-db", help="Remember finished runs in this SQLite file and seed new runs from "
+                                            "the most similar past successes.")
+    parser.add_argument("--memory-top-k", type=int, default=3, help="Similar past runs used to seed each run.")
+    parser.add_argument("--context-cache-ttl", type=int,
+                        help="With the gemini backend, store static prompt prefixes in Gemini's context cache for "
+                             "this many seconds instead of sending them with every call.")
+    parser.add_argument("--policy", default="adaptive", metavar="NAME[:SETTING=VALUE,...]",
+                        help="Routing policy, 'fixed' or 'adaptive', with optional settings, e.g. "
+                             "adaptive:token_budget=20000,latency_budget_s=120. Jobs can override settings "
+                             "with a stop_policy object.")
+    parser.add_argument("--dedup", choices=("off", "run", "shared"), default="run",
+                        help="Reuse evaluations of duplicate prompts within each run, across all runs, or never.")
+    parser.add_argument("--dedup-threshold", type=float, default=0.9,
+                        help="Estimated Jaccard similarity above which two prompts count as duplicates.")
+
+
+def evaluation_config(args) -> "EvaluationConfig":
+    """Returns the evaluation settings given by the `--eval-*` options."""
+    from evaluation import EvaluationConfig
+    return EvaluationConfig(batch_size=args.eval_batch_size, max_wait_s=args.eval_max_wait,
+                            samples=args.eval_samples, max_samples=args.eval_max_samples,
+                            temperature=args.eval_temperature, aggregate=args.eval_aggregate)
+
+
+def build_graph(args, concurrency: int):
+    """Builds the graph described by the options of `add_graph_arguments`, for `concurrency` jobs in flight."""
+    from agents import P3RO_Graph
+    from backends import gemini_context_cache_factory
+    from cache import ResponseCache
+    from checkpoint import RunJournal
+    from dedup import EvaluationIndex
+    from memory import StrategyMemory
+    from policy import create_policy
+    from ratelimit import AdaptiveConcurrency, RateLimiter, RetryPolicy
+    from routing import ModelRouter
+    from templates import ContextCacheRegistry
+
+    cache = ResponseCache(db_path=args.cache_db, ttl_seconds=args.cache_ttl) if args.cache_db else None
+    journal = RunJournal(args.checkpoint_db) if args.checkpoint_db else None
+    llm_concurrency = AdaptiveConcurrency(initial=min(concurrency, args.max_llm_concurrency),
+                                          maximum=args.max_llm_concurrency)
+    limiter = RateLimiter(requests_per_minute=args.rpm, tokens_per_minute=args.tpm, concurrency=llm_concurrency)
+    node_models = dict(spec.split("=", 1) for spec in args.node_model)
+    router = ModelRouter(default_model=args.model, node_models=node_models,
+                         escalation_model=args.escalation_model or None, sample_stdev_threshold=args.escalation_stdev)
+    dedup_index = None
+    if args.dedup != "off":
+        dedup_index = EvaluationIndex(threshold=args.dedup_threshold, shared=args.dedup == "shared")
+    memory = StrategyMemory(args.memory_db, top_k=args.memory_top_k) if args.memory_db else None
+    context_caches = None
+    if args.context_cache_ttl and args.backend == "gemini":
+        # Gemini rejects cached contents below its minimum size; smaller prefixes rely on implicit caching
+        context_caches = ContextCacheRegistry(gemini_context_cache_factory(args.context_cache_ttl), min_tokens=1024,
+                                              ttl_s=args.context_cache_ttl)
+    return P3RO_Graph(cache=cache, beam_width=args.beam_width, beam_top_k=args.beam_top_k,
+                      history_token_budget=args.history_token_budget, journal=journal, backend=args.backend,
+                      evaluation=evaluation_config(args),
+                      rate_limiter=limiter, retry_policy=RetryPolicy(max_attempts=args.max_attempts),
+                      model_router=router, dedup_index=dedup_index, strategy_memory=memory,
+                      context_caches=context_caches, policy=create_policy(args.policy))
+
+
+def close_graph(graph, args):
+    """Exports the requested metrics, prints the shared components' stats and closes clients and stores."""
+    tools = graph.tools
+    tools.close()
+    if args.trace:
+        graph.instrumentation.export_json(args.trace)
+    if args.metrics:
+        graph.instrumentation.write_prometheus(args.metrics)
+    print(f"Rate limiter stats: {tools.rate_limiter.stats()}")
+    print(f"Model routing stats: {tools.model_router.stats()}")
+    print(f"Structured output stats: {tools.output_repair.stats()}")
+    if tools.dedup_index is not None:
+        print(f"Evaluation dedup stats: {tools.dedup_index.stats()}")
+    if tools.sampled_evaluator is not None:
+        print(f"Evaluation sampling stats: {tools.sampled_evaluator.stats()}")
+    for key, agg in graph.instrumentation.summary()["models"].items():
+        print(f"  {key}: {agg['calls']} calls, {agg['wall_time_s'] / max(agg['calls'], 1):.2f}s mean, "
+              f"{agg['cached_input_tokens']}/{agg['input_tokens']} input tokens cached, ${agg['cost_usd']:.4f}")
+    if graph.strategy_memory is not None:
+        print(f"Strategy memory stats: {graph.strategy_memory.stats()}")
+        graph.strategy_memory.close()
+    if tools.cache is not None:
+        print(f"Cache stats: {tools.cache.stats()}")
+        tools.cache.close()
+    if graph.journal is not None:
+        graph.journal.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refine many prompts concurrently with the P³RO agent.")
+    parser.add_argument("jobs", help="Path to a JSONL file of {job_id?, initial_prompt, goal} objects.")
+    parser.add_argument("results", help="Path of the JSONL file to stream results into.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of jobs in flight.")
+    add_graph_arguments(parser)
+    args = parser.parse_args()
+
+    load_dotenv()
+    jobs = list(read_jobs(args.jobs))
+    print(f"--- Running {len(jobs)} jobs with concurrency {args.concurrency} ---")
+
+    graph = build_graph(args, args.concurrency)
+    runner = BatchRunner(graph=graph, concurrency=args.concurrency)
+    try:
+        summary = asyncio.run(runner.run(jobs, args.results))
+    finally:
+        close_graph(graph, args)
+    print(f"\n--- Batch Finished: {summary['ok']} ok, {summary['error']} failed in {summary['elapsed_s']}s ---")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+from typing import Dict, List
+
+from agents import P3RO_Graph
+from batch import BatchRunner
+from evaluation import EvaluationConfig
+from fake_llm import FakeChatModel
+from policy import create_policy
+
+# Score behaviour of the simulated evaluator for each scenario
+SCENARIOS = {
+    "converging": {"score_trajectory": [5.0, 6.0, 7.0, 8.0, 9.0], "score_noise": 0.5},
+    "plateau": {"score_trajectory": [6.0, 7.0, 7.0, 7.0, 7.0], "score_noise": 1.0},
+    "noisy": {"score_trajectory": [6.0, 7.0, 8.0, 8.5, 9.0], "score_noise": 2.0},
+    "instant": {"score_trajectory": [9.0], "score_noise": 0.0},
+}
+
+# Metrics where a higher value is a regression; for all others a lower value is
+LOWER_IS_BETTER = {"failed_jobs", "llm_calls_per_job", "iterations_mean", "revisions_per_job", "reasks_per_job",
+                   "peak_memory_mb", "node_overhead_ms"}
+
+
+def _run_batch(graph: P3RO_Graph, jobs: List[Dict], concurrency: int) -> Dict:
+    """Runs the jobs through a batch runner with the agent's console output silenced."""
+    with tempfile.TemporaryDirectory() as tmp:
+        results_path = os.path.join(tmp, "results.jsonl")
+        with contextlib.redirect_stdout(io.StringIO()):
+            runner = BatchRunner(graph=graph, concurrency=concurrency)
+            summary = asyncio.run(runner.run(jobs, results_path))
+        with open(results_path, "r", encoding="utf-8") as f:
+            summary["results"] = [json.loads(line) for line in f]
+    return summary
+
+
+def _build_graph(scenario: str, args) -> P3RO_Graph:
+    """Builds a graph backed by a fake model configured for the scenario."""
+    model = FakeChatModel(latency_s=args.latency, seed=args.seed, resample=args.resample,
+                          malformed_rate=args.malformed_rate, **SCENARIOS[scenario])
+    with contextlib.redirect_stdout(io.StringIO()):
+        return P3RO_Graph(model=model, beam_width=args.beam_width, beam_top_k=args.beam_top_k,
+                          policy=create_policy(args.policy),
+                          evaluation=EvaluationConfig(batch_size=args.eval_batch_size, samples=args.eval_samples,
+                                                      max_samples=args.eval_max_samples,
+                                                      aggregate=args.eval_aggregate))
+
+
+def run_scenario(scenario: str, args) -> Dict:
+    """Benchmarks one scenario and returns its metrics."""
+    jobs = [{"job_id": str(i), "initial_prompt": f"Write a tweet about product {i}.", "goal": "Make it exciting."}
+            for i in range(args.jobs)]
+
+    # Timed pass
+    graph = _build_graph(scenario, args)
+    summary = _run_batch(graph, jobs, args.concurrency)
+    ok = [r for r in summary["results"] if r["status"] == "ok"]
+    stats = graph.instrumentation.summary()
+    outputs = graph.tools.output_repair.stats()
+    node_calls = sum(agg["calls"] for agg in stats["nodes"].values())
+    llm_calls = sum(agg["calls"] for agg in stats["llm_calls"].values())
+    # Time spent in nodes outside of LLM calls: prompt rendering, state handling, journaling, etc. Calls made
+    # concurrently inside one node (beam mode) overlap, so only one call's worth of time is subtracted per run
+    overhead = 0.0
+    for node, agg in stats["nodes"].items():
+        llm = stats["llm_calls"].get(node)
+        llm_time = llm["wall_time_s"] * min(1.0, agg["calls"] / llm["calls"]) if llm and llm["calls"] else 0.0
+        overhead += agg["wall_time_s"] - llm_time
+
+    # Memory pass; tracing slows execution, so it is kept separate from the timed pass
+    graph = _build_graph(scenario, args)
+    tracemalloc.start()
+    _run_batch(graph, jobs, args.concurrency)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "jobs": args.jobs,
+        "failed_jobs": len(summary["results"]) - len(ok),
+        "jobs_per_s": round(args.jobs / summary["elapsed_s"], 3) if summary["elapsed_s"] else 0.0,
+        "llm_calls_per_job": round(llm_calls / args.jobs, 3),
+        "iterations_mean": round(sum(r["iterations"] for r in ok) / len(ok), 3) if ok else 0.0,
+        # Every run formulates one strategy up front; each further formulation is a REVISE_STRATEGY decision
+        "revisions_per_job": round(stats["nodes"].get("formulate_strategy", {}).get("calls", 0) / args.jobs - 1, 3),
+        "best_score_mean": round(sum(r["best_score"] for r in ok) / len(ok), 3) if ok else 0.0,
+        "reasks_per_job": round((outputs["reasked"] + outputs["failed"]) / args.jobs, 3),
+        "structured_outputs": outputs,
+        "node_overhead_ms": round(overhead / node_calls * 1000, 3) if node_calls else 0.0,
+        "node_seconds": {node: round(agg["wall_time_s"], 3) for node, agg in stats["nodes"].items()},
+        "peak_memory_mb": round(peak / 2 ** 20, 3),
+    }
+
+
+def find_regressions(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Compares results against a baseline and describes every metric that got worse beyond `tolerance`."""
+    regressions = []
+    for scenario, metrics in results.items():
+        for metric, value in metrics.items():
+            previous = baseline.get(scenario, {}).get(metric)
+            if metric == "jobs" or not isinstance(value, (int, float)) or not isinstance(previous, (int, float)):
+                continue
+            if not previous:
+                if metric == "failed_jobs" and value > previous:
+                    regressions.append(f"{scenario}.{metric}: {previous} -> {value}")
+                continue
+            change = (value - previous) / previous
+            if change > tolerance if metric in LOWER_IS_BETTER else change < -tolerance:
+                regressions.append(f"{scenario}.{metric}: {previous} -> {value} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the P³RO graph offline with a fake LLM backend.")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario to run; repeat to run several. Defaults to all.")
+    parser.add_argument("--jobs", type=int, default=20, help="Jobs per scenario.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Jobs in flight.")
+    parser.add_argument("--latency", type=float, default=0.01, help="Simulated seconds per LLM call.")
+    parser.add_argument("--beam-width", type=int, default=1)
+    parser.add_argument("--beam-top-k", type=int, default=1)
+    parser.add_argument("--eval-batch-size", type=int, default=1)
+    parser.add_argument("--eval-samples", type=int, default=1, help="Evaluator samples per candidate.")
+    parser.add_argument("--eval-max-samples", type=int, help="Samples drawn at most for scores close to a threshold.")
+    parser.add_argument("--eval-aggregate", choices=("mean", "median"), default="mean")
+    parser.add_argument("--resample", action="store_true",
+                        help="Let the fake evaluator score repeated identical requests independently, as a model "
+                             "sampled at a non-zero temperature would.")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="Share of fake responses returned as output the structured-output parser rejects.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--policy", default="adaptive", help="Routing policy spec, e.g. fixed or adaptive.")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="JSON results of an earlier run; exit non-zero on regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative change before failing.")
+    args = parser.parse_args()
+
+    results = {}
+    for scenario in args.scenario or sorted(SCENARIOS):
+        results[scenario] = run_scenario(scenario, args)
+        metrics = results[scenario]
+        print(f"{scenario:>12}: {metrics['jobs_per_s']:>8} jobs/s  {metrics['llm_calls_per_job']:>6} calls/job  "
+              f"{metrics['iterations_mean']:>5} iterations  {metrics['revisions_per_job']:>5} revisions/job  "
+              f"{metrics['node_overhead_ms']:>7} ms overhead/node  "
+              f"{metrics['peak_memory_mb']:>7} MB peak")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            sys.exit(1)
+        print("\nNo regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
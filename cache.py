@@ -0,0 +1,150 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Optional, Type
+
+from pydantic import BaseModel
+
+
+@lru_cache(maxsize=None)
+def _schema_json(pydantic_class: Type[BaseModel]) -> str:
+    """Returns a class's JSON schema as canonical text; building the schema is costly, so it is done once."""
+    return json.dumps(pydantic_class.model_json_schema(), sort_keys=True)
+
+
+class ResponseCache:
+    """A content-addressed cache for structured LLM responses.
+
+    Responses are keyed on (model, temperature, schema class, prompt text) and stored in two tiers: a bounded
+    in-memory LRU and an optional SQLite file that survives restarts. Both tiers honour the same TTL.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, max_memory_entries: int = 1024,
+                 max_disk_entries: int = 100_000, ttl_seconds: Optional[float] = None):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "memory_hits": 0, "disk_hits": 0, "writes": 0, "evictions": 0,
+                       "expirations": 0}
+
+        self._conn = None
+        if db_path:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(model_name: str, temperature: float, pydantic_class: Type[BaseModel], prompt: str) -> str:
+        """Builds the content address for a structured call."""
+        payload = json.dumps([model_name, temperature, f"{pydantic_class.__module__}.{pydantic_class.__qualname__}",
+                              _schema_json(pydantic_class), prompt])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def _remember(self, key: str, value: str, created_at: float):
+        """Inserts into the memory tier, evicting least-recently-used entries beyond the size limit."""
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def get(self, key: str, pydantic_class: Type[BaseModel]) -> Optional[BaseModel]:
+        """Returns the cached response for `key`, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if self._is_expired(created_at, now):
+                    del self._memory[key]
+                    self._stats["expirations"] += 1
+                else:
+                    self._memory.move_to_end(key)
+                    self._stats["hits"] += 1
+                    self._stats["memory_hits"] += 1
+                    return pydantic_class.model_validate_json(value)
+
+            if self._conn is not None:
+                row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value, created_at = row
+                    if self._is_expired(created_at, now):
+                        self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                        self._conn.commit()
+                        self._stats["expirations"] += 1
+                    else:
+                        self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                        self._conn.commit()
+                        self._remember(key, value, created_at)
+                        self._stats["hits"] += 1
+                        self._stats["disk_hits"] += 1
+                        return pydantic_class.model_validate_json(value)
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key: str, response: BaseModel):
+        """Stores a response in both tiers."""
+        now = time.time()
+        value = response.model_dump_json()
+        with self._lock:
+            self._remember(key, value, now)
+            self._stats["writes"] += 1
+            if self._conn is None:
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+            if count > self.max_disk_entries:
+                overflow = count - self.max_disk_entries
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                    (overflow,),
+                )
+                self._stats["evictions"] += overflow
+            self._conn.commit()
+
+    def purge_expired(self) -> int:
+        """Drops every expired entry from both tiers and returns how many disk rows were removed."""
+        if self.ttl_seconds is None:
+            return 0
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            for key in [k for k, (_, created_at) in self._memory.items() if created_at < cutoff]:
+                del self._memory[key]
+            if self._conn is None:
+                return 0
+            removed = self._conn.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,)).rowcount
+            self._conn.commit()
+            self._stats["expirations"] += removed
+            return removed
+
+    def stats(self) -> Dict[str, float]:
+        """Returns hit/miss counters and the overall hit rate."""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def close(self):
+        """Closes the on-disk tier."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
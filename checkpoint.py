@@ -0,0 +1,165 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from state import AgentState, Attempt, PromptHistory, encode_state_value
+
+HISTORY_KEY = "prompt_history"
+
+
+class RunJournal:
+    """A durable, append-only journal of node transitions, stored in SQLite.
+
+    Every completed node appends one row holding only what that node changed. Since `prompt_history` is
+    append-only, a row holds just the attempts its node appended, so writes stay small as the history grows.
+    Replaying the rows rebuilds the state after the last completed node.
+    """
+
+    def __init__(self, db_path: str = "p3ro_runs.db"):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "run_id TEXT PRIMARY KEY, initial_state TEXT NOT NULL, status TEXT NOT NULL, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS steps ("
+            "run_id TEXT NOT NULL, seq INTEGER NOT NULL, node TEXT NOT NULL, delta TEXT NOT NULL, "
+            "created_at REAL NOT NULL, PRIMARY KEY (run_id, seq))"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+        # Next step number of each run being written by this process, so steps are appended without re-reading
+        self._next_seq: Dict[str, int] = {}
+
+    def has_run(self, run_id: str) -> bool:
+        """Returns whether the journal already holds a run with this id."""
+        with self._lock:
+            return run_id in self._next_seq or self._conn.execute(
+                "SELECT 1 FROM runs WHERE run_id = ?", (run_id,)).fetchone() is not None
+
+    def is_open(self, run_id: str) -> bool:
+        """Returns whether this process is writing the run, i.e. has journaled a step of it since it last finished."""
+        with self._lock:
+            return run_id in self._next_seq
+
+    def start_run(self, run_id: str, initial_state: AgentState):
+        """Registers a new run with its initial state.
+
+        Raises ValueError if the journal already holds a run with this id; such a run is continued from `load`.
+        """
+        now = time.time()
+        initial_state = {k: v for k, v in initial_state.items() if k != "resume_node"}
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT INTO runs (run_id, initial_state, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (run_id, json.dumps(initial_state, default=encode_state_value), "running", now, now),
+                )
+            except sqlite3.IntegrityError:
+                # Ends the transaction the failed insert opened, which would lock out other writers
+                self._conn.rollback()
+                raise ValueError(f"The journal already holds a run with id '{run_id}'; resume it or use a new id.")
+            self._conn.commit()
+            self._next_seq[run_id] = 0
+
+    def record_step(self, run_id: str, node: str, update: Dict):
+        """Appends the changes made by `node` to the journal."""
+        delta = {key: value for key, value in update.items() if key != HISTORY_KEY}
+        if HISTORY_KEY in update:
+            history = update[HISTORY_KEY]
+            # Nodes return only their new attempts; a whole history replaces the journaled one
+            delta[HISTORY_KEY] = {"replace" if isinstance(history, PromptHistory) else "append": list(history)}
+        raw_delta = json.dumps(delta, default=encode_state_value)
+        with self._lock:
+            seq = self._next_seq.get(run_id)
+            if seq is None:
+                # A run continued without `load`, e.g. by another journal instance; its steps are in the database
+                seq = self._conn.execute("SELECT coalesce(max(seq) + 1, 0) FROM steps WHERE run_id = ?",
+                                         (run_id,)).fetchone()[0]
+            now = time.time()
+            self._conn.execute("INSERT INTO steps (run_id, seq, node, delta, created_at) VALUES (?, ?, ?, ?, ?)",
+                               (run_id, seq, node, raw_delta, now))
+            self._conn.execute("UPDATE runs SET updated_at = ? WHERE run_id = ?", (now, run_id))
+            self._conn.commit()
+            self._next_seq[run_id] = seq + 1
+
+    def finish_run(self, run_id: str, status: str = "finished"):
+        """Marks a run as finished (or failed) and releases its in-memory bookkeeping.
+
+        The run is closed either way: continuing it, e.g. after a failure, starts from `load`.
+        """
+        with self._lock:
+            self._conn.execute("UPDATE runs SET status = ?, updated_at = ? WHERE run_id = ?",
+                               (status, time.time(), run_id))
+            self._conn.commit()
+            self._next_seq.pop(run_id, None)
+
+    def run_status(self, run_id: str) -> Optional[str]:
+        """Returns the stored status of a run, or None if it is unknown."""
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        return row[0] if row else None
+
+    def run_ids(self, status: Optional[str] = None) -> List[str]:
+        """Returns the ids of all journaled runs, or of those with the given status, oldest first."""
+        with self._lock:
+            if status is None:
+                rows = self._conn.execute("SELECT run_id FROM runs ORDER BY created_at").fetchall()
+            else:
+                rows = self._conn.execute("SELECT run_id FROM runs WHERE status = ? ORDER BY created_at",
+                                          (status,)).fetchall()
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def _decode_initial_state(raw: str) -> AgentState:
+        """Parses a journaled initial state, rebuilding its attempts."""
+        state = json.loads(raw)
+        state[HISTORY_KEY] = PromptHistory.from_dicts(state.get(HISTORY_KEY, []))
+        state["candidates"] = [Attempt.from_dict(entry) for entry in state.get("candidates", [])]
+        return state
+
+    def replay(self, run_id: str) -> Iterator[Tuple[str, AgentState]]:
+        """Yields each completed node with the run's state right after it.
+
+        The yielded state is updated in place by later steps; its `prompt_history` is a `PromptHistory` that
+        later steps extend, so earlier yielded histories keep their length.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT initial_state FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+            if row is None:
+                raise KeyError(f"No journaled run with id '{run_id}'.")
+            steps = self._conn.execute("SELECT node, delta FROM steps WHERE run_id = ? ORDER BY seq",
+                                       (run_id,)).fetchall()
+
+        state = self._decode_initial_state(row[0])
+        for node, raw_delta in steps:
+            delta = json.loads(raw_delta)
+            history_delta = delta.pop(HISTORY_KEY, None)
+            if "candidates" in delta:
+                delta["candidates"] = [Attempt.from_dict(entry) for entry in delta["candidates"]]
+            state.update(delta)
+            if history_delta and "append" in history_delta:
+                state[HISTORY_KEY] = state[HISTORY_KEY].appended(
+                    Attempt.from_dict(entry) for entry in history_delta["append"])
+            elif history_delta:
+                state[HISTORY_KEY] = PromptHistory.from_dicts(history_delta["replace"])
+            yield node, state
+
+    def load(self, run_id: str) -> Tuple[AgentState, Optional[str]]:
+        """Replays a run's journal and returns its latest state and the last completed node."""
+        state, last_node = None, None
+        for last_node, state in self.replay(run_id):
+            pass
+        if state is None:
+            with self._lock:
+                state = self._decode_initial_state(self._conn.execute(
+                    "SELECT initial_state FROM runs WHERE run_id = ?", (run_id,)).fetchone()[0])
+        return state, last_node
+
+    def close(self):
+        """Closes the underlying database connection."""
+        self._conn.close()
@@ -0,0 +1,100 @@
+import threading
+from typing import Dict
+
+from state import PromptHistory
+
+
+def estimate_tokens(text: str, chars_per_token: int = 4) -> int:
+    """Cheap token estimate used for budgeting; close enough for English prompts."""
+    return -(-len(text) // chars_per_token)
+
+
+def _elide(text: str, limit: int) -> str:
+    """Shortens `text` to roughly `limit` characters, keeping its beginning and end."""
+    if len(text) <= limit:
+        return text
+    head = max(limit * 2 // 3, 0)
+    tail = max(limit - head, 0)
+    return f"{text[:head]} [...] {text[len(text) - tail:]}" if tail else f"{text[:head]} [...]"
+
+
+class HistoryCompactor:
+    """Builds a bounded context from `prompt_history` for the StrategyFormulator.
+
+    Instead of the raw history, the context holds the best prompt so far, the last attempt, a score
+    trajectory table and the lowest-scoring criteria with their justifications. Sections are shrunk until the
+    rendered context fits within `token_budget`.
+    """
+
+    def __init__(self, token_budget: int = 1500, max_weak_criteria: int = 3, max_trajectory_rows: int = 20):
+        self.token_budget = token_budget
+        self.max_weak_criteria = max_weak_criteria
+        self.max_trajectory_rows = max_trajectory_rows
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "raw_tokens": 0, "compacted_tokens": 0}
+
+    def _render(self, history: PromptHistory, prompt_chars: int, rows: int, weak: int) -> str:
+        """Renders the context with the given section limits."""
+        last, best_index, best = history[-1], history.best_index, history.best
+        lines = []
+
+        if best is not None:
+            criteria = last.criteria or best.criteria
+            lines.append("Score trajectory (attempt | iteration | average | per-criterion scores in order "
+                         f"{[_elide(c, 60) for c in criteria]}):")
+            start = max(len(history) - rows, 0)
+            for index, attempt in enumerate(history[start:], start=start):
+                if attempt.evaluated:
+                    spread = f" ± {attempt.average_ci:.2f}" if attempt.samples > 1 else ""
+                    lines.append(f"  {index} | {attempt.iteration} | {attempt.average_score:.2f}{spread} | "
+                                 f"{attempt.scores.tolist()}")
+            lines.append(f"Best prompt so far (attempt {best_index}, average "
+                         f"{best.average_score:.2f}): {_elide(best.prompt_text, prompt_chars)}")
+
+        if last is not best:
+            lines.append(f"Last attempt: {_elide(last.prompt_text, prompt_chars)}")
+        lines.append(f"Reasoning behind the last attempt: {_elide(last.reasoning, prompt_chars // 2)}")
+
+        if last.evaluated:
+            lines.append(f"Feedback on the last attempt: {_elide(last.feedback, prompt_chars // 2)}")
+            lowest = sorted(range(len(last.scores)), key=lambda i: last.scores[i])[:weak]
+            if lowest:
+                lines.append("Lowest-scoring criteria on the last attempt:")
+                for i in lowest:
+                    lines.append(f"  - {last.criteria[i]} ({last.scores[i]}/10): "
+                                 f"{_elide(last.justifications[i], 200)}")
+        return "\n".join(lines)
+
+    def compact(self, prompt_history: PromptHistory) -> str:
+        """Returns a context string for `prompt_history` that fits within the token budget."""
+        if not prompt_history:
+            return "None"
+
+        prompt_chars, rows, weak = 2000, self.max_trajectory_rows, self.max_weak_criteria
+        context = self._render(prompt_history, prompt_chars, rows, weak)
+
+        # Shrink the largest sections first, then hard-truncate if the floor is still over budget
+        while estimate_tokens(context) > self.token_budget and (prompt_chars > 200 or rows > 3 or weak > 1):
+            prompt_chars = max(prompt_chars // 2, 200)
+            rows = max(rows // 2, 3)
+            weak = max(weak - 1, 1)
+            context = self._render(prompt_history, prompt_chars, rows, weak)
+        if estimate_tokens(context) > self.token_budget:
+            context = _elide(context, self.token_budget * 4)
+        return context
+
+    def record(self, raw_prompt: str, compacted_prompt: str) -> Dict[str, int]:
+        """Records the size of a rendered prompt before and after compaction and returns the comparison."""
+        metric = {"raw_tokens": estimate_tokens(raw_prompt), "compacted_tokens": estimate_tokens(compacted_prompt)}
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["raw_tokens"] += metric["raw_tokens"]
+            self._stats["compacted_tokens"] += metric["compacted_tokens"]
+        return metric
+
+    def stats(self) -> Dict[str, float]:
+        """Returns cumulative before/after token estimates and the overall saving ratio."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["saved_ratio"] = 1 - stats["compacted_tokens"] / stats["raw_tokens"] if stats["raw_tokens"] else 0.0
+        return stats
@@ -0,0 +1,138 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_NON_WORD = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+# Modulus of the universal hash family used to derive MinHash permutations (the Mersenne prime 2**61 - 1)
+_PRIME = (1 << 61) - 1
+
+
+def normalize_prompt(text: str) -> str:
+    """Lowercases a prompt and strips punctuation and redundant whitespace, so trivial edits compare equal."""
+    return _WHITESPACE.sub(" ", _NON_WORD.sub(" ", text.lower())).strip()
+
+
+def _hash(text: str) -> int:
+    """Returns a stable 64-bit hash of `text`."""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class EvaluationIndex:
+    """Remembers evaluated prompts so that identical or near-identical candidates are not scored again.
+
+    Prompts are matched exactly on a hash of their normalized text, and approximately with MinHash signatures
+    of word shingles: locality-sensitive bands over the signature find candidates, which match when their
+    estimated Jaccard similarity is at least `threshold`. Evaluations only transfer between prompts scored
+    against the same criteria. Entries are scoped per run, or shared by all runs when `shared` is set; the most
+    recent `max_scopes` scopes are kept, each with up to `max_entries` prompts.
+    """
+
+    def __init__(self, threshold: float = 0.9, num_perm: int = 64, bands: int = 16, shingle_size: int = 3,
+                 shared: bool = False, max_scopes: int = 10_000, max_entries: int = 1024):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands.")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.shared = shared
+        self.max_scopes = max_scopes
+        self.max_entries = max_entries
+        seeds = [_hash(f"minhash-{i}") for i in range(2 * num_perm)]
+        self._permutations = [(seeds[2 * i] % _PRIME or 1, seeds[2 * i + 1] % _PRIME) for i in range(num_perm)]
+        self._lock = threading.Lock()
+        self._scopes: "OrderedDict[Tuple[str, int], Dict]" = OrderedDict()
+        self._stats = {"lookups": 0, "exact_hits": 0, "near_hits": 0, "regenerations": 0}
+
+    def _signature(self, normalized: str) -> Tuple[int, ...]:
+        """Computes the MinHash signature of a normalized prompt's word shingles."""
+        words = normalized.split()
+        size = min(self.shingle_size, len(words)) or 1
+        shingles = {_hash(" ".join(words[i:i + size])) for i in range(max(len(words) - size + 1, 1))}
+        return tuple(min((a * s + b) % _PRIME for s in shingles) for a, b in self._permutations)
+
+    def _bands(self, signature: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+        """Splits a signature into its locality-sensitive bands."""
+        return [(band, signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    def _scope(self, run_id: str, criteria: Iterable[str], create: bool) -> Optional[Dict]:
+        """Returns the entries for a run and criteria set; must be called with the lock held."""
+        key = ("" if self.shared else run_id, _hash("\n".join(criteria)))
+        scope = self._scopes.get(key)
+        if scope is None and create:
+            scope = self._scopes[key] = {"exact": OrderedDict(), "buckets": defaultdict(set), "signatures": {}}
+            while len(self._scopes) > self.max_scopes:
+                self._scopes.popitem(last=False)
+        if scope is not None:
+            self._scopes.move_to_end(key)
+        return scope
+
+    def has_scope(self, run_id: str, criteria: Iterable[str]) -> bool:
+        """Returns whether anything has been indexed for the run and criteria."""
+        with self._lock:
+            return self._scope(run_id, criteria, create=False) is not None
+
+    def lookup(self, run_id: str, criteria: List[str], prompt_text: str) -> Optional[Tuple[str, Dict]]:
+        """Returns ("exact" or "near", stored evaluation) for a previously evaluated match, or None."""
+        normalized = normalize_prompt(prompt_text)
+        exact_key = _hash(normalized)
+        signature = self._signature(normalized)
+        with self._lock:
+            self._stats["lookups"] += 1
+            scope = self._scope(run_id, criteria, create=False)
+            if scope is None:
+                return None
+            if exact_key in scope["exact"]:
+                self._stats["exact_hits"] += 1
+                return "exact", scope["exact"][exact_key]
+            candidates = set()
+            for band in self._bands(signature):
+                candidates |= scope["buckets"].get(band, set())
+            best_key, best_similarity = None, 0.0
+            for key in candidates:
+                stored = scope["signatures"][key]
+                similarity = sum(x == y for x, y in zip(signature, stored)) / self.num_perm
+                if similarity > best_similarity:
+                    best_key, best_similarity = key, similarity
+            if best_key is None or best_similarity < self.threshold:
+                return None
+            self._stats["near_hits"] += 1
+            return "near", scope["exact"][best_key]
+
+    def add(self, run_id: str, criteria: List[str], prompt_text: str, evaluation: Dict):
+        """Indexes an evaluated prompt."""
+        normalized = normalize_prompt(prompt_text)
+        exact_key = _hash(normalized)
+        signature = self._signature(normalized)
+        with self._lock:
+            scope = self._scope(run_id, criteria, create=True)
+            if exact_key in scope["exact"]:
+                return
+            scope["exact"][exact_key] = evaluation
+            scope["signatures"][exact_key] = signature
+            for band in self._bands(signature):
+                scope["buckets"][band].add(exact_key)
+            if len(scope["exact"]) > self.max_entries:
+                evicted, _ = scope["exact"].popitem(last=False)
+                for band in self._bands(scope["signatures"].pop(evicted)):
+                    scope["buckets"][band].discard(evicted)
+                    if not scope["buckets"][band]:
+                        del scope["buckets"][band]
+
+    def record_regeneration(self):
+        """Counts a candidate that was regenerated because it duplicated an evaluated prompt."""
+        with self._lock:
+            self._stats["regenerations"] += 1
+
+    def stats(self) -> Dict:
+        """Returns lookup, exact/near hit and regeneration counters plus the hit rate."""
+        with self._lock:
+            stats = dict(self._stats)
+        hits = stats["exact_hits"] + stats["near_hits"]
+        stats["hit_rate"] = round(hits / stats["lookups"], 4) if stats["lookups"] else 0.0
+        return stats
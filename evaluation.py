@@ -0,0 +1,261 @@
+import statistics
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from instrumentation import current_run_id
+from state import BatchEvaluationResult, EvaluationResult, confidence_half_width
+from templates import RenderedPrompt
+
+# Header that introduces each item in a batched evaluation prompt
+ITEM_HEADER = "### Item {item_id}"
+
+# (item_id, prompt_text, criteria)
+EvaluationItem = Tuple[int, str, List[str]]
+
+# Ways of combining evaluator samples into one score per criterion
+AGGREGATES = {"mean": statistics.fmean, "median": statistics.median}
+
+
+@dataclass
+class EvaluationConfig:
+    """How candidate prompts are scored.
+
+    A `batch_size` above 1 packs concurrent evaluations, across candidates and runs, into shared requests of up
+    to that many prompts, waiting at most `max_wait_s` for a batch to fill; see `BatchEvaluator`. A `samples`
+    count above 1 scores each candidate with that many independent evaluator samples instead, combined by
+    `aggregate`, drawing up to `max_samples` while a score is too close to a routing threshold to call; see
+    `SampledEvaluator`. The two cannot be combined: samples of one prompt must be separate requests to be
+    independent. The evaluator samples at `temperature` when given, for the models the tools create.
+    """
+    batch_size: int = 1
+    max_wait_s: float = 0.05
+    samples: int = 1
+    max_samples: Optional[int] = None
+    temperature: Optional[float] = None
+    aggregate: str = "mean"
+
+    def __post_init__(self):
+        if self.batch_size > 1 and self.sampled:
+            raise ValueError("Batched evaluation cannot be combined with several evaluator samples.")
+
+    @property
+    def sampled(self) -> bool:
+        """Whether candidates are scored with several samples."""
+        return self.samples > 1 or (self.max_samples or 1) > 1
+
+
+# Result handed back for items the batch did not answer validly; the caller then evaluates them on its own
+_FALLBACK = object()
+
+# (prompt_text, criteria, run_id of the caller, future the caller waits on)
+_PendingItem = Tuple[str, List[str], str, Future]
+
+
+def _criterion_key(name: str) -> str:
+    """Returns a criterion name with case and whitespace differences removed, for comparing names."""
+    return " ".join(name.split()).casefold()
+
+
+class BatchEvaluator:
+    """A micro-batcher that packs concurrent evaluation requests into single structured LLM calls.
+
+    Callers block in `evaluate` while their request waits for the batch to fill up to `batch_size` or for
+    `max_wait_s` to elapse, whichever comes first. The batch is then sent as one request with a list-of-results
+    schema and the results are handed back to each caller. Items the batch response omits or gets wrong are
+    re-evaluated individually, each in its own caller's thread.
+
+    The batch may be sent from any caller's thread or from the wait timer, so `invoke` is also given the
+    weight of each caller's run in the batch, i.e. the size of its items, to split the call's usage by.
+    """
+
+    def __init__(self, render_batch: Callable[[List[EvaluationItem]], RenderedPrompt],
+                 invoke: Callable[[RenderedPrompt, Dict[str, float]], Optional[BatchEvaluationResult]],
+                 evaluate_single: Callable[[str, List[str]], Optional[EvaluationResult]],
+                 batch_size: int = 4, max_wait_s: float = 0.05):
+        if batch_size < 2:
+            raise ValueError("batch_size must be at least 2 for batched evaluation.")
+        self.render_batch = render_batch
+        self.invoke = invoke
+        self.evaluate_single = evaluate_single
+        self.batch_size = batch_size
+        self.max_wait_s = max_wait_s
+        self._lock = threading.Lock()
+        self._pending: List[_PendingItem] = []
+        self._generation = 0
+        self._stats = {"requests": 0, "batches": 0, "batched_items": 0, "fallback_items": 0, "unbatched_items": 0}
+
+    def evaluate(self, prompt_text: str, criteria: List[str]) -> Optional[EvaluationResult]:
+        """Queues one evaluation and blocks until its batch has been processed."""
+        future: Future = Future()
+        batch = None
+        with self._lock:
+            self._stats["requests"] += 1
+            self._pending.append((prompt_text, criteria, current_run_id.get(), future))
+            if len(self._pending) >= self.batch_size:
+                batch = self._take_batch()
+            elif len(self._pending) == 1:
+                timer = threading.Timer(self.max_wait_s, self._flush_due, args=(self._generation,))
+                timer.daemon = True
+                timer.start()
+        if batch:
+            self._process(batch)
+        result = future.result()
+        return self.evaluate_single(prompt_text, criteria) if result is _FALLBACK else result
+
+    def _take_batch(self) -> List[_PendingItem]:
+        """Detaches the pending requests; must be called with the lock held."""
+        batch, self._pending = self._pending, []
+        self._generation += 1
+        return batch
+
+    def _flush_due(self, generation: int):
+        """Timer callback that sends a partially filled batch once its wait time has elapsed."""
+        with self._lock:
+            if generation != self._generation or not self._pending:
+                return
+            batch = self._take_batch()
+        self._process(batch)
+
+    def _process(self, batch: List[_PendingItem]):
+        """Sends one batch and demultiplexes the results onto the waiting callers."""
+        results: Dict[int, EvaluationResult] = {}
+        if len(batch) > 1:
+            weights: Dict[str, float] = {}
+            for text, criteria, run_id, _ in batch:
+                weights[run_id] = weights.get(run_id, 0) + len(text) + sum(len(criterion) for criterion in criteria)
+            try:
+                response = self.invoke(self.render_batch([(i, text, criteria)
+                                                          for i, (text, criteria, _, _) in enumerate(batch)]),
+                                       weights)
+            except Exception as e:
+                print(f"Batched evaluation failed: {e}")
+                response = None
+            for item in (response.results if response else []):
+                if 0 <= item.item_id < len(batch) and self._is_valid(item.evaluation, batch[item.item_id][1]):
+                    results.setdefault(item.item_id, item.evaluation)
+
+        with self._lock:
+            if len(batch) == 1:
+                # The wait expired before anyone else arrived; a single call is cheaper than a batch of one
+                self._stats["unbatched_items"] += 1
+            else:
+                self._stats["batches"] += 1
+                self._stats["batched_items"] += len(results)
+                self._stats["fallback_items"] += len(batch) - len(results)
+        if len(batch) > 1 and len(results) < len(batch):
+            print(f"Batched evaluation returned {len(results)}/{len(batch)} valid results; evaluating the rest "
+                  f"individually.")
+
+        for i, (_, _, _, future) in enumerate(batch):
+            future.set_result(results.get(i, _FALLBACK))
+
+    @staticmethod
+    def _is_valid(evaluation: EvaluationResult, criteria: List[str]) -> bool:
+        """Checks that a batched result scored exactly the requested criteria, in the requested order.
+
+        Names are compared ignoring case and whitespace, so a result that reorders or relabels the criteria is
+        re-evaluated rather than attributed to the wrong ones.
+        """
+        return [_criterion_key(score.criterion) for score in evaluation.scores] == \
+            [_criterion_key(criterion) for criterion in criteria]
+
+    def stats(self) -> Dict[str, int]:
+        """Returns request, batch, fallback and unbatched-item counters."""
+        with self._lock:
+            return dict(self._stats)
+
+
+def aggregate_evaluations(samples: List[EvaluationResult], method: str = "mean") -> Dict:
+    """Combines independent evaluations of one prompt into a single serialized evaluation.
+
+    Each criterion gets the mean or median of its sample scores, its standard deviation across samples (`sd`)
+    and the justification of the sample closest to that score. The qualitative feedback comes from the sample
+    whose average is closest to the aggregated average. The result also holds the sample count and the
+    standard deviation of the samples' average scores (`average_sd`).
+    """
+    combine = AGGREGATES[method]
+    if len(samples) == 1:
+        return samples[0].dict()
+    scores = []
+    for criterion_score in samples[0].scores:
+        drawn = [(score.score, score.justification) for sample in samples for score in sample.scores
+                 if score.criterion == criterion_score.criterion]
+        values = [value for value, _ in drawn]
+        score = round(combine(values), 3)
+        justification = min(drawn, key=lambda item: abs(item[0] - score))[1]
+        sd = round(statistics.stdev(values), 3) if len(values) > 1 else 0.0
+        scores.append({"criterion": criterion_score.criterion, "score": score, "justification": justification,
+                       "sd": sd})
+    averages = [sum(score.score for score in sample.scores) / len(sample.scores) for sample in samples]
+    average = sum(score["score"] for score in scores) / len(scores)
+    feedback = min(zip(averages, samples), key=lambda item: abs(item[0] - average))[1].qualitative_feedback
+    return {"scores": scores, "qualitative_feedback": feedback, "samples": len(samples),
+            "average_sd": round(statistics.stdev(averages), 3)}
+
+
+class SampledEvaluator:
+    """Scores prompts with several independent evaluator samples to reduce the noise of single judgements.
+
+    `samples` draws are made concurrently and aggregated per criterion. When the 95% confidence interval of
+    the average score contains one of the decision thresholds passed to `evaluate`, i.e. the sampled score
+    cannot yet tell which way the decision goes, more samples are drawn, doubling the count each time, until
+    the interval clears every threshold or `max_samples` is reached.
+    """
+
+    def __init__(self, draw: Callable[[str, List[str]], Optional[EvaluationResult]],
+                 run_concurrently: Callable[[Callable, List], List], samples: int = 3,
+                 max_samples: Optional[int] = None, aggregate: str = "mean"):
+        max_samples = samples if max_samples is None else max_samples
+        if samples < 1 or max_samples < samples:
+            raise ValueError("samples must be at least 1 and max_samples at least samples.")
+        if max_samples > samples and samples < 2:
+            raise ValueError("Escalating to more samples needs at least 2 initial samples to estimate the spread.")
+        if aggregate not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate '{aggregate}'. Expected one of {tuple(AGGREGATES)}.")
+        self.draw = draw
+        self.run_concurrently = run_concurrently
+        self.samples = samples
+        self.max_samples = max_samples
+        self.aggregate = aggregate
+        self._lock = threading.Lock()
+        self._stats = {"evaluations": 0, "samples": 0, "failed_samples": 0, "escalations": 0}
+
+    def evaluate(self, prompt_text: str, criteria: List[str], thresholds: Iterable[float] = ()) -> Optional[Dict]:
+        """Returns the aggregated evaluation of a prompt, or None if no sample could be drawn."""
+        thresholds = list(thresholds)
+        drawn, evaluation = [], None
+        requested, count = 0, self.samples
+        while count > 0:
+            results = self.run_concurrently(lambda _: self.draw(prompt_text, criteria), list(range(count)))
+            requested += count
+            drawn.extend(result for result in results if result is not None)
+            if not drawn:
+                break
+            evaluation = aggregate_evaluations(drawn, self.aggregate)
+            count = min(len(drawn), self.max_samples - requested)
+            if count <= 0 or len(drawn) < 2:
+                break
+            average = sum(score["score"] for score in evaluation["scores"]) / len(evaluation["scores"])
+            half_width = confidence_half_width(evaluation["average_sd"], len(drawn))
+            close = [threshold for threshold in thresholds if abs(average - threshold) <= half_width]
+            if not close:
+                break
+            print(f"Average score {average:.2f} ± {half_width:.2f} from {len(drawn)} samples is too close to "
+                  f"{close[0]:.2f} to decide; drawing {count} more.")
+
+        with self._lock:
+            self._stats["evaluations"] += 1
+            self._stats["samples"] += len(drawn)
+            self._stats["failed_samples"] += requested - len(drawn)
+            self._stats["escalations"] += requested > self.samples
+        return evaluation
+
+    def stats(self) -> Dict[str, float]:
+        """Returns evaluation, sample and escalation counters and the mean samples per evaluation."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["samples_per_evaluation"] = round(stats["samples"] / stats["evaluations"], 3) \
+            if stats["evaluations"] else 0.0
+        return stats
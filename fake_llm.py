@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import random
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Type, Union
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import AIMessage
+from pydantic import BaseModel
+
+from evaluation import ITEM_HEADER
+from state import (BatchEvaluationItem, BatchEvaluationResult, CriterionScore, DecomposedGoal, EvaluationResult,
+                   GeneratedPrompt, ImprovementPlan, Reflection)
+
+DEFAULT_CRITERIA = [
+    "Evoke a sense of urgency in the target audience.",
+    "Use a conversational and energetic tone.",
+    "End with a clear and compelling call-to-action.",
+]
+
+# Mean score given to a prompt at each revision; the last value repeats for later revisions
+DEFAULT_SCORE_TRAJECTORY = [5.0, 6.0, 7.0, 7.5, 8.0, 8.5, 9.0]
+
+# Granularity, in characters, at which the simulated provider caches prompt prefixes
+PREFIX_CACHE_BLOCK = 1024
+
+_REVISION_MARKER = re.compile(r"\[revision (\d+)\]")
+_ITEM_HEADER = re.compile(re.escape(ITEM_HEADER).replace(r"\{item_id\}", r"(\d+)"))
+
+
+class FakeChatModel:
+    """A deterministic, offline stand-in for the chat model.
+
+    It returns schema-valid objects for every structured output the agent requests. Generated prompts carry a
+    `[revision N]` marker, and the evaluator scores a prompt around `score_trajectory[N]`, so convergence
+    follows the configured trajectory regardless of scheduling. The same prompt always gets the same response,
+    unless `resample` is set: then repeated calls with the same prompt draw fresh responses, like a real model
+    sampled at a non-zero temperature, while the n-th repeat stays reproducible. Each call sleeps for a
+    simulated latency. Reported usage mimics implicit prefix caching: input tokens of a prefix seen before,
+    in blocks of `PREFIX_CACHE_BLOCK` characters, are reported as cache reads. A share `malformed_rate` of
+    responses comes back as text the structured-output parser rejects: wrapped in prose and a code fence,
+    written as a Python literal with a trailing comma, or truncated.
+    """
+
+    def __init__(self, model: str = "fake", temperature: float = 1.0,
+                 latency_s: Union[float, Dict[str, float]] = 0.0,
+                 score_trajectory: Sequence[float] = DEFAULT_SCORE_TRAJECTORY, score_noise: float = 1.0,
+                 criteria: Optional[List[str]] = None, seed: int = 0, cached_content: Optional[str] = None,
+                 max_cached_prefixes: int = 100_000, resample: bool = False, malformed_rate: float = 0.0):
+        self.model = model
+        self.temperature = temperature
+        self.latency_s = latency_s
+        self.score_trajectory = list(score_trajectory)
+        self.score_noise = score_noise
+        self.criteria = list(criteria or DEFAULT_CRITERIA)
+        self.seed = seed
+        self.cached_content = cached_content
+        self.max_cached_prefixes = max_cached_prefixes
+        self.resample = resample
+        self.malformed_rate = malformed_rate
+        self._prefixes: set = set()
+        self._prefix_lock = threading.Lock()
+        self._draws: Dict[bytes, int] = {}
+        self._draws_lock = threading.Lock()
+
+    def with_structured_output(self, schema: Type[BaseModel], include_raw: bool = False, **kwargs):
+        """Mirrors LangChain's structured-output binding."""
+        return _FakeStructuredRunnable(self, schema, include_raw)
+
+    def _latency(self, schema: Type[BaseModel]) -> float:
+        """Returns the simulated latency for a schema, falling back to the "default" entry."""
+        if isinstance(self.latency_s, dict):
+            return self.latency_s.get(schema.__name__, self.latency_s.get("default", 0.0))
+        return self.latency_s
+
+    def _rng(self, schema: Type[BaseModel], prompt: str) -> random.Random:
+        """Returns a random generator seeded by the call's content, so responses are reproducible."""
+        digest = hashlib.sha256(f"{self.seed}|{schema.__name__}|{prompt}".encode("utf-8")).digest()
+        if self.resample:
+            with self._draws_lock:
+                draw = self._draws.get(digest, 0)
+                if len(self._draws) >= self.max_cached_prefixes:
+                    self._draws.clear()
+                self._draws[digest] = draw + 1
+            digest = hashlib.sha256(digest + draw.to_bytes(8, "big")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def _score(self, revision: int, rng: random.Random) -> int:
+        """Draws an integer score around the trajectory's mean for `revision`."""
+        mean = self.score_trajectory[min(revision, len(self.score_trajectory) - 1)]
+        return max(1, min(10, round(mean + rng.uniform(-self.score_noise, self.score_noise))))
+
+    def respond(self, schema: Type[BaseModel], prompt: str) -> BaseModel:
+        """Builds the deterministic response for a prompt."""
+        rng = self._rng(schema, prompt)
+        if schema is DecomposedGoal:
+            return DecomposedGoal(criteria=list(self.criteria))
+        if schema is ImprovementPlan:
+            return ImprovementPlan(plan="1. Establish the persona.\n2. Add urgency.\n3. End with a call to action.")
+        if schema is GeneratedPrompt:
+            revisions = [int(n) for n in _REVISION_MARKER.findall(prompt)]
+            revision = max(revisions, default=0) + 1
+            return GeneratedPrompt(
+                prompt_text=f"Write an energetic tweet with a call to action, variant {rng.randrange(10 ** 6)} "
+                            f"[revision {revision}]",
+                reasoning=f"Simulated change number {revision}.",
+            )
+        if schema is EvaluationResult:
+            return self._evaluate(prompt, rng)
+        if schema is BatchEvaluationResult:
+            # Split the request at each item header and score every item as if it had been sent on its own
+            parts = _ITEM_HEADER.split(prompt)
+            return BatchEvaluationResult(results=[
+                BatchEvaluationItem(item_id=int(item_id), evaluation=self._evaluate(text, self._rng(schema, text)))
+                for item_id, text in zip(parts[1::2], parts[2::2])
+            ])
+        if schema is Reflection:
+            return Reflection(summary="Simulated reflection: strengthen the weakest criterion next.")
+        raise ValueError(f"FakeChatModel cannot produce {schema.__name__}.")
+
+    def _evaluate(self, prompt: str, rng: random.Random) -> EvaluationResult:
+        """Scores the prompt carrying the highest revision marker in `prompt`."""
+        revisions = [int(n) for n in _REVISION_MARKER.findall(prompt)]
+        revision = max(revisions, default=0)
+        return EvaluationResult(
+            scores=[CriterionScore(criterion=c, score=self._score(revision, rng), justification="Simulated.")
+                    for c in self.criteria],
+            qualitative_feedback=f"Simulated feedback for revision {revision}.",
+        )
+
+    def malformed_text(self, prompt: str, response: BaseModel) -> Optional[str]:
+        """Returns a malformed rendering of `response` for a `malformed_rate` share of prompts, else None."""
+        rng = self._rng(response.__class__, f"malformed|{prompt}")
+        if rng.random() >= self.malformed_rate:
+            return None
+        text = response.model_dump_json()
+        variant = rng.randrange(3)
+        if variant == 0:
+            return f"Here is the result:\n```json\n{text}\n```\nLet me know if you need anything else."
+        if variant == 1:
+            return f"{response.model_dump()!r}"[:-1] + ",}"
+        return text[:len(text) // 2]
+
+    def _cached_prefix_chars(self, prompt: str) -> int:
+        """Returns how many leading characters of `prompt` a prefix cache would hold, then caches its prefixes."""
+        digest = hashlib.blake2b(digest_size=16)
+        prefixes = []
+        for start in range(0, len(prompt) - PREFIX_CACHE_BLOCK + 1, PREFIX_CACHE_BLOCK):
+            digest.update(prompt[start:start + PREFIX_CACHE_BLOCK].encode("utf-8"))
+            prefixes.append(digest.copy().digest())
+        with self._prefix_lock:
+            cached_blocks = 0
+            while cached_blocks < len(prefixes) and prefixes[cached_blocks] in self._prefixes:
+                cached_blocks += 1
+            if len(self._prefixes) + len(prefixes) > self.max_cached_prefixes:
+                self._prefixes.clear()
+            self._prefixes.update(prefixes)
+        return cached_blocks * PREFIX_CACHE_BLOCK
+
+    def usage(self, prompt: str, response: BaseModel) -> Dict:
+        """Estimates token usage the way a provider would report it."""
+        input_tokens = len(prompt) // 4
+        cached_tokens = self._cached_prefix_chars(prompt) // 4
+        output_tokens = len(response.model_dump_json()) // 4
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens, "input_token_details": {"cache_read": cached_tokens}}
+
+
+class _FakeStructuredRunnable:
+    """The object returned by `FakeChatModel.with_structured_output`."""
+
+    def __init__(self, model: FakeChatModel, schema: Type[BaseModel], include_raw: bool):
+        self.model = model
+        self.schema = schema
+        self.include_raw = include_raw
+
+    def _wrap(self, prompt: str, parsed: BaseModel):
+        """Shapes the response like LangChain does, including the raw message when requested."""
+        malformed = self.model.malformed_text(prompt, parsed) if self.model.malformed_rate else None
+        if malformed is not None:
+            try:
+                parsed = self.schema.model_validate_json(malformed)
+            except ValueError as e:
+                if not self.include_raw:
+                    raise OutputParserException(str(e)) from e
+                raw = AIMessage(content=malformed, usage_metadata=self.model.usage(prompt, parsed))
+                return {"raw": raw, "parsed": None, "parsing_error": OutputParserException(str(e))}
+        if not self.include_raw:
+            return parsed
+        raw = AIMessage(content=malformed or parsed.model_dump_json(), usage_metadata=self.model.usage(prompt, parsed))
+        return {"raw": raw, "parsed": parsed, "parsing_error": None}
+
+    def invoke(self, prompt: str, *args, **kwargs):
+        time.sleep(self.model._latency(self.schema))
+        return self._wrap(prompt, self.model.respond(self.schema, prompt))
+
+    async def ainvoke(self, prompt: str, *args, **kwargs):
+        await asyncio.sleep(self.model._latency(self.schema))
+        return self._wrap(prompt, self.model.respond(self.schema, prompt))
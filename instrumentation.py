@@ -0,0 +1,243 @@
+import contextvars
+import json
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterator, Optional
+
+# The run whose node is currently executing, so LLM calls can be attributed without threading ids through
+current_run_id: contextvars.ContextVar[str] = contextvars.ContextVar("current_run_id", default="")
+# Shares of the runs on whose behalf the current LLM call is made together, e.g. a batched evaluation
+current_run_shares: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "current_run_shares", default=None)
+
+
+@dataclass
+class CallRecord:
+    """A single timed unit of work: either a graph node or one structured LLM call."""
+    kind: str
+    node: str
+    run_id: str = ""
+    schema: str = ""
+    model: str = ""
+    started_at: float = 0.0
+    wall_time_s: float = 0.0
+    wait_time_s: float = 0.0
+    input_tokens: int = 0
+    cached_input_tokens: int = 0
+    static_prefix_tokens: int = 0
+    output_tokens: int = 0
+    retries: int = 0
+    cost_usd: float = 0.0
+    success: bool = True
+    error: str = ""
+    run_shares: Dict[str, float] = field(default_factory=dict)
+
+
+def _new_aggregate() -> Dict:
+    """Returns an empty set of summed counters."""
+    return {"calls": 0, "failures": 0, "wall_time_s": 0.0, "wait_time_s": 0.0, "input_tokens": 0,
+            "cached_input_tokens": 0, "static_prefix_tokens": 0, "output_tokens": 0, "retries": 0, "cost_usd": 0.0}
+
+
+def _add(aggregate: Dict, record: CallRecord, weight: float = 1.0):
+    """Adds a record's counters to an aggregate, scaled by `weight` when the record is shared between runs."""
+    aggregate["calls"] += weight
+    aggregate["failures"] += 0 if record.success else weight
+    aggregate["wall_time_s"] += record.wall_time_s * weight
+    aggregate["wait_time_s"] += record.wait_time_s * weight
+    aggregate["input_tokens"] += record.input_tokens * weight
+    aggregate["cached_input_tokens"] += record.cached_input_tokens * weight
+    aggregate["static_prefix_tokens"] += record.static_prefix_tokens * weight
+    aggregate["output_tokens"] += record.output_tokens * weight
+    aggregate["retries"] += record.retries * weight
+    aggregate["cost_usd"] += record.cost_usd * weight
+
+
+class Instrumentation:
+    """Collects per-call timings, token counts and outcomes for graph nodes and LLM calls.
+
+    Aggregates are kept per node for the lifetime of the process and per (run, node) for the most recent
+    `max_runs` runs, while raw records are kept in a bounded buffer for the JSON trace. Both a JSON trace and a
+    Prometheus text dump can be exported.
+    """
+
+    def __init__(self, max_records: int = 100_000, max_runs: int = 10_000):
+        self._lock = threading.Lock()
+        self._records: deque = deque(maxlen=max_records)
+        self._max_runs = max_runs
+        self._by_node: Dict[str, Dict[str, Dict]] = {"node": defaultdict(_new_aggregate),
+                                                      "llm": defaultdict(_new_aggregate)}
+        self._by_run: "OrderedDict[str, Dict[str, Dict]]" = OrderedDict()
+        self._by_model: Dict[tuple, Dict] = defaultdict(_new_aggregate)
+        self._queue_wait: Dict[str, float] = {}
+
+    def record(self, record: CallRecord):
+        """Adds a finished record to the trace and the aggregates.
+
+        A record made on behalf of several runs counts towards each of them in proportion to its share.
+        """
+        with self._lock:
+            self._records.append(record)
+            _add(self._by_node[record.kind][record.node], record)
+            if record.kind == "llm":
+                _add(self._by_model[(record.node, record.model)], record)
+            shares = record.run_shares or ({record.run_id: 1.0} if record.run_id else {})
+            for run_id, share in shares.items():
+                if run_id not in self._by_run:
+                    self._by_run[run_id] = defaultdict(_new_aggregate)
+                    while len(self._by_run) > self._max_runs:
+                        self._by_run.popitem(last=False)
+                _add(self._by_run[run_id][f"{record.kind}:{record.node}"], record, share)
+
+    @contextmanager
+    def _timed(self, record: CallRecord) -> Iterator[CallRecord]:
+        """Measures the wall time of the enclosed block, marking the record failed if it raises."""
+        record.started_at = time.time()
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record.success = False
+            record.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record.wall_time_s = time.perf_counter() - start
+            self.record(record)
+
+    @contextmanager
+    def node(self, name: str, run_id: str = "") -> Iterator[CallRecord]:
+        """Times a graph node and makes `run_id` the current run for LLM calls made inside it."""
+        token = current_run_id.set(run_id)
+        try:
+            with self._timed(CallRecord(kind="node", node=name, run_id=run_id)) as record:
+                yield record
+        finally:
+            current_run_id.reset(token)
+
+    @contextmanager
+    def shared(self, weights: Dict[str, float]) -> Iterator[None]:
+        """Attributes the LLM calls made inside the block to several runs at once, split by `weights`.
+
+        E.g. a batched evaluation, which may be sent from whichever thread filled or flushed the batch.
+        """
+        total = sum(weights.values())
+        shares = {run_id: weight / total for run_id, weight in weights.items() if run_id and weight > 0} \
+            if total > 0 else {}
+        run_token, shares_token = current_run_id.set(""), current_run_shares.set(shares)
+        try:
+            yield
+        finally:
+            current_run_shares.reset(shares_token)
+            current_run_id.reset(run_token)
+
+    @contextmanager
+    def llm_call(self, node: str, schema: str, model: str) -> Iterator[CallRecord]:
+        """Times one structured LLM call; the caller fills in tokens, cost, wait time, retries and success."""
+        with self._timed(CallRecord(kind="llm", node=node or "unknown", run_id=current_run_id.get(),
+                                    schema=schema, model=model,
+                                    run_shares=dict(current_run_shares.get() or {}))) as record:
+            yield record
+
+    def record_queue_wait(self, run_id: str, seconds: float):
+        """Records how long a run waited for a concurrency slot before it started."""
+        with self._lock:
+            self._queue_wait[run_id] = seconds
+            while len(self._queue_wait) > self._max_runs:
+                self._queue_wait.pop(next(iter(self._queue_wait)))
+
+    def run_totals(self, run_id: str) -> Dict:
+        """Returns the LLM calls, tokens and node wall time recorded for a run in this process."""
+        totals = {"llm_calls": 0, "tokens": 0, "elapsed_s": 0.0}
+        with self._lock:
+            for name, aggregate in self._by_run.get(run_id, {}).items():
+                if name.startswith("llm:"):
+                    totals["llm_calls"] += aggregate["calls"]
+                    totals["tokens"] += aggregate["input_tokens"] + aggregate["output_tokens"]
+                else:
+                    totals["elapsed_s"] += aggregate["wall_time_s"]
+        # Shared calls contribute fractions; keep the totals readable
+        totals["llm_calls"] = round(totals["llm_calls"], 3)
+        totals["tokens"] = round(totals["tokens"])
+        return totals
+
+    def summary(self) -> Dict:
+        """Returns aggregates per node, per node and model, and per run."""
+        with self._lock:
+            return {
+                "nodes": {name: dict(agg) for name, agg in self._by_node["node"].items()},
+                "llm_calls": {name: dict(agg) for name, agg in self._by_node["llm"].items()},
+                "models": {f"{node}|{model}": dict(agg) for (node, model), agg in self._by_model.items()},
+                "runs": {run_id: {"queue_wait_s": self._queue_wait.get(run_id, 0.0),
+                                  **{name: dict(agg) for name, agg in nodes.items()}}
+                         for run_id, nodes in self._by_run.items()},
+            }
+
+    def export_json(self, path: str):
+        """Writes the raw records and the aggregates to a JSON trace file."""
+        with self._lock:
+            records = [asdict(record) for record in self._records]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"records": records, "summary": self.summary()}, f, indent=2)
+
+    def to_prometheus(self) -> str:
+        """Renders the per-node aggregates in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                rendered = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"{name}{{{rendered}}} {value}")
+
+        nodes, llm = summary["nodes"], summary["llm_calls"]
+        metric("p3ro_node_seconds_sum", "counter", "Total wall time spent in each graph node.",
+               [({"node": n}, round(a["wall_time_s"], 6)) for n, a in nodes.items()])
+        metric("p3ro_node_executions_total", "counter", "Graph node executions.",
+               [({"node": n}, a["calls"]) for n, a in nodes.items()])
+        metric("p3ro_node_failures_total", "counter", "Graph node executions that raised.",
+               [({"node": n}, a["failures"]) for n, a in nodes.items()])
+        metric("p3ro_llm_seconds_sum", "counter", "Total wall time of LLM calls, including waits and retries.",
+               [({"node": n}, round(a["wall_time_s"], 6)) for n, a in llm.items()])
+        metric("p3ro_llm_wait_seconds_sum", "counter", "Total time LLM calls spent waiting before being sent.",
+               [({"node": n}, round(a["wait_time_s"], 6)) for n, a in llm.items()])
+        metric("p3ro_llm_calls_total", "counter", "Structured LLM calls.",
+               [({"node": n}, a["calls"]) for n, a in llm.items()])
+        metric("p3ro_llm_failures_total", "counter", "Structured LLM calls that produced no result.",
+               [({"node": n}, a["failures"]) for n, a in llm.items()])
+        metric("p3ro_llm_retries_total", "counter", "Retries of structured LLM calls.",
+               [({"node": n}, a["retries"]) for n, a in llm.items()])
+        metric("p3ro_llm_tokens_total", "counter", "Tokens consumed by structured LLM calls.",
+               [({"node": n, "direction": direction}, a[f"{direction}_tokens"])
+                for n, a in llm.items() for direction in ("input", "output")])
+        metric("p3ro_llm_cached_input_tokens_total", "counter",
+               "Input tokens served from provider prefix/context caches.",
+               [({"node": n}, a["cached_input_tokens"]) for n, a in llm.items()])
+        metric("p3ro_llm_static_prefix_tokens_total", "counter",
+               "Estimated input tokens in static template prefixes, i.e. the cacheable share of the input.",
+               [({"node": n}, a["static_prefix_tokens"]) for n, a in llm.items()])
+        metric("p3ro_llm_cost_usd_total", "counter", "Estimated cost of structured LLM calls per node and model.",
+               [({"node": key.split("|", 1)[0], "model": key.split("|", 1)[1]}, round(a["cost_usd"], 6))
+                for key, a in summary["models"].items()])
+        metric("p3ro_llm_model_seconds_sum", "counter", "Total wall time of LLM calls per node and model.",
+               [({"node": key.split("|", 1)[0], "model": key.split("|", 1)[1]}, round(a["wall_time_s"], 6))
+                for key, a in summary["models"].items()])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Dumps the Prometheus text format to a file, e.g. for the node exporter's textfile collector."""
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+
+
+def usage_tokens(raw_message) -> Dict[str, int]:
+    """Extracts input, cached input and output token counts from a LangChain message's usage metadata, if present."""
+    usage = getattr(raw_message, "usage_metadata", None) or {}
+    details = usage.get("input_token_details") or {}
+    return {"input_tokens": usage.get("input_tokens", 0) or 0,
+            "cached_input_tokens": details.get("cache_read", 0) or 0,
+            "output_tokens": usage.get("output_tokens", 0) or 0}
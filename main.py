@@ -1,108 +1,137 @@
-import os
-
-from dotenv import load_dotenv
-
-from agents import P3RO_Graph
-
-# --- Configuration ---
-load_dotenv()
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+import argparse
+import contextlib
+import sys
+import uuid
 
 if __name__ == "__main__":
-    print("--- Initializing P³RO Agent ---")
+    parser = argparse.ArgumentParser(description="Refine a prompt with the P³RO agent.")
+    parser.add_argument("--resume", metavar="RUN_ID", help="Continue a journaled run from its last completed node.")
+    parser.add_argument("--checkpoint-db", default="p3ro_runs.db", help="SQLite file that journals every run.")
+    parser.add_argument("--memory-db", help="Remember finished runs in this SQLite file and seed new runs from "
+                                            "the most similar past successes.")
+    parser.add_argument("--stream", nargs="?", const="-", metavar="PATH",
+                        help="Emit run events as JSONL to PATH, or to stdout (agent logs then go to stderr).")
+    parser.add_argument("--stop-at-score", type=float,
+                        help="With --stream, stop as soon as a prompt reaches this average score.")
+    parser.add_argument("--trace", help="Write a JSON trace of per-node and per-call metrics to this file.")
+    parser.add_argument("--metrics", help="Write a Prometheus text dump of the aggregated metrics to this file.")
+    args = parser.parse_args()
 
-    # Example User Input
-    initial_prompt_example = "Write a tweet about our new productivity app, 'SyncFlow'."
-    goal_example = "Make the prompt generate tweets that are more exciting, create a sense of FOMO (fear of missing out), and include a clear call to action."
+    # With events streamed to stdout, everything else goes to stderr so that stdout stays pure JSONL
+    events_stdout = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr if args.stream == "-" else sys.stdout):
+        # Imported only now, so that --help and argument errors do not wait for LangGraph to load
+        from dotenv import load_dotenv
 
-    # Initial state
-    initial_state = {
-        "initial_prompt": initial_prompt_example,
-        "goal": goal_example,
-        "decomposed_criteria": [],
-        "high_level_plan": "",
-        "prompt_history": [],
-        "current_reflection": "This is the first iteration, so the goal is to establish a baseline improvement based on the initial plan.",
-        "final_prompt": "",
-        "iteration_count": 0,
-    }
+        from agents import P3RO_Graph
+        from checkpoint import RunJournal
+        from memory import StrategyMemory
+        from streaming import JsonlSink, RunStream
+        from state import create_initial_state, find_best_prompt
 
-    # Build and compile the graph
-    p3ro_graph_builder = P3RO_Graph()
-    app = p3ro_graph_builder.compile_graph()
+        # --- Configuration ---
+        load_dotenv()
 
-    print("\n--- Starting Agent Execution ---")
+        print("--- Initializing P³RO Agent ---")
 
-    try:
-        # Run the agent and get the complete final state
-        final_state = app.invoke(initial_state)
+        # Example User Input
+        initial_prompt_example = "Write a tweet about our new productivity app, 'SyncFlow'."
+        goal_example = "Make the prompt generate tweets that are more exciting, create a sense of FOMO (fear of missing out), and include a clear call to action."
 
-        print("\n\n--- Agent Execution Finished ---")
+        # Build and compile the graph
+        journal = RunJournal(args.checkpoint_db)
+        memory = StrategyMemory(args.memory_db) if args.memory_db else None
+        p3ro_graph_builder = P3RO_Graph(journal=journal, strategy_memory=memory)
+        app = p3ro_graph_builder.compile_graph()
 
-        # Find the best prompt from the history with robust error handling
-        best_prompt = ""
-        best_score = -1
-    
-        print(f"\n--- Debugging Final State ---")
-        if final_state:
-            print(f"Final state keys: {list(final_state.keys())}")
-            if "prompt_history" in final_state:
-                print(f"Found {len(final_state['prompt_history'])} prompts in history")
-            else:
-                print("No 'prompt_history' key in final_state")
+        # Initial state, either fresh or rebuilt from the journal
+        already_finished = False
+        if args.resume:
+            run_id = args.resume
+            initial_state = p3ro_graph_builder.resume_state(run_id)
+            if initial_state is None:
+                print("Run had already finished; nothing to resume.")
+                already_finished = True
+                initial_state, _ = journal.load(run_id)
         else:
-            print("final_state is None")
-    
-        if final_state and final_state.get("prompt_history"):
-            for i, attempt in enumerate(final_state["prompt_history"]):
-                print(f"\nAttempt {i} keys: {list(attempt.keys())}")
-                if "evaluation" in attempt and attempt["evaluation"] and "scores" in attempt["evaluation"]:
+            run_id = uuid.uuid4().hex
+            initial_state = create_initial_state(initial_prompt_example, goal_example, run_id=run_id)
+
+        print(f"\n--- Starting Agent Execution (run id: {run_id}) ---")
+
+        try:
+            # Run the agent and get the complete final state
+            status = "finished"
+            try:
+                if already_finished:
+                    final_state = initial_state
+                elif args.stream:
+                    events_file = events_stdout if args.stream == "-" else open(args.stream, "a", encoding="utf-8")
+                    stop_when = None
+                    if args.stop_at_score is not None:
+                        stop_when = lambda best: best.average_score >= args.stop_at_score
+                    run_stream = RunStream(p3ro_graph_builder, on_event=JsonlSink(events_file), stop_when=stop_when)
                     try:
-                        scores = attempt["evaluation"]["scores"]
-                        print(f"  Found {len(scores)} evaluation scores")
-                        current_score = sum(s["score"] for s in scores if isinstance(s, dict) and "score" in s)
-                        print(f"  Total score: {current_score}")
-                        if current_score > best_score:
-                            best_score = current_score
-                            best_prompt = attempt["prompt_text"]
-                            print(f"  New best prompt found with score {current_score}")
-                    except Exception as e:
-                        print(f"  Error calculating score for attempt {i}: {e}")
+                        for _ in run_stream.events(initial_state):
+                            pass
+                    finally:
+                        if events_file is not events_stdout:
+                            events_file.close()
+                    final_state, status = run_stream.state, run_stream.status
                 else:
-                    print(f"  No evaluation data for attempt {i}")
-    
-        # Fallback: if no evaluated prompts, use the last generated one
-        if not best_prompt and final_state and final_state.get("prompt_history"):
-            print("\nNo evaluated prompts found, using last generated prompt as fallback")
-            last_attempt = final_state["prompt_history"][-1]
-            if "prompt_text" in last_attempt:
-                best_prompt = last_attempt["prompt_text"]
-                print("Using last generated prompt")
-        
-        if not best_prompt:
-            print("No prompts found in history")
+                    final_state = app.invoke(initial_state)
+            except BaseException:
+                journal.finish_run(run_id, status="failed")
+                print(f"\nRun failed; continue it with: python main.py --resume {run_id}")
+                raise
+            journal.finish_run(run_id, status=status)
+            if status == "cancelled":
+                print(f"\nRun stopped early; continue it with: python main.py --resume {run_id}")
+            if memory is not None and not already_finished and status == "finished":
+                memory.record(run_id, final_state)
 
-        print("\n\n=====================================")
-        print("          FINAL RESULTS")
-        print("=====================================")
-        print("\n### Initial Prompt:")
-        print(initial_state["initial_prompt"])
-        print("\n### User Goal:")
-        print(initial_state["goal"])
-        print("\n### Best Refined Prompt:")
-        if best_prompt:
-            print(best_prompt)
-        else:
-            print("No improved prompt was finalized.")
-        print("\n=====================================")
-    finally:
-        # Explicit cleanup to prevent threading exception during shutdown
-        try:
-            # Close the underlying HTTP client if accessible
-            if hasattr(p3ro_graph_builder.tools.model, '_client'):
-                p3ro_graph_builder.tools.model._client.close()
-            elif hasattr(p3ro_graph_builder.tools.model, 'client'):
-                p3ro_graph_builder.tools.model.client.close()
-        except Exception:
-            # Ignore cleanup errors - they're not critical
-            pass
+            print("\n\n--- Agent Execution Finished ---")
+
+            print(f"\n--- Debugging Final State ---")
+            if final_state:
+                print(f"Final state keys: {list(final_state.keys())}")
+                if "prompt_history" in final_state:
+                    print(f"Found {len(final_state['prompt_history'])} prompts in history")
+                else:
+                    print("No 'prompt_history' key in final_state")
+            else:
+                print("final_state is None")
+
+            # Find the best prompt from the history, falling back to the last generated one
+            best_prompt, best_score = find_best_prompt(final_state.get("prompt_history") if final_state else [],
+                                                       final_state.get("candidates") if final_state else None)
+            if best_prompt and best_score < 0:
+                print("\nNo evaluated prompts found, using last generated prompt as fallback")
+            elif best_prompt:
+                print(f"\nBest prompt found with total score {best_score}")
+            else:
+                print("No prompts found in history")
+
+            print("\n\n=====================================")
+            print("          FINAL RESULTS")
+            print("=====================================")
+            print("\n### Initial Prompt:")
+            print(initial_state["initial_prompt"])
+            print("\n### User Goal:")
+            print(initial_state["goal"])
+            print("\n### Best Refined Prompt:")
+            if best_prompt:
+                print(best_prompt)
+            else:
+                print("No improved prompt was finalized.")
+            print("\n=====================================")
+        finally:
+            # Explicit cleanup to prevent threading exception during shutdown
+            p3ro_graph_builder.tools.close()
+            journal.close()
+            if memory is not None:
+                memory.close()
+            if args.trace:
+                p3ro_graph_builder.instrumentation.export_json(args.trace)
+            if args.metrics:
+                p3ro_graph_builder.instrumentation.write_prometheus(args.metrics)
@@ -0,0 +1,118 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from state import AgentState, PromptHistory
+
+_WORD = re.compile(r"\w+")
+
+# Words too common in goals to say anything about their similarity
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in into is it its make more most my of on or our should so that "
+    "the their them this to us was we were which will with would you your prompt prompts".split()
+)
+
+
+def score_trajectory(prompt_history: Optional[PromptHistory]) -> List[float]:
+    """Returns the best average score of each iteration, in order."""
+    if not prompt_history:
+        return []
+    return [round(attempt.average_score, 3) for attempt in prompt_history.round_bests()]
+
+
+class StrategyMemory:
+    """A persistent store of finished runs with a local full-text index for finding similar past goals.
+
+    Runs are stored in SQLite and indexed with FTS5 for BM25 ranking. A goal is matched on all of its words;
+    BM25's inverse document frequency already down-weights common ones. To bound the cost on large stores,
+    only the `max_candidates` best-ranked matches are considered. Only runs that reached `min_score` are
+    returned as examples, so new runs are seeded with what worked.
+    """
+
+    def __init__(self, db_path: str = "p3ro_memory.db", top_k: int = 3, min_score: float = 7.0,
+                 max_candidates: int = 2000):
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_candidates = max_candidates
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "id INTEGER PRIMARY KEY, run_id TEXT UNIQUE NOT NULL, goal TEXT NOT NULL, initial_prompt TEXT NOT NULL, "
+            "criteria TEXT NOT NULL, plan TEXT NOT NULL, reflection TEXT NOT NULL, trajectory TEXT NOT NULL, "
+            "best_score REAL NOT NULL, iterations INTEGER NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS runs_fts USING fts5(goal, criteria, content='runs', content_rowid='id')"
+        )
+        self._conn.commit()
+        self._stats = {"records": 0, "queries": 0, "hits": 0, "query_s": 0.0}
+
+    def record(self, run_id: str, state: AgentState):
+        """Stores a finished run; runs that were never evaluated are skipped."""
+        trajectory = score_trajectory(state.get("prompt_history"))
+        if not trajectory:
+            return
+        criteria = state.get("decomposed_criteria") or []
+        row = (run_id, state["goal"], state["initial_prompt"], json.dumps(criteria),
+               state.get("high_level_plan", ""), state.get("current_reflection", ""), json.dumps(trajectory),
+               max(trajectory), state.get("iteration_count", 0), time.time())
+        with self._lock:
+            with self._conn:
+                existing = self._conn.execute("SELECT id, goal, criteria FROM runs WHERE run_id = ?",
+                                              (run_id,)).fetchone()
+                if existing is not None:
+                    # External-content FTS tables are updated by deleting the old row's terms explicitly
+                    self._conn.execute("INSERT INTO runs_fts (runs_fts, rowid, goal, criteria) "
+                                       "VALUES ('delete', ?, ?, ?)", existing)
+                    self._conn.execute("DELETE FROM runs WHERE id = ?", (existing[0],))
+                cursor = self._conn.execute(
+                    "INSERT INTO runs (run_id, goal, initial_prompt, criteria, plan, reflection, trajectory, "
+                    "best_score, iterations, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+                self._conn.execute("INSERT INTO runs_fts (rowid, goal, criteria) VALUES (?, ?, ?)",
+                                   (cursor.lastrowid, row[1], row[3]))
+            self._stats["records"] += 1
+
+    @staticmethod
+    def _terms(text: str) -> List[str]:
+        """Returns the distinct indexable words of a text, in order of first occurrence."""
+        return list(dict.fromkeys(word for word in _WORD.findall(text.lower())
+                                  if word not in _STOPWORDS and len(word) > 1))
+
+    def _match_query(self, text: str) -> str:
+        """Builds an FTS5 query matching any of the text's words."""
+        return " OR ".join(f'"{term}"' for term in self._terms(text))
+
+    def similar(self, goal: str, exclude_run_id: str = "", k: Optional[int] = None) -> List[Dict]:
+        """Returns the most similar successful past runs, best match first."""
+        start = time.perf_counter()
+        with self._lock:
+            query = self._match_query(goal)
+            rows = self._conn.execute(
+                "SELECT r.run_id, r.goal, r.criteria, r.plan, r.reflection, r.trajectory, r.best_score, r.iterations "
+                "FROM (SELECT rowid, rank FROM runs_fts WHERE runs_fts MATCH ? ORDER BY rank LIMIT ?) m "
+                "JOIN runs r ON r.id = m.rowid WHERE r.best_score >= ? AND r.run_id != ? ORDER BY m.rank LIMIT ?",
+                (query, self.max_candidates, self.min_score, exclude_run_id, k or self.top_k),
+            ).fetchall() if query else []
+            self._stats["queries"] += 1
+            self._stats["hits"] += 1 if rows else 0
+            self._stats["query_s"] += time.perf_counter() - start
+        return [{"run_id": row[0], "goal": row[1], "criteria": json.loads(row[2]), "plan": row[3],
+                 "reflection": row[4], "trajectory": json.loads(row[5]), "best_score": row[6],
+                 "iterations": row[7]} for row in rows]
+
+    def stats(self) -> Dict:
+        """Returns record and query counters plus the mean query latency."""
+        with self._lock:
+            stats = dict(self._stats)
+        query_s = stats.pop("query_s")
+        stats["mean_query_ms"] = round(query_s / stats["queries"] * 1000, 3) if stats["queries"] else 0.0
+        return stats
+
+    def close(self):
+        """Closes the underlying database connection."""
+        self._conn.close()
@@ -0,0 +1,377 @@
+import copy
+import hashlib
+import math
+from typing import Dict, List, Optional, Tuple
+
+from dedup import normalize_prompt
+from state import AgentState, Attempt, PromptHistory
+
+ROUTES = ("CONTINUE_PROBING", "REVISE_STRATEGY", "FINISH")
+
+
+class RunStatistics:
+    """Score and usage statistics of one run, updated incrementally as rounds are evaluated.
+
+    Each round contributes its best average score and that attempt's criterion scores. The statistics keep an
+    exponential moving average of the round score and of its round-to-round change, the same per criterion,
+    how many rounds have passed since the best score last improved, and the pooled variance of repeated
+    independent evaluations of the same prompt, which estimates how noisy a single evaluation is. Attempts
+    scored with several evaluator samples contribute the variance between their samples instead. Usage
+    snapshots give the mean tokens and seconds spent per round. The statistics round-trip through
+    `state_dict`, so they travel with the run's state and its journal.
+    """
+
+    # Attributes saved by `state_dict`
+    _FIELDS = ("rounds", "best", "last_round_best", "previous_round_best", "smoothed_score", "smoothed_gain",
+               "criterion_scores", "criterion_trends", "improved_at_round", "revised_at_round", "samples",
+               "tokens_per_round", "seconds_per_round", "_consumed", "_last_usage", "_repeats", "_pooled_m2",
+               "_pooled_dof")
+
+    def __init__(self, alpha: float = 0.5):
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        """Forgets everything observed so far."""
+        self.rounds = 0
+        self.best = 0.0
+        self.last_round_best: Optional[float] = None
+        self.previous_round_best: Optional[float] = None
+        self.smoothed_score: Optional[float] = None
+        self.smoothed_gain: Optional[float] = None
+        self.criterion_scores: Dict[str, float] = {}
+        self.criterion_trends: Dict[str, float] = {}
+        self.improved_at_round = 0
+        self.revised_at_round: Optional[int] = None
+        self.samples = 1
+        self.tokens_per_round: Optional[float] = None
+        self.seconds_per_round: Optional[float] = None
+        self._consumed = 0
+        self._last_usage: Dict = {}
+        self._repeats: Dict[str, Tuple[int, float, float]] = {}
+        self._pooled_m2 = 0.0
+        self._pooled_dof = 0
+
+    def state_dict(self) -> Dict:
+        """Returns the statistics as a JSON-serializable dict, to be kept in the run's state."""
+        data = {name: copy.copy(getattr(self, name)) for name in self._FIELDS}
+        data["_repeats"] = {key: list(value) for key, value in self._repeats.items()}
+        return data
+
+    @classmethod
+    def from_state_dict(cls, data: Optional[Dict], alpha: float = 0.5) -> "RunStatistics":
+        """Rebuilds statistics saved by `state_dict`; empty or missing data gives fresh statistics."""
+        stats = cls(alpha)
+        for name in cls._FIELDS:
+            if name in (data or {}):
+                setattr(stats, name, copy.copy(data[name]))
+        stats._repeats = {key: tuple(value) for key, value in stats._repeats.items()}
+        return stats
+
+    def _ema(self, current: Optional[float], value: float) -> float:
+        return value if current is None else current + self.alpha * (value - current)
+
+    def observe(self, history: PromptHistory, usage: Optional[Dict] = None, margin: float = 0.0):
+        """Folds in the evaluated attempts added since the last call and the run's latest usage.
+
+        `margin` is how much a round must beat the previous best by to count as an improvement.
+        """
+        if len(history) < self._consumed:
+            # A different or rewound history; start over
+            self.reset()
+        rounds: Dict[int, List[Attempt]] = {}
+        for attempt in history[self._consumed:]:
+            if not attempt.evaluated:
+                break
+            rounds.setdefault(attempt.iteration, []).append(attempt)
+            self._observe_repeat(attempt)
+            self._consumed += 1
+        for iteration in sorted(rounds):
+            self._add_round(rounds[iteration], margin)
+        if rounds and usage:
+            self._add_usage(usage, len(rounds))
+
+    def _observe_repeat(self, attempt: Attempt):
+        """Updates the running variance of repeated evaluations of the attempt's prompt (Welford's method)."""
+        if attempt.reused:
+            # A copy of an earlier evaluation, not an independent judgement
+            return
+        if attempt.samples > 1:
+            # The attempt's own samples are repeated evaluations of its prompt
+            self._pooled_m2 += (attempt.samples - 1) * attempt.average_sd ** 2
+            self._pooled_dof += attempt.samples - 1
+            return
+        # Keyed by a digest, so the statistics stay small in the run's state
+        key = hashlib.sha1(normalize_prompt(attempt.prompt_text).encode("utf-8")).hexdigest()[:16]
+        count, mean, m2 = self._repeats.get(key, (0, 0.0, 0.0))
+        score = attempt.average_score
+        count += 1
+        delta = score - mean
+        mean += delta / count
+        new_m2 = m2 + delta * (score - mean)
+        self._pooled_m2 += new_m2 - m2
+        self._pooled_dof += 1 if count > 1 else 0
+        self._repeats[key] = (count, mean, new_m2)
+
+    def _add_round(self, attempts: List[Attempt], margin: float):
+        """Updates the round-level statistics with one round's evaluated attempts."""
+        best_attempt = max(attempts, key=lambda attempt: attempt.average_score)
+        score = best_attempt.average_score
+        self.samples = best_attempt.samples
+        self.rounds += 1
+        self.previous_round_best, self.last_round_best = self.last_round_best, score
+        if self.previous_round_best is not None:
+            self.smoothed_gain = self._ema(self.smoothed_gain, score - self.previous_round_best)
+        self.smoothed_score = self._ema(self.smoothed_score, score)
+        if self.rounds == 1 or score > self.best + margin:
+            self.improved_at_round = self.rounds
+        self.best = max(self.best, score)
+        for criterion, value in zip(best_attempt.criteria, best_attempt.scores):
+            previous = self.criterion_scores.get(criterion)
+            if previous is not None:
+                self.criterion_trends[criterion] = self._ema(self.criterion_trends.get(criterion),
+                                                             value - previous)
+            self.criterion_scores[criterion] = self._ema(previous, value)
+
+    def _add_usage(self, usage: Dict, rounds: int):
+        """Updates the moving averages of tokens and seconds per round from a cumulative usage snapshot."""
+        tokens = usage.get("tokens", 0) - self._last_usage.get("tokens", 0)
+        seconds = usage.get("elapsed_s", 0.0) - self._last_usage.get("elapsed_s", 0.0)
+        self.tokens_per_round = self._ema(self.tokens_per_round, max(tokens, 0) / rounds)
+        self.seconds_per_round = self._ema(self.seconds_per_round, max(seconds, 0.0) / rounds)
+        self._last_usage = dict(usage)
+
+    @property
+    def rounds_since_improvement(self) -> int:
+        return self.rounds - self.improved_at_round
+
+    def noise_sd(self, prior: float) -> float:
+        """Returns the evaluator's estimated score standard deviation, or `prior` without enough repeats."""
+        if self._pooled_dof < 2:
+            return prior
+        return math.sqrt(self._pooled_m2 / self._pooled_dof)
+
+    def as_dict(self) -> Dict:
+        """Returns the statistics, e.g. for logging."""
+        return {"rounds": self.rounds, "best": round(self.best, 3),
+                "last_round_best": self.last_round_best and round(self.last_round_best, 3),
+                "smoothed_score": self.smoothed_score and round(self.smoothed_score, 3),
+                "smoothed_gain": self.smoothed_gain and round(self.smoothed_gain, 3),
+                "rounds_since_improvement": self.rounds_since_improvement,
+                "criterion_trends": {criterion: round(trend, 3) for criterion, trend in self.criterion_trends.items()},
+                "tokens_per_round": self.tokens_per_round and round(self.tokens_per_round),
+                "seconds_per_round": self.seconds_per_round and round(self.seconds_per_round, 3),
+                "repeated_evaluations": self._pooled_dof, "samples": self.samples}
+
+
+class RoutingPolicy:
+    """Decides after every round whether a run continues, revises its strategy or finishes.
+
+    Subclasses list their tunable settings in `PARAMETERS` and implement `_decide`. Each run's statistics are
+    kept in its state under `policy_stats` and updated incrementally, so a decision costs the same however long
+    the history is, and a resumed run continues with the statistics it was journaled with. Settings can be
+    overridden for a single run through the state's `stop_policy` mapping; names that no policy knows are
+    rejected, while settings of other policies are ignored so one job file can be replayed under any policy.
+    """
+
+    PARAMETERS: Tuple[str, ...] = ()
+
+    def __init__(self, ema_alpha: float = 0.5):
+        self.ema_alpha = ema_alpha
+
+    def settings(self) -> Dict:
+        """Returns the policy's current settings."""
+        return {name: getattr(self, name) for name in self.PARAMETERS}
+
+    def configured(self, overrides: Optional[Dict]) -> "RoutingPolicy":
+        """Returns a copy with per-run settings applied."""
+        if not overrides:
+            return self
+        unknown = set(overrides) - KNOWN_PARAMETERS
+        if unknown:
+            raise ValueError(f"Unknown stop policy settings: {', '.join(sorted(unknown))}.")
+        policy = copy.copy(self)
+        for name, value in overrides.items():
+            if name in self.PARAMETERS:
+                setattr(policy, name, value)
+        return policy
+
+    def statistics(self, state: AgentState) -> RunStatistics:
+        """Returns the run's statistics as of its latest decision."""
+        return RunStatistics.from_state_dict(state.get("policy_stats"), self.ema_alpha)
+
+    def decide(self, state: AgentState) -> Tuple[str, str, Dict]:
+        """Returns the route to take after the latest round, the reason for it and the run's updated statistics,
+        which belong in the state's `policy_stats`."""
+        policy = self.configured(state.get("stop_policy"))
+        stats = policy.statistics(state)
+        stats.observe(state.get("prompt_history") or PromptHistory(), state.get("run_usage"), policy._margin(stats))
+        route, reason = policy._decide(state, stats)
+        if route == "REVISE_STRATEGY":
+            stats.revised_at_round = stats.rounds
+        return route, reason, stats.state_dict()
+
+    def decision_thresholds(self, state: AgentState) -> List[float]:
+        """Returns the round scores at which the next decision changes, given the run's rounds decided so far.
+
+        Evaluation uses them to spend extra evaluator samples only on scores too close to call.
+        """
+        policy = self.configured(state.get("stop_policy"))
+        return policy._thresholds(policy.statistics(state))
+
+    def _thresholds(self, stats: RunStatistics) -> List[float]:
+        return []
+
+    def _margin(self, stats: RunStatistics) -> float:
+        """Returns how much a round must beat the best score by to count as an improvement."""
+        return 0.0
+
+    def _decide(self, state: AgentState, stats: RunStatistics) -> Tuple[str, str]:
+        raise NotImplementedError
+
+
+class FixedPolicy(RoutingPolicy):
+    """The original rules: finish at a target score or iteration limit, and revise whenever a round fails to
+    beat the one before it."""
+
+    PARAMETERS = ("target_score", "max_iterations")
+
+    def __init__(self, target_score: float = 8.5, max_iterations: int = 5, **kwargs):
+        super().__init__(**kwargs)
+        self.target_score = target_score
+        self.max_iterations = max_iterations
+
+    def _thresholds(self, stats: RunStatistics) -> List[float]:
+        # The next round is compared with the target and with the latest round
+        if stats.last_round_best is None:
+            return [self.target_score]
+        return [self.target_score, stats.last_round_best]
+
+    def _decide(self, state: AgentState, stats: RunStatistics) -> Tuple[str, str]:
+        score, previous = stats.last_round_best, stats.previous_round_best
+        if score is None:
+            return "CONTINUE_PROBING", "no evaluated candidates yet"
+        if score >= self.target_score or state["iteration_count"] >= self.max_iterations:
+            return "FINISH", "score threshold met or max iterations reached"
+        if state["iteration_count"] >= 2 and previous is not None and score <= previous:
+            return "REVISE_STRATEGY", f"progress stalled: {score:.2f} <= {previous:.2f}"
+        return "CONTINUE_PROBING", "progressing"
+
+
+class AdaptivePolicy(RoutingPolicy):
+    """Stops runs that have reached their target, exhausted a budget or stopped paying off.
+
+    A run finishes when a round reaches `target_score`, after `max_iterations`, when another round at the
+    current rate would exceed `token_budget` tokens or `latency_budget_s` seconds, or, from
+    `min_iterations` on, when the expected gain of another round (the moving average of round-to-round
+    change, but at most the remaining headroom) falls below `min_expected_gain` points, or below
+    `min_gain_per_1k_tokens` points per thousand tokens. The strategy is revised when no round has beaten
+    the best score by more than the evaluator's noise (`noise_z` standard deviations, estimated from repeated
+    evaluations or taken from `score_noise`, and divided by the square root of the samples averaged into a
+    score) for `patience` rounds, or when a criterion is trending down, unless the strategy was already
+    revised since the last improvement.
+    """
+
+    PARAMETERS = ("target_score", "max_iterations", "min_iterations", "token_budget", "latency_budget_s",
+                  "min_expected_gain", "min_gain_per_1k_tokens", "patience", "noise_z", "score_noise")
+
+    def __init__(self, target_score: float = 8.5, max_iterations: int = 5, min_iterations: int = 3,
+                 token_budget: Optional[int] = None, latency_budget_s: Optional[float] = None,
+                 min_expected_gain: float = 0.1, min_gain_per_1k_tokens: Optional[float] = None,
+                 patience: int = 1, noise_z: float = 1.0, score_noise: float = 0.5, **kwargs):
+        super().__init__(**kwargs)
+        self.target_score = target_score
+        self.max_iterations = max_iterations
+        self.min_iterations = min_iterations
+        self.token_budget = token_budget
+        self.latency_budget_s = latency_budget_s
+        self.min_expected_gain = min_expected_gain
+        self.min_gain_per_1k_tokens = min_gain_per_1k_tokens
+        self.patience = patience
+        self.noise_z = noise_z
+        self.score_noise = score_noise
+
+    def _margin(self, stats: RunStatistics) -> float:
+        return self.noise_z * stats.noise_sd(self.score_noise) / math.sqrt(stats.samples)
+
+    def _thresholds(self, stats: RunStatistics) -> List[float]:
+        # The next round is compared with the target and, to count as an improvement, with the best plus noise
+        if not stats.rounds:
+            return [self.target_score]
+        return [self.target_score, stats.best + self._margin(stats)]
+
+    def _over_budget(self, usage: Dict, stats: RunStatistics) -> Optional[str]:
+        """Describes the budget another round would exceed, if any."""
+        tokens, elapsed = usage.get("tokens", 0), usage.get("elapsed_s", 0.0)
+        if self.token_budget is not None and tokens + (stats.tokens_per_round or 0) > self.token_budget:
+            return f"token budget: {tokens} used, ~{stats.tokens_per_round or 0:.0f} per round, {self.token_budget} allowed"
+        if self.latency_budget_s is not None and elapsed + (stats.seconds_per_round or 0) > self.latency_budget_s:
+            return (f"latency budget: {elapsed:.1f}s used, ~{stats.seconds_per_round or 0:.1f}s per round, "
+                    f"{self.latency_budget_s}s allowed")
+        return None
+
+    def _decide(self, state: AgentState, stats: RunStatistics) -> Tuple[str, str]:
+        score = stats.last_round_best
+        if score is None:
+            return "CONTINUE_PROBING", "no evaluated candidates yet"
+        if score >= self.target_score:
+            return "FINISH", f"target reached: {score:.2f} >= {self.target_score}"
+        if state["iteration_count"] >= self.max_iterations:
+            return "FINISH", f"max iterations reached: {self.max_iterations}"
+        exhausted = self._over_budget(state.get("run_usage") or {}, stats)
+        if exhausted:
+            return "FINISH", exhausted
+
+        margin = self._margin(stats)
+        revised_since_improvement = stats.revised_at_round is not None and \
+            stats.revised_at_round >= stats.improved_at_round
+        if not revised_since_improvement:
+            if stats.rounds_since_improvement >= self.patience:
+                return "REVISE_STRATEGY", (f"no gain above noise for {stats.rounds_since_improvement} round(s): "
+                                           f"best {stats.best:.2f}, margin {margin:.2f}")
+            # Criterion scores are noisier than their average by about the square root of their count
+            criterion_margin = margin * math.sqrt(max(len(stats.criterion_scores), 1))
+            regressing = [criterion for criterion, trend in stats.criterion_trends.items() if trend < -criterion_margin]
+            if regressing:
+                return "REVISE_STRATEGY", f"criteria trending down: {', '.join(regressing)}"
+
+        if stats.rounds >= self.min_iterations:
+            expected_gain = min(max(stats.smoothed_gain or 0.0, 0.0), 10.0 - stats.best)
+            if expected_gain < self.min_expected_gain:
+                return "FINISH", f"low expected improvement: {expected_gain:.2f} points per round"
+            if self.min_gain_per_1k_tokens is not None and stats.tokens_per_round:
+                gain_rate = expected_gain / (stats.tokens_per_round / 1000)
+                if gain_rate < self.min_gain_per_1k_tokens:
+                    return "FINISH", f"low expected improvement per token: {gain_rate:.3f} points per 1k tokens"
+        return "CONTINUE_PROBING", f"expected gain {max(stats.smoothed_gain or 0.0, 0.0):.2f} points per round"
+
+
+POLICIES = {"fixed": FixedPolicy, "adaptive": AdaptivePolicy}
+KNOWN_PARAMETERS = frozenset(name for policy in POLICIES.values() for name in policy.PARAMETERS)
+
+
+def parse_settings(specs: List[str]) -> Dict:
+    """Parses NAME=VALUE settings; values are numbers, or `none` to disable an optional limit."""
+    settings = {}
+    for spec in specs:
+        name, _, value = spec.partition("=")
+        if not value:
+            raise ValueError(f"Expected NAME=VALUE, got '{spec}'.")
+        if value.lower() == "none":
+            settings[name] = None
+        else:
+            number = float(value)
+            settings[name] = int(number) if number.is_integer() and "." not in value else number
+    return settings
+
+
+def create_policy(spec: str) -> RoutingPolicy:
+    """Builds a policy from a spec such as `adaptive` or `adaptive:token_budget=20000,patience=2`."""
+    name, _, settings = spec.partition(":")
+    if name not in POLICIES:
+        raise ValueError(f"Unknown policy '{name}'; choose from {', '.join(POLICIES)}.")
+    overrides = parse_settings([item for item in settings.split(",") if item])
+    unknown = set(overrides) - set(POLICIES[name].PARAMETERS)
+    if unknown:
+        raise ValueError(f"Policy '{name}' has no settings {', '.join(sorted(unknown))}.")
+    return POLICIES[name](**overrides)
@@ -0,0 +1,186 @@
+import random
+import threading
+import time
+from typing import Optional
+
+# Fragments of provider error messages that identify throttling and transient failures. The Gemini client
+# surfaces these through several exception types depending on version, so messages are checked too.
+_THROTTLING_MARKERS = ("429", "resource_exhausted", "resource exhausted", "rate limit", "ratelimit", "quota",
+                       "too many requests")
+_TRANSIENT_MARKERS = ("500", "502", "503", "504", "unavailable", "deadline", "timeout", "timed out",
+                      "connection reset", "connection aborted", "internal error", "overloaded")
+_TRANSIENT_TYPES = ("ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded",
+                    "InternalServerError", "BadGateway", "GatewayTimeout", "ServerError")
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    """Returns the HTTP-like status code carried by a provider exception, if any."""
+    for attribute in ("status_code", "code", "status"):
+        value = getattr(exc, attribute, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_throttling_error(exc: BaseException) -> bool:
+    """Returns whether an exception means the provider is throttling us."""
+    if _status_code(exc) == 429 or type(exc).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    message = str(exc).lower()
+    return any(marker in message for marker in _THROTTLING_MARKERS)
+
+
+def is_retryable_error(exc: BaseException) -> bool:
+    """Returns whether a failed call may succeed if retried; client errors such as 400/401/403 are fatal."""
+    if isinstance(exc, (TimeoutError, ConnectionError)) or is_throttling_error(exc):
+        return True
+    status = _status_code(exc)
+    if status is not None:
+        return status >= 500 or status == 408
+    if any(name in type(exc).__name__ for name in _TRANSIENT_TYPES):
+        return True
+    message = str(exc).lower()
+    return any(marker in message for marker in _TRANSIENT_MARKERS)
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter for retryable model-call failures."""
+
+    def __init__(self, max_attempts: int = 5, base_delay_s: float = 1.0, max_delay_s: float = 30.0):
+        self.max_attempts = max_attempts
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+
+    def should_retry(self, exc: BaseException, attempt: int) -> bool:
+        """Returns whether to retry after `attempt` (1-based) failed with `exc`."""
+        return attempt < self.max_attempts and is_retryable_error(exc)
+
+    def backoff(self, attempt: int) -> float:
+        """Returns a jittered delay before the retry that follows `attempt`."""
+        return random.uniform(0, min(self.max_delay_s, self.base_delay_s * 2 ** (attempt - 1)))
+
+
+class TokenBucket:
+    """A continuously refilling bucket; `acquire` blocks until enough capacity is available."""
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst if burst is not None else per_minute
+        self._level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """Adds the capacity accrued since the last update; must be called with the lock held."""
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Takes `amount` from the bucket, sleeping as needed, and returns the time spent waiting."""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._level >= amount:
+                    self._level -= amount
+                    return waited
+                delay = (amount - self._level) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def adjust(self, amount: float):
+        """Debits (positive) or credits (negative) the bucket after the fact, e.g. once real usage is known."""
+        with self._lock:
+            self._refill()
+            self._level = min(self.capacity, self._level - amount)
+
+
+class AdaptiveConcurrency:
+    """An AIMD concurrency limit: grows by about one slot per window of successes, halves on throttling.
+
+    Throttling responses tend to arrive in bursts from calls that were all in flight together, so the limit is
+    decreased at most once per `cooldown_s`.
+    """
+
+    def __init__(self, initial: int = 8, minimum: int = 1, maximum: int = 64, decrease_factor: float = 0.5,
+                 cooldown_s: float = 1.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.cooldown_s = cooldown_s
+        self._last_decrease = float("-inf")
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        """The current number of calls allowed in flight."""
+        return int(self._limit)
+
+    def acquire(self) -> float:
+        """Waits for a free slot and returns the time spent waiting."""
+        start = time.perf_counter()
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+        return time.perf_counter() - start
+
+    def release(self, throttled: bool = False):
+        """Frees a slot and adapts the limit to the call's outcome."""
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown_s:
+                    self._limit = max(self.minimum, self._limit * self.decrease_factor)
+                    self._last_decrease = now
+            else:
+                self._limit = min(self.maximum, self._limit + 1.0 / self._limit)
+            self._condition.notify_all()
+
+
+class RateLimiter:
+    """A process-wide gate for model calls: requests/min, tokens/min and an adaptive concurrency limit.
+
+    Share one instance between every graph and run that draws on the same provider quota.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 concurrency: Optional[AdaptiveConcurrency] = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = concurrency or AdaptiveConcurrency()
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "throttled": 0, "wait_s": 0.0}
+
+    def acquire(self, estimated_tokens: int) -> float:
+        """Blocks until the call may be sent and returns the time spent waiting."""
+        waited = self.concurrency.acquire()
+        if self.requests is not None:
+            waited += self.requests.acquire(1)
+        if self.tokens is not None:
+            waited += self.tokens.acquire(estimated_tokens)
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["wait_s"] += waited
+        return waited
+
+    def release(self, throttled: bool = False, estimated_tokens: int = 0, actual_tokens: Optional[int] = None):
+        """Reports the call's outcome, correcting the token budget once real usage is known."""
+        self.concurrency.release(throttled=throttled)
+        if self.tokens is not None and actual_tokens is not None:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+        if throttled:
+            with self._lock:
+                self._stats["throttled"] += 1
+
+    def stats(self) -> dict:
+        """Returns call, throttling and waiting counters plus the current concurrency limit."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["concurrency_limit"] = self.concurrency.limit
+        return stats
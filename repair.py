@@ -0,0 +1,180 @@
+import re
+import threading
+from typing import Dict, List, Optional, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+
+_FENCE = re.compile(r"```[a-zA-Z]*\s*(.*?)```", re.S)
+_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+
+# Appended to a prompt whose structured output could not be used, before it is sent once more
+REASK_INSTRUCTIONS = ("\n\nYour previous response could not be used: {error}\nPrevious response:\n{previous}\n"
+                      "Respond again with only the corrected output as JSON that matches the requested schema.")
+
+
+def message_text(raw) -> str:
+    """Returns the text of a raw chat message, joining the text parts of multi-part content."""
+    content = getattr(raw, "content", raw)
+    if isinstance(content, list):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in content
+                       if isinstance(part, (str, dict)))
+    return content if isinstance(content, str) else ""
+
+
+def _scan_string(text: str, start: int) -> int:
+    """Returns the index just past the string literal opening at `start`, or the text's length if unterminated.
+
+    In a single-quoted string, a quote only closes the string where JSON syntax can follow it, so apostrophes
+    as in 'don't' stay part of the text.
+    """
+    quote, i = text[start], start + 1
+    while i < len(text):
+        if text[i] == "\\":
+            i += 2
+            continue
+        if text[i] == quote and (quote == '"' or _closes_single_quote(text, i + 1)):
+            return i + 1
+        i += 1
+    return len(text)
+
+
+def _closes_single_quote(text: str, end: int) -> bool:
+    """Returns whether the text from `end` on, ignoring whitespace, continues like JSON after a string."""
+    rest = text[end:].lstrip()
+    return not rest or rest[0] in ",:}]"
+
+
+def _requote(body: str) -> str:
+    """Turns the body of a single-quoted string into a JSON string, keeping its escape sequences."""
+    out, i = ['"'], 0
+    while i < len(body):
+        if body[i] == "\\" and i + 1 < len(body):
+            out.append("'" if body[i + 1] == "'" else body[i:i + 2])
+            i += 2
+            continue
+        out.append('\\"' if body[i] == '"' else body[i])
+        i += 1
+    out.append('"')
+    return "".join(out)
+
+
+def extract_json(text: str) -> Optional[str]:
+    """Returns the JSON object or array embedded in `text`, e.g. in a fenced code block or surrounded by prose.
+
+    Without a closing bracket, e.g. in a truncated response, the rest of the text is returned.
+    """
+    for block in _FENCE.finditer(text):
+        if "{" in block.group(1) or "[" in block.group(1):
+            # Scanned from the block's start rather than cut at its end, which may be a fence inside a string
+            text = text[block.start(1):]
+            break
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        return None
+    depth, i = 0, start
+    while i < len(text):
+        c = text[i]
+        if c in "\"'":
+            i = _scan_string(text, i)
+            continue
+        if c in "{[":
+            depth += 1
+        elif c in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+        i += 1
+    return text[start:]
+
+
+def repair_json(text: str) -> str:
+    """Fixes common syntax slips of JSON written by a model.
+
+    Single-quoted strings become double-quoted, trailing commas before a closing bracket are dropped and
+    Python's True, False and None become their JSON equivalents. String contents are left untouched.
+    """
+    out, i = [], 0
+    while i < len(text):
+        c = text[i]
+        if c == '"':
+            end = _scan_string(text, i)
+            out.append(text[i:end])
+            i = end
+        elif c == "'":
+            end = _scan_string(text, i)
+            closed = end - i > 1 and text[end - 1] == "'"
+            out.append(_requote(text[i + 1:end - 1 if closed else end]))
+            i = end
+        elif c == ",":
+            j = i + 1
+            while j < len(text) and text[j].isspace():
+                j += 1
+            if j < len(text) and text[j] in "}]":
+                i += 1
+            else:
+                out.append(c)
+                i += 1
+        elif c.isalpha():
+            j = i
+            while j < len(text) and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            out.append(_LITERALS.get(word, word))
+            i = j
+        else:
+            out.append(c)
+            i += 1
+    return "".join(out)
+
+
+class StructuredOutputRepair:
+    """Recovers structured outputs that the model's own parser rejected, and counts how each output was obtained.
+
+    Tiers, cheapest first: `direct` (parsed as returned), `extracted` (valid JSON found inside the response,
+    e.g. in a fenced block, in prose or in tool-call arguments), `repaired` (valid after fixing quotes,
+    trailing commas and literals), `reasked` (valid after asking the model again with the validation error)
+    and `failed`. Score values given as text are coerced by the schemas themselves, see `CriterionScore`.
+    """
+
+    TIERS = ("direct", "extracted", "repaired", "reasked", "failed")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {tier: 0 for tier in self.TIERS}
+
+    def repair(self, raw, schema: Type[BaseModel]) -> Tuple[Optional[BaseModel], str, str]:
+        """Tries the local tiers on a raw response; returns the object (or None), its tier and the last error."""
+        error = "no JSON found in the response"
+        texts: List[str] = [message_text(raw)]
+        for call in getattr(raw, "tool_calls", None) or []:
+            try:
+                return schema.model_validate(call.get("args") or {}), "extracted", ""
+            except ValidationError as e:
+                error = str(e)
+        texts += [call.get("args") or "" for call in getattr(raw, "invalid_tool_calls", None) or []]
+        texts = [text for text in texts if isinstance(text, str) and text.strip()]
+
+        extracted = [extract_json(text) or text for text in texts]
+        for tier, variants in (("extracted", lambda s: (s,)),
+                               ("repaired", lambda s: (repair_json(s), repair_json(s.translate(_SMART_QUOTES))))):
+            for text in extracted:
+                for candidate in variants(text):
+                    try:
+                        return schema.model_validate_json(candidate), tier, ""
+                    except ValidationError as e:
+                        error = str(e)
+        return None, "failed", error
+
+    def record(self, tier: str):
+        """Counts one structured output obtained at `tier`, or one that could not be obtained at all."""
+        with self._lock:
+            self._stats[tier] += 1
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the outputs obtained at each tier and the share that needed no model round-trip to recover."""
+        with self._lock:
+            stats = dict(self._stats)
+        total = sum(stats.values())
+        stats["recovered_locally_ratio"] = round((stats["extracted"] + stats["repaired"]) / total, 4) if total else 0.0
+        return stats
@@ -0,0 +1,127 @@
+import argparse
+import json
+from typing import Dict, List
+
+from checkpoint import RunJournal
+from policy import RoutingPolicy, create_policy
+
+# Nodes that make LLM calls, used to approximate the calls of runs journaled without usage totals
+LLM_NODES = {"decompose_goal", "formulate_strategy", "generate_prompt", "evaluate_prompt", "synthesize_reflection"}
+
+
+def decision_points(journal: RunJournal, run_id: str) -> List[Dict]:
+    """Returns the state of a journaled run at each decide_next_step, with what the run had spent by then."""
+    points, llm_steps = [], 0
+    for node, state in journal.replay(run_id):
+        llm_steps += node in LLM_NODES
+        if node != "decide_next_step":
+            continue
+        usage = dict(state.get("run_usage") or {})
+        if not usage.get("llm_calls"):
+            usage["llm_calls"] = llm_steps
+        history = state.get("prompt_history")
+        best = history.best.average_score if history and history.best else 0.0
+        points.append({"state": {**state, "run_id": run_id, "run_usage": usage},
+                       "best_score": best, "usage": usage})
+    return points
+
+
+def replay_run(policy: RoutingPolicy, points: List[Dict]) -> Dict:
+    """Replays a policy over a recorded run's decision points.
+
+    The policy sees the same state the run had at each point, except for the recorded policy's statistics:
+    it keeps its own across the points, as it would have in the run. It finishes the replayed run where it first
+    chooses FINISH; choosing another route than the recording did only changes the outcome if that route is
+    FINISH, since what a different route would have produced is unknown. A policy that wants to continue past
+    the end of the recording is reported as such, with the recorded outcome.
+    """
+    stats = {}
+    for index, point in enumerate(points):
+        route, reason, stats = policy.decide({**point["state"], "policy_stats": stats})
+        if route == "FINISH":
+            return {"stopped_at": index + 1, "best_score": point["best_score"], "usage": point["usage"],
+                    "reason": reason, "wants_more": False}
+    last = points[-1]
+    return {"stopped_at": len(points), "best_score": last["best_score"], "usage": last["usage"],
+            "reason": "recording ended", "wants_more": True}
+
+
+def compare_policies(journal: RunJournal, specs: List[str], status: str = "finished") -> Dict[str, Dict]:
+    """Replays every policy over the journal's runs and totals calls, tokens and final scores against the
+    recordings."""
+    runs = {run_id: points for run_id in journal.run_ids(status) if (points := decision_points(journal, run_id))}
+    recorded = {"runs": len(runs), "rounds": 0, "llm_calls": 0, "tokens": 0, "score_sum": 0.0}
+    for points in runs.values():
+        recorded["rounds"] += len(points)
+        recorded["llm_calls"] += points[-1]["usage"]["llm_calls"]
+        recorded["tokens"] += points[-1]["usage"].get("tokens", 0)
+        recorded["score_sum"] += points[-1]["best_score"]
+
+    results = {}
+    for spec in specs:
+        policy = create_policy(spec)
+        totals = {"rounds": 0, "llm_calls": 0, "tokens": 0, "score_sum": 0.0, "stopped_earlier": 0,
+                  "wants_more": 0, "reasons": {}}
+        for points in runs.values():
+            outcome = replay_run(policy, points)
+            totals["rounds"] += outcome["stopped_at"]
+            totals["llm_calls"] += outcome["usage"]["llm_calls"]
+            totals["tokens"] += outcome["usage"].get("tokens", 0)
+            totals["score_sum"] += outcome["best_score"]
+            totals["stopped_earlier"] += outcome["stopped_at"] < len(points)
+            totals["wants_more"] += outcome["wants_more"]
+            reason = outcome["reason"].split(":", 1)[0]
+            totals["reasons"][reason] = totals["reasons"].get(reason, 0) + 1
+        results[spec] = {
+            "runs": len(runs),
+            "rounds": totals["rounds"],
+            "llm_calls": totals["llm_calls"],
+            "calls_saved": round(1 - totals["llm_calls"] / recorded["llm_calls"], 4) if recorded["llm_calls"] else 0.0,
+            "tokens_saved": round(1 - totals["tokens"] / recorded["tokens"], 4) if recorded["tokens"] else 0.0,
+            "mean_best_score": round(totals["score_sum"] / len(runs), 3) if runs else 0.0,
+            "score_change": round((totals["score_sum"] - recorded["score_sum"]) / len(runs), 3) if runs else 0.0,
+            "stopped_earlier": totals["stopped_earlier"],
+            "wants_more": totals["wants_more"],
+            "reasons": totals["reasons"],
+        }
+    results["recorded"] = {"runs": len(runs), "rounds": recorded["rounds"], "llm_calls": recorded["llm_calls"],
+                           "mean_best_score": round(recorded["score_sum"] / len(runs), 3) if runs else 0.0}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare routing policies offline on journaled P³RO runs.")
+    parser.add_argument("journal", help="SQLite run journal, e.g. written by batch.py --checkpoint-db.")
+    parser.add_argument("--policy", action="append", metavar="NAME[:SETTING=VALUE,...]",
+                        help="Policy to replay, e.g. fixed or adaptive:token_budget=20000; repeatable. "
+                             "Defaults to fixed and adaptive.")
+    parser.add_argument("--status", default="finished", help="Only replay runs with this journal status.")
+    parser.add_argument("--output", help="Write the comparison as JSON to this file.")
+    args = parser.parse_args()
+
+    journal = RunJournal(args.journal)
+    try:
+        results = compare_policies(journal, args.policy or ["fixed", "adaptive"], status=args.status)
+    finally:
+        journal.close()
+
+    recorded = results["recorded"]
+    print(f"{'recorded':>40}: {recorded['runs']} runs, {recorded['rounds']} rounds, {recorded['llm_calls']} calls, "
+          f"mean best score {recorded['mean_best_score']}")
+    for spec, metrics in results.items():
+        if spec == "recorded":
+            continue
+        print(f"{spec:>40}: {metrics['rounds']} rounds, {metrics['llm_calls']} calls "
+              f"({metrics['calls_saved']:+.1%} saved, {metrics['tokens_saved']:+.1%} tokens), "
+              f"mean best score {metrics['mean_best_score']} ({metrics['score_change']:+.3f}), "
+              f"{metrics['stopped_earlier']} stopped earlier, {metrics['wants_more']} wanted more")
+        for reason, count in sorted(metrics["reasons"].items(), key=lambda item: -item[1]):
+            print(f"{'':>44}{count:>5} x {reason}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
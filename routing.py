@@ -0,0 +1,89 @@
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from pydantic import BaseModel
+
+# List prices in USD per million (input, output) tokens, used to estimate the cost of each call
+MODEL_PRICES = {
+    "gemini-2.5-pro": (1.25, 10.00),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+}
+
+# Share of the input price charged for input tokens served from a context cache
+CACHED_INPUT_PRICE_FACTOR = 0.25
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int, cached_input_tokens: int = 0) -> float:
+    """Returns the estimated USD cost of a call, or 0.0 for models without a known price."""
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    cached = min(cached_input_tokens, input_tokens)
+    input_cost = (input_tokens - cached) * input_price + cached * input_price * CACHED_INPUT_PRICE_FACTOR
+    return (input_cost + output_tokens * output_price) / 1_000_000
+
+
+class ModelRouter:
+    """Chooses the model each node calls, and when a node's call is retried on a stronger model.
+
+    Nodes use `node_models[node]`, or `default_model` if they have no entry. For the nodes in `escalate_nodes`, a
+    call is repeated on `escalation_model` when the first model's structured output could not be obtained, even
+    after repair. A sampled evaluation is redone on `escalation_model` when its samples disagree on a criterion
+    by a standard deviation above `sample_stdev_threshold`, i.e. when the cheap evaluator cannot judge the
+    prompt consistently. Scores that differ between criteria are an informative result, not a reason to escalate.
+    """
+
+    def __init__(self, default_model: str = "gemini-2.5-flash", node_models: Optional[Dict[str, str]] = None,
+                 escalation_model: Optional[str] = None, escalate_nodes: Iterable[str] = ("evaluate_prompt",),
+                 sample_stdev_threshold: float = 2.5):
+        self.default_model = default_model
+        self.node_models = dict(node_models or {})
+        self.escalation_model = escalation_model
+        self.escalate_nodes = set(escalate_nodes)
+        self.sample_stdev_threshold = sample_stdev_threshold
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"calls": 0, "escalations": 0,
+                                                                      "escalation_failures": 0})
+
+    def model_for(self, node: Optional[str]) -> str:
+        """Returns the model a node calls first."""
+        return self.node_models.get(node, self.default_model)
+
+    def models(self) -> List[str]:
+        """Returns every model the router may call."""
+        names = [self.default_model, *self.node_models.values()]
+        if self.escalation_model:
+            names.append(self.escalation_model)
+        return list(dict.fromkeys(names))
+
+    def escalation_for(self, node: Optional[str]) -> Optional[str]:
+        """Returns the model to escalate a node's calls to, or None if they are never escalated."""
+        if node not in self.escalate_nodes or self.escalation_model in (None, self.model_for(node)):
+            return None
+        return self.escalation_model
+
+    def should_escalate(self, response: Optional[BaseModel]) -> bool:
+        """Decides whether a response from the first model is unusable, i.e. missing or unparseable."""
+        return response is None
+
+    def samples_disagree(self, evaluation: Dict) -> bool:
+        """Decides whether the samples of a serialized, sampled evaluation disagree too much on a criterion."""
+        return evaluation.get("samples", 1) > 1 and any(
+            score.get("sd", 0.0) > self.sample_stdev_threshold for score in evaluation["scores"])
+
+    def record(self, node: Optional[str], escalated: bool = False, escalation_failed: bool = False,
+               calls: int = 1):
+        """Counts `calls` routed calls and whether one had to be escalated."""
+        with self._lock:
+            stats = self._stats[node or "unknown"]
+            stats["calls"] += calls
+            stats["escalations"] += 1 if escalated else 0
+            stats["escalation_failures"] += 1 if escalation_failed else 0
+
+    def stats(self) -> Dict[str, Dict]:
+        """Returns routed calls, escalations and the escalation rate per node."""
+        with self._lock:
+            return {node: {**counts, "model": self.model_for(node),
+                           "escalation_rate": round(counts["escalations"] / counts["calls"], 4)
+                           if counts["calls"] else 0.0}
+                    for node, counts in self._stats.items()}
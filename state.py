@@ -1,8 +1,16 @@
-from typing import List, TypedDict
-from pydantic import BaseModel, Field
-from typing import List, TypedDict
+import math
+import re
+import sys
+import uuid
+from array import array
+from functools import lru_cache
+from typing import Annotated, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypedDict, Union
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
+
+
+# A number at the start of a text, e.g. the 8 of "8/10"
+_LEADING_NUMBER = re.compile(r"\s*(-?\d+(?:\.\d+)?)")
 
 
 class DecomposedGoal(BaseModel):
@@ -28,6 +36,17 @@ class CriterionScore(BaseModel):
     score: int = Field(description="A score from 1 (fails completely) to 10 (perfectly satisfies).")
     justification: str = Field(description="A brief justification for the score, citing evidence from the prompt.")
 
+    @field_validator("score", mode="before")
+    @classmethod
+    def _coerce_score(cls, value):
+        """Accepts scores written as text or fractions, e.g. "8", "8/10" or 7.5, rounded to the nearest integer."""
+        if isinstance(value, str):
+            match = _LEADING_NUMBER.match(value)
+            return round(float(match.group(1))) if match else value
+        if isinstance(value, float):
+            return round(value)
+        return value
+
 
 class EvaluationResult(BaseModel):
     """Pydantic model for the output of the PromptEvaluator tool."""
@@ -35,18 +54,358 @@ class EvaluationResult(BaseModel):
     qualitative_feedback: str = Field(description="A summary of the prompt's main strengths and weaknesses.")
 
 
+class BatchEvaluationItem(BaseModel):
+    """Pydantic model for one prompt's evaluation inside a batched PromptEvaluator response."""
+    item_id: int = Field(description="The id of the evaluated item, exactly as given in the request.")
+    evaluation: EvaluationResult = Field(description="The evaluation of that item's prompt.")
+
+
+class BatchEvaluationResult(BaseModel):
+    """Pydantic model for the output of the PromptEvaluator tool when several prompts are scored at once."""
+    results: List[BatchEvaluationItem] = Field(description="One evaluation per requested item.")
+
+
 class Reflection(BaseModel):
     """Pydantic model for the output of the ReflectionSynthesizer tool."""
     summary: str = Field(description="A concise, actionable insight synthesized from the evaluation report.")
 
 
+# Two-sided 95% critical values of Student's t distribution for 1 to 30 degrees of freedom
+_T_CRITICAL_95 = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160,
+                  2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056,
+                  2.052, 2.048, 2.045, 2.042)
+
+
+def confidence_half_width(sd: float, samples: int) -> float:
+    """Returns the half-width of the 95% confidence interval of a mean of `samples` draws with deviation `sd`."""
+    if samples < 2:
+        return 0.0
+    t = _T_CRITICAL_95[samples - 2] if samples - 1 <= len(_T_CRITICAL_95) else 1.96
+    return t * sd / math.sqrt(samples)
+
+
+def _score_array(scores: Iterable[float]) -> array:
+    """Stores integer scores as 16-bit integers and aggregated, fractional ones as doubles."""
+    scores = list(scores)
+    if all(float(score).is_integer() for score in scores):
+        return array("h", (int(score) for score in scores))
+    return array("d", scores)
+
+
+@lru_cache(maxsize=4096)
+def intern_criteria(criteria: Tuple[str, ...]) -> Tuple[str, ...]:
+    """Returns one shared tuple per distinct list of criterion names, so attempts only store indexes into it."""
+    return tuple(sys.intern(criterion) for criterion in criteria)
+
+
+class Attempt:
+    """One candidate prompt and, once scored, its evaluation, stored compactly.
+
+    Criterion names live in a tuple shared by every attempt scored against the same criteria; the scores and
+    justifications are stored by index into it, the scores in a 16-bit integer array. The total and average
+    score are computed once. An evaluation aggregated from several evaluator samples also keeps the sample
+    count and the standard deviation of each criterion's and of the average score across samples.
+    Attempts are treated as immutable: `with_evaluation` returns a new one.
+    """
+
+    __slots__ = ("prompt_text", "reasoning", "iteration", "parent", "criteria", "scores", "justifications",
+                 "feedback", "total_score", "average_score", "reused", "samples", "score_sd", "average_sd")
+
+    def __init__(self, prompt_text: str, reasoning: str = "", iteration: int = 0, parent: Optional[int] = None,
+                 criteria: Optional[Tuple[str, ...]] = None, scores: Iterable[float] = (),
+                 justifications: Tuple[str, ...] = (), feedback: str = "", reused: bool = False,
+                 samples: int = 1, score_sd: Iterable[float] = (), average_sd: float = 0.0):
+        self.prompt_text = prompt_text
+        self.reasoning = reasoning
+        self.iteration = iteration
+        self.parent = parent
+        self.criteria = intern_criteria(tuple(criteria)) if criteria is not None else None
+        self.scores = _score_array(scores)
+        self.justifications = tuple(justifications)
+        self.feedback = feedback
+        self.total_score = sum(self.scores)
+        self.average_score = self.total_score / len(self.scores) if self.scores else 0.0
+        self.reused = reused
+        self.samples = samples
+        self.score_sd = array("d", score_sd)
+        self.average_sd = average_sd
+
+    @property
+    def evaluated(self) -> bool:
+        return self.criteria is not None
+
+    @property
+    def average_ci(self) -> float:
+        """Half-width of the 95% confidence interval of the average score; 0 for a single sample."""
+        return confidence_half_width(self.average_sd, self.samples)
+
+    def with_evaluation(self, evaluation: Dict, reused: bool = False) -> "Attempt":
+        """Returns a copy of this attempt scored with a serialized `EvaluationResult`.
+
+        The evaluation may be aggregated from several samples, see `evaluation.aggregate_evaluations`.
+        `reused` marks an evaluation copied from another prompt rather than judged independently.
+        """
+        scores = evaluation["scores"]
+        samples = evaluation.get("samples", 1)
+        return Attempt(self.prompt_text, self.reasoning, self.iteration, self.parent,
+                       criteria=tuple(score["criterion"] for score in scores),
+                       scores=[score["score"] for score in scores],
+                       justifications=tuple(score["justification"] for score in scores),
+                       feedback=evaluation["qualitative_feedback"], reused=reused, samples=samples,
+                       score_sd=[score.get("sd", 0.0) for score in scores] if samples > 1 else (),
+                       average_sd=evaluation.get("average_sd", 0.0))
+
+    def evaluation_dict(self) -> Optional[Dict]:
+        """Returns the evaluation in the shape of a serialized `EvaluationResult`, or None if not scored."""
+        if self.criteria is None:
+            return None
+        evaluation = {"scores": [{"criterion": criterion, "score": score, "justification": justification}
+                                 for criterion, score, justification in zip(self.criteria, self.scores,
+                                                                            self.justifications)],
+                      "qualitative_feedback": self.feedback}
+        if self.samples > 1:
+            for score, sd in zip(evaluation["scores"], self.score_sd):
+                score["sd"] = sd
+            evaluation["samples"] = self.samples
+            evaluation["average_sd"] = self.average_sd
+        return evaluation
+
+    def scores_by_criterion(self) -> Dict[str, int]:
+        return dict(zip(self.criteria or (), self.scores))
+
+    def to_dict(self) -> Dict:
+        """Returns the attempt as plain JSON-serializable data."""
+        data = {"prompt_text": self.prompt_text, "reasoning": self.reasoning, "iteration": self.iteration,
+                "parent": self.parent}
+        if self.criteria is not None:
+            data["evaluation"] = self.evaluation_dict()
+        if self.reused:
+            data["reused"] = True
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Attempt":
+        """Rebuilds an attempt from `to_dict` output."""
+        attempt = cls(data["prompt_text"], data.get("reasoning", ""), data.get("iteration", 0), data.get("parent"))
+        if data.get("evaluation"):
+            attempt = attempt.with_evaluation(data["evaluation"], reused=data.get("reused", False))
+        return attempt
+
+    def __repr__(self) -> str:
+        return f"Attempt(iteration={self.iteration}, average_score={self.average_score:.2f}, " \
+               f"prompt_text={self.prompt_text[:40]!r})"
+
+
+class _HistoryLog:
+    """The append-only storage behind `PromptHistory` views, with running aggregates per position.
+
+    For every position it records the index of the best attempt so far, the index of the first attempt of the
+    round (iteration) the attempt belongs to, and the index of the best attempt of that round so far.
+    """
+
+    __slots__ = ("attempts", "best", "round_start", "round_best")
+
+    def __init__(self):
+        self.attempts: List[Attempt] = []
+        self.best = array("l")
+        self.round_start = array("l")
+        self.round_best = array("l")
+
+    def copy(self, size: int) -> "_HistoryLog":
+        log = _HistoryLog()
+        log.attempts = self.attempts[:size]
+        log.best, log.round_start, log.round_best = self.best[:size], self.round_start[:size], self.round_best[:size]
+        return log
+
+    def append(self, attempt: Attempt):
+        index = len(self.attempts)
+        previous = self.attempts[-1] if self.attempts else None
+        self.attempts.append(attempt)
+        if previous is None:
+            self.best.append(index)
+            self.round_start.append(index)
+            self.round_best.append(index)
+            return
+        best = self.attempts[self.best[-1]]
+        better = attempt.evaluated and (not best.evaluated or attempt.total_score > best.total_score)
+        self.best.append(index if better else self.best[-1])
+        if attempt.iteration != previous.iteration:
+            self.round_start.append(index)
+            self.round_best.append(index)
+        else:
+            round_best = self.attempts[self.round_best[-1]]
+            self.round_start.append(self.round_start[-1])
+            better = attempt.evaluated and (not round_best.evaluated
+                                            or attempt.average_score > round_best.average_score)
+            self.round_best.append(index if better else self.round_best[-1])
+
+
+class PromptHistory(Sequence):
+    """An append-only sequence of attempts with O(1) access to the best attempt and the latest rounds.
+
+    Appending returns a new history that shares storage with the old one: attempts are added to the shared
+    log in place and the new view simply covers more of it, so no attempt is ever copied and older views
+    (e.g. held by earlier graph states) stay valid. Only appending to an older view copies its prefix.
+    """
+
+    __slots__ = ("_log", "_size")
+
+    def __init__(self, attempts: Iterable[Attempt] = ()):
+        self._log = _HistoryLog()
+        for attempt in attempts:
+            self._log.append(attempt)
+        self._size = len(self._log.attempts)
+
+    @classmethod
+    def from_dicts(cls, entries: Iterable[Dict]) -> "PromptHistory":
+        return cls(Attempt.from_dict(entry) for entry in entries)
+
+    def appended(self, attempts: Iterable[Attempt]) -> "PromptHistory":
+        """Returns a history with `attempts` added at the end."""
+        log = self._log if self._size == len(self._log.attempts) else self._log.copy(self._size)
+        for attempt in attempts:
+            log.append(attempt)
+        history = PromptHistory.__new__(PromptHistory)
+        history._log, history._size = log, len(log.attempts)
+        return history
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            return self._log.attempts[:self._size][index]
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("prompt history index out of range")
+        return self._log.attempts[index]
+
+    def __iter__(self) -> Iterator[Attempt]:
+        attempts = self._log.attempts
+        return (attempts[i] for i in range(self._size))
+
+    @property
+    def best_index(self) -> Optional[int]:
+        """Index of the attempt with the highest total score (the first one on ties), or None."""
+        if not self._size or not self._log.attempts[self._log.best[self._size - 1]].evaluated:
+            return None
+        return self._log.best[self._size - 1]
+
+    @property
+    def best(self) -> Optional[Attempt]:
+        index = self.best_index
+        return None if index is None else self._log.attempts[index]
+
+    def round_best(self, rounds_back: int = 0) -> Optional[Attempt]:
+        """Returns the best attempt of the latest round, or of the round `rounds_back` rounds before it."""
+        end = self._size - 1
+        for _ in range(rounds_back):
+            if end < 0:
+                return None
+            end = self._log.round_start[end] - 1
+        if end < 0:
+            return None
+        attempt = self._log.attempts[self._log.round_best[end]]
+        return attempt if attempt.evaluated else None
+
+    def round_bests(self) -> List[Attempt]:
+        """Returns the best attempt of every round, oldest round first."""
+        bests, end = [], self._size - 1
+        while end >= 0:
+            bests.append(self._log.attempts[self._log.round_best[end]])
+            end = self._log.round_start[end] - 1
+        return [attempt for attempt in reversed(bests) if attempt.evaluated]
+
+    def as_dicts(self) -> List[Dict]:
+        return [attempt.to_dict() for attempt in self]
+
+    def __repr__(self) -> str:
+        return f"PromptHistory(attempts={self._size}, best_index={self.best_index})"
+
+
+def append_attempts(current: Optional[PromptHistory],
+                    update: Union[PromptHistory, Iterable[Union[Attempt, Dict]]]) -> PromptHistory:
+    """LangGraph reducer for `prompt_history`: nodes return only their new attempts, which are appended.
+
+    A whole `PromptHistory` (e.g. from `create_initial_state` or a resumed journal) replaces the current one.
+    """
+    if isinstance(update, PromptHistory):
+        return update
+    attempts = [item if isinstance(item, Attempt) else Attempt.from_dict(item) for item in update]
+    return (current if current is not None else PromptHistory()).appended(attempts)
+
+
+def encode_state_value(value):
+    """`json.dumps` default for state values: attempts and histories become plain dicts and lists."""
+    if isinstance(value, Attempt):
+        return value.to_dict()
+    if isinstance(value, PromptHistory):
+        return value.as_dicts()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
 class AgentState(TypedDict):
     """Defines the state of the agent, serving as its memory."""
     initial_prompt: str
     goal: str
     decomposed_criteria: List[str]
     high_level_plan: str
-    prompt_history: List
+    prompt_history: Annotated[PromptHistory, append_attempts]
+    candidates: List[Attempt]
     current_reflection: str
     final_prompt: str
     iteration_count: int
+    beam: List[int]
+    run_id: str
+    resume_node: str
+    stop_policy: Dict
+    run_usage: Dict
+    route: str
+    route_reason: str
+    policy_stats: Dict
+
+
+INITIAL_REFLECTION = "This is the first iteration, so the goal is to establish a baseline improvement based on the initial plan."
+
+
+def create_initial_state(initial_prompt: str, goal: str, run_id: str = "",
+                         stop_policy: Optional[Dict] = None) -> AgentState:
+    """Builds the starting state for a single refinement job.
+
+    Every run gets an id, a random one unless `run_id` is given: LLM usage is attributed to runs by id, which
+    the routing policy's budgets rely on, and when the graph has a journal, the run is journaled under it.
+    `stop_policy` overrides the graph's routing policy settings for this run, e.g. `{"token_budget": 20000}`.
+    """
+    return {
+        "initial_prompt": initial_prompt,
+        "goal": goal,
+        "decomposed_criteria": [],
+        "high_level_plan": "",
+        "prompt_history": PromptHistory(),
+        "candidates": [],
+        "current_reflection": INITIAL_REFLECTION,
+        "final_prompt": "",
+        "iteration_count": 0,
+        "beam": [],
+        "run_id": run_id or uuid.uuid4().hex,
+        "stop_policy": dict(stop_policy or {}),
+        "run_usage": {"llm_calls": 0, "tokens": 0, "elapsed_s": 0.0},
+        "policy_stats": {},
+    }
+
+
+def find_best_prompt(prompt_history: Optional[PromptHistory],
+                     candidates: Optional[List[Attempt]] = None) -> Tuple[str, float]:
+    """Returns the highest-scoring prompt in the history and its total score.
+
+    Falls back to the last generated prompt (with a score of -1) when no attempt has been evaluated.
+    """
+    best = prompt_history.best if prompt_history else None
+    if best is not None:
+        return best.prompt_text, best.total_score
+    if candidates:
+        return candidates[-1].prompt_text, -1
+    if prompt_history:
+        return prompt_history[-1].prompt_text, -1
+    return "", -1
@@ -0,0 +1,202 @@
+import json
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, IO, Iterator, List, Optional
+
+from state import AgentState, Attempt, append_attempts
+
+# Route taken by decide_next_step, keyed by the node that runs next
+_ROUTE_BY_NEXT_NODE = {"generate_prompt": "CONTINUE_PROBING", "formulate_strategy": "REVISE_STRATEGY"}
+
+
+class BestSoFar:
+    """Tracks the highest-scoring evaluated prompt incrementally, by the same total score as `find_best_prompt`."""
+
+    def __init__(self):
+        self.prompt_text: Optional[str] = None
+        self.total_score = -1
+        self.average_score = 0.0
+        self.iteration: Optional[int] = None
+
+    def offer(self, attempt: Attempt) -> bool:
+        """Considers one evaluated attempt and returns whether it became the new best."""
+        if attempt.total_score <= self.total_score:
+            return False
+        self.prompt_text = attempt.prompt_text
+        self.total_score = attempt.total_score
+        self.average_score = round(attempt.average_score, 3)
+        self.iteration = attempt.iteration
+        return True
+
+    def as_dict(self) -> Dict:
+        """Returns the best prompt and its scores."""
+        return {"prompt_text": self.prompt_text, "total_score": self.total_score,
+                "average_score": self.average_score, "iteration": self.iteration}
+
+
+class RunStream:
+    """Runs the graph with streaming and turns node activity into structured events.
+
+    Events are dicts with an `event` key: run_started, node_started, node_finished, candidate, scores, best,
+    route and run_finished. Each is yielded and, when given, passed to `on_event`. The best prompt so far is
+    kept up to date as scores arrive. A run stops early once `stop_when(best)` returns true or `cancel` is
+    called, after the node in progress finishes, or when the consumer stops iterating; `state` then holds
+    everything completed up to that point.
+    """
+
+    def __init__(self, graph, on_event: Optional[Callable[[Dict], None]] = None,
+                 stop_when: Optional[Callable[[BestSoFar], bool]] = None):
+        self.app = graph.compile_graph()
+        self.on_event = on_event
+        self.stop_when = stop_when
+        self.best = BestSoFar()
+        self.state: Optional[AgentState] = None
+        self.status = "pending"
+        self._cancelled = threading.Event()
+        self._started: Dict[str, float] = {}
+        self._last_node: Optional[str] = None
+
+    def _start(self, initial_state: AgentState) -> List[Dict]:
+        """Resets the stream for a new run."""
+        self.best = BestSoFar()
+        self.state = dict(initial_state)
+        self.status = "running"
+        self._cancelled.clear()
+        self._started.clear()
+        self._last_node = None
+        history = self.state.get("prompt_history")
+        if history and history.best is not None:
+            self.best.offer(history.best)
+        return [self._emit("run_started", resume_node=self.state.get("resume_node") or "decompose_goal")]
+
+    def cancel(self):
+        """Asks the run to stop after the node in progress; safe to call from any thread."""
+        self._cancelled.set()
+
+    def _emit(self, event: str, **fields) -> Dict:
+        """Builds an event and hands it to the callback."""
+        payload = {"event": event, "run_id": (self.state or {}).get("run_id", ""), "ts": round(time.time(), 3),
+                   **fields}
+        if self.on_event is not None:
+            self.on_event(payload)
+        return payload
+
+    def _events_for(self, chunk: Dict) -> List[Dict]:
+        """Converts one `tasks` stream chunk into events, updating the accumulated state."""
+        node = chunk["name"]
+        events = []
+        if "input" in chunk:
+            if self._last_node == "decide_next_step" and node in _ROUTE_BY_NEXT_NODE:
+                events.append(self._emit("route", decision=_ROUTE_BY_NEXT_NODE[node],
+                                         reason=self.state.get("route_reason", "")))
+            self._started[node] = time.perf_counter()
+            events.append(self._emit("node_started", node=node))
+            return events
+
+        self._last_node = node
+        elapsed = time.perf_counter() - self._started.pop(node, time.perf_counter())
+        if chunk.get("error") is not None:
+            events.append(self._emit("node_finished", node=node, elapsed_s=round(elapsed, 3),
+                                     error=f"{type(chunk['error']).__name__}: {chunk['error']}"))
+            return events
+        update = dict(chunk.get("result") or {})
+        offset = len(self.state.get("prompt_history") or ())
+        new_attempts = update.pop("prompt_history", None)
+        self.state.update(update)
+        if new_attempts is not None:
+            self.state["prompt_history"] = append_attempts(self.state.get("prompt_history"), new_attempts)
+        events.append(self._emit("node_finished", node=node, elapsed_s=round(elapsed, 3)))
+
+        # Candidates are indexed by the history position they will take once evaluated
+        for index, attempt in enumerate(update.get("candidates") or [], start=offset):
+            events.append(self._emit("candidate", index=index, iteration=attempt.iteration,
+                                     prompt_text=attempt.prompt_text, reasoning=attempt.reasoning))
+        history = self.state.get("prompt_history")
+        if new_attempts is not None and history is not None:
+            start = 0 if new_attempts is history else offset
+            for index in range(start, len(history)):
+                attempt = history[index]
+                sampling = {}
+                if attempt.samples > 1:
+                    sampling = {"samples": attempt.samples, "average_ci": round(attempt.average_ci, 3)}
+                events.append(self._emit("scores", index=index, iteration=attempt.iteration,
+                                         average_score=round(attempt.average_score, 3),
+                                         scores=attempt.scores_by_criterion(), **sampling))
+                if self.best.offer(attempt):
+                    events.append(self._emit("best", **self.best.as_dict()))
+        return events
+
+    def _should_stop(self) -> bool:
+        """Returns whether the caller asked to stop, directly or through `stop_when`."""
+        if not self._cancelled.is_set() and self.stop_when is not None and self.best.prompt_text is not None:
+            if self.stop_when(self.best):
+                self._cancelled.set()
+        return self._cancelled.is_set()
+
+    def _finish(self, status: str) -> List[Dict]:
+        """Records the outcome of the run."""
+        self.status = status
+        events = []
+        if status == "finished" and self._last_node == "decide_next_step":
+            events.append(self._emit("route", decision="FINISH", reason=self.state.get("route_reason", "")))
+        events.append(self._emit("run_finished", status=status, iterations=self.state.get("iteration_count", 0),
+                                 best=self.best.as_dict()))
+        return events
+
+    def events(self, initial_state: AgentState) -> Iterator[Dict]:
+        """Runs the graph and yields its events as they happen."""
+        yield from self._start(initial_state)
+        stream = self.app.stream(initial_state, stream_mode="tasks")
+        try:
+            for chunk in stream:
+                yield from self._events_for(chunk)
+                if "input" not in chunk and self._should_stop():
+                    yield from self._finish("cancelled")
+                    return
+        except GeneratorExit:
+            # The consumer stopped iterating, which cancels the run just like `cancel`
+            self.status = "cancelled"
+            raise
+        except BaseException:
+            self.status = "failed"
+            raise
+        finally:
+            stream.close()
+        yield from self._finish("finished")
+
+    async def aevents(self, initial_state: AgentState) -> AsyncIterator[Dict]:
+        """Async variant of `events`, built on the graph's `astream`."""
+        for event in self._start(initial_state):
+            yield event
+        stream = self.app.astream(initial_state, stream_mode="tasks")
+        try:
+            async for chunk in stream:
+                for event in self._events_for(chunk):
+                    yield event
+                if "input" not in chunk and self._should_stop():
+                    for event in self._finish("cancelled"):
+                        yield event
+                    return
+        except GeneratorExit:
+            self.status = "cancelled"
+            raise
+        except BaseException:
+            self.status = "failed"
+            raise
+        finally:
+            await stream.aclose()
+        for event in self._finish("finished"):
+            yield event
+
+
+class JsonlSink:
+    """An `on_event` callback that writes each event as one JSON line and flushes it immediately."""
+
+    def __init__(self, stream: IO[str]):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Dict):
+        with self._lock:
+            self.stream.write(json.dumps(event) + "\n")
+            self.stream.flush()
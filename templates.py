@@ -0,0 +1,319 @@
+import hashlib
+import string
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from compaction import estimate_tokens
+
+
+class RenderedPrompt:
+    """A rendered node prompt: the template's static prefix followed by its per-call dynamic suffix."""
+
+    __slots__ = ("template", "static", "dynamic")
+
+    def __init__(self, template: "PromptTemplate", dynamic: str):
+        self.template = template
+        self.static = template.static
+        self.dynamic = dynamic
+
+    @property
+    def text(self) -> str:
+        """The full prompt as sent to a model without a context cache."""
+        return self.static + self.dynamic
+
+    @property
+    def cache_text(self) -> str:
+        """Identifies the prompt for the response cache without rehashing the static prefix on every call."""
+        return f"{self.template.name}@{self.template.fingerprint}\n{self.dynamic}"
+
+    def __str__(self) -> str:
+        return self.text
+
+
+class PromptTemplate:
+    """A node prompt split into a static prefix, identical for every call, and a dynamic suffix.
+
+    Keeping every per-call value in the suffix gives all calls of a node a byte-identical prefix, which
+    providers can serve from their prefix/context caches. The suffix is parsed once, when the template is
+    created, and rendered by joining its literal parts with the values.
+    """
+
+    def __init__(self, name: str, static: str, dynamic: str):
+        self.name = name
+        self.static = static
+        self.dynamic = dynamic
+        self.fingerprint = hashlib.sha256(f"{static}\0{dynamic}".encode("utf-8")).hexdigest()[:16]
+        self.static_tokens = estimate_tokens(static)
+        self._parts: List[Tuple[str, Optional[str]]] = [
+            (literal, field) for literal, field, _, _ in string.Formatter().parse(dynamic)
+        ]
+
+    def render(self, **values) -> RenderedPrompt:
+        """Fills the dynamic suffix with `values`."""
+        return RenderedPrompt(self, "".join(
+            literal + (str(values[field]) if field is not None else "") for literal, field in self._parts))
+
+
+# Fragments of provider errors that mean a referenced context cache no longer exists, e.g. after its TTL
+_MISSING_CACHE_MARKERS = ("cachedcontent", "cached content", "cached_content")
+
+
+def is_missing_context_cache_error(exc: BaseException) -> bool:
+    """Returns whether a failed call referenced a context cache the provider no longer has."""
+    message = str(exc).lower()
+    return any(marker in message for marker in _MISSING_CACHE_MARKERS) and \
+        any(marker in message for marker in ("not found", "404", "expired", "permission denied", "403"))
+
+
+class ContextCacheRegistry:
+    """Provider context-cache handles for the static prefixes of templates.
+
+    `create_handle(model_name, template)` uploads a template's static prefix to the provider's context cache
+    and returns the handle to reference it by (for Gemini, the `cachedContents/...` name), or None if the
+    prefix should not be cached. Handles are created once per model and template version and reused
+    afterwards. With a `ttl_s`, the lifetime the provider keeps the caches for, a handle is recreated
+    `refresh_before_s` seconds before it expires; a handle the provider has dropped earlier can be
+    `invalidate`d. Providers only accept cached contents above a minimum size, so templates with fewer than
+    `min_tokens` estimated static tokens are never offered.
+    """
+
+    def __init__(self, create_handle: Callable[[str, PromptTemplate], Optional[str]], min_tokens: int = 0,
+                 ttl_s: Optional[float] = None, refresh_before_s: float = 60.0):
+        self.create_handle = create_handle
+        self.min_tokens = min_tokens
+        self.ttl_s = ttl_s
+        self.refresh_before_s = min(refresh_before_s, ttl_s / 2) if ttl_s else refresh_before_s
+        self._lock = threading.Lock()
+        # (model, template fingerprint) -> (handle, monotonic time after which it must not be used)
+        self._handles: Dict[Tuple[str, str], Tuple[Optional[str], Optional[float]]] = {}
+        # Held while a key's handle is created, so concurrent callers of other keys are never blocked by it
+        self._creation_locks: Dict[Tuple[str, str], threading.Lock] = {}
+
+    def _current(self, key: Tuple[str, str]) -> Tuple[Optional[str], bool]:
+        """Returns the key's handle and whether it is still usable; must be called with the lock held."""
+        handle, expires_at = self._handles.get(key, (None, 0.0))
+        return handle, expires_at is None or time.monotonic() < expires_at
+
+    def handle(self, model_name: str, template: PromptTemplate) -> Optional[str]:
+        """Returns the context-cache handle for a template's static prefix on `model_name`, if any."""
+        if template.static_tokens < self.min_tokens:
+            return None
+        key = (model_name, template.fingerprint)
+        with self._lock:
+            handle, usable = self._current(key)
+            if usable:
+                return handle
+            creation_lock = self._creation_locks.setdefault(key, threading.Lock())
+        with creation_lock:
+            with self._lock:
+                # Another caller may have created the handle while this one waited
+                handle, usable = self._current(key)
+            if usable:
+                return handle
+            try:
+                handle = self.create_handle(model_name, template)
+            except Exception as e:
+                print(f"Could not create a context cache for template '{template.name}': {e}")
+                handle = None
+            expires_at = None
+            if handle and self.ttl_s:
+                expires_at = time.monotonic() + self.ttl_s - self.refresh_before_s
+            with self._lock:
+                self._handles[key] = (handle, expires_at)
+            return handle
+
+    def invalidate(self, model_name: str, template: PromptTemplate, handle: str):
+        """Drops a handle the provider no longer knows, so the next call creates a new one."""
+        key = (model_name, template.fingerprint)
+        with self._lock:
+            if self._handles.get(key, (None, None))[0] == handle:
+                del self._handles[key]
+
+
+DECOMPOSE_GOAL = PromptTemplate(
+    "decompose_goal",
+    static="""**Role:** You are a meticulous requirements analyst and prompt engineering expert. Your task is to decompose a user's high-level, often vague, goal for a prompt into a set of specific, orthogonal, and actionable criteria. These criteria will be used to objectively evaluate future versions of the prompt.
+
+**Task:**
+1.  **Analyze the Goal:** Deeply analyze the user's goal. Identify the core intent and the key qualities the user is seeking in the final prompt's output. Consider aspects like tone, structure, persona, constraints, and desired output format.
+2.  **Decompose into Criteria:** Break down the goal into 3-5 distinct, measurable criteria. Each criterion should be a concise statement describing a specific quality or characteristic.
+3.  **Ensure Actionability:** Each criterion must be something that can be reasonably judged or measured when comparing two prompts. Avoid vague terms like "make it better." Instead, use precise language like "Increase the use of sensory details," "Adopt a more formal and academic tone," or "Ensure the output is structured as a JSON object with 'name' and 'description' keys."
+
+**Example:**
+- **User Goal:** "I want a prompt for a marketing copywriter that is more creative and engaging."
+- **Your Decomposed Criteria Output (as JSON):**
+  ```json
+  {
+    "criteria": [
+      "Evoke a sense of urgency in the target audience.",
+      "Incorporate at least two power words related to exclusivity.",
+      "Use a conversational and slightly humorous tone.",
+      "End with a clear and compelling call-to-action."
+    ]
+  }
+  ```
+
+**Instructions:**
+- Generate ONLY the list of criteria.
+- Your output must be a single, valid JSON object that strictly adheres to the following Pydantic schema:
+  `class DecomposedGoal(BaseModel): criteria: List[str]`
+""",
+    dynamic="""
+**Context:**
+- The user wants to improve an initial prompt.{past_runs}
+
+**User Goal to Decompose:**
+"{goal}"
+""",
+)
+
+FORMULATE_STRATEGY = PromptTemplate(
+    "formulate_strategy",
+    static="""**Role:** You are an expert AI strategist and master prompt engineer. Your task is to devise a high-level, ordered plan to improve a given prompt based on a set of specific criteria. If this is a revision, you must learn from past failures.
+
+**Task:**
+1.  **Analyze the Gap:** Compare the Initial Prompt with the Improvement Criteria. Identify the biggest gaps and areas for improvement. If a history of past attempts exists, analyze why the previous strategy failed. The last entry in the history contains the most relevant feedback.
+2.  **Formulate a Strategy:** Create a logical, step-by-step plan to address these gaps. The plan should be a sequence of general approaches. Think about the order of operations. It might be best to fix the structure first, then the tone, then the specific details. If revising a failed strategy, explicitly state a *new* approach.
+3.  **Output the Plan:** Write the plan as a concise, multi-line string, formatted as a numbered list.
+
+**Example (First Pass):**
+- **Initial Prompt:** "Write about our new shoes."
+- **Improvement Criteria:**
+- **Your Formulated Plan Output (as JSON):**
+  ```json
+  {
+    "plan": "1. First, I will rewrite the prompt to explicitly establish the persona of a professional athlete.\\n2. Second, I will add specific instructions to focus on the 'ultralight foam' technology and its benefits.\\n3. Finally, I will adjust the language to be more energetic and use slang appropriate for a young, active audience."
+  }
+  ```
+
+**Instructions:**
+- Generate ONLY the plan string.
+- Your output must be a single, valid JSON object that strictly adheres to the following Pydantic schema:
+  `class ImprovementPlan(BaseModel): plan: str`
+""",
+    dynamic="""
+**Your Task:**
+- Initial Prompt: "{initial_prompt}"
+- Improvement Criteria: {criteria}
+- History of Past Attempts (if any): "{history_context}"{past_runs}
+""",
+)
+
+GENERATE_PROMPT = PromptTemplate(
+    "generate_prompt",
+    static="""**Role:** You are a creative and meticulous prompt engineer executing one step of a larger plan. Your task is to generate a single, new version of a prompt that attempts to improve upon the previous version, guided by a high-level plan and specific reflections from the last attempt.
+
+**Task:**
+1.  **Synthesize Context:** Review the entire context. Understand the main goal, what has been tried, and what the most recent analysis concluded.
+2.  **Formulate a Thought (Reasoning):** Based on the `current_reflection`, decide on the *single most impactful change* you can make to the most recent prompt. This could be rephrasing a sentence, adding a constraint, changing the persona, or adding an example. State this thought process clearly and concisely. This will be your `reasoning`.
+3.  **Generate the New Prompt:** Write the complete text of the new, improved prompt. Do not just write the changed part; provide the full prompt from beginning to end.
+
+**Instructions:**
+- Your output must be a single, valid JSON object that strictly adheres to the following Pydantic schema:
+  `class GeneratedPrompt(BaseModel): prompt_text: str; reasoning: str`
+- The `reasoning` field should contain your thought process for this specific iteration.
+- The `prompt_text` field should contain the full text of the newly generated prompt.
+""",
+    dynamic="""
+**Context:**
+- The overall strategic plan is: "{plan}"
+- {base_prompt_context}
+- The key takeaway from the last evaluation (your primary focus for this iteration) is: "{reflection}"
+
+**Perform your task now based on the provided context.**
+""",
+)
+
+EVALUATE_PROMPT = PromptTemplate(
+    "evaluate_prompt",
+    static="""**Role:** You are a hyper-critical and objective AI prompt evaluator. Your task is to score a new prompt against a set of predefined criteria and provide a detailed justification for your scores. You must be impartial, rigorous, and analytical.
+
+**Task:**
+1.  **Evaluate Against Each Criterion:** For each individual criterion in the list, perform the following:
+    a.  Carefully assess how well the `new_prompt_text` satisfies that specific criterion.
+    b.  Assign a score from 1 (fails completely) to 10 (perfectly satisfies). A score of 5 means it partially addresses the criterion but has significant room for improvement.
+    c.  Write a brief, one-sentence justification for your score, citing specific evidence from the prompt text or noting its absence.
+2.  **Provide Holistic Feedback:** After scoring all criteria, write a short paragraph of overall qualitative feedback. Summarize the prompt's main strengths and weaknesses. Point out any unintended side effects of the changes and suggest the most important area for the next improvement.
+
+**Instructions:**
+- Your output must be a single, valid JSON object that strictly adheres to the following Pydantic schema:
+  `class CriterionScore(BaseModel): criterion: str; score: int; justification: str`
+  `class EvaluationResult(BaseModel): scores: List; qualitative_feedback: str`
+- Be strict and consistent in your scoring. Do not give high scores easily. Your justification is more important than the score itself.
+""",
+    dynamic="""
+**Context:**
+- The new prompt to be evaluated is: "{prompt_text}"
+- The evaluation criteria are: {criteria}
+
+**Perform your evaluation now.**
+""",
+)
+
+EVALUATE_PROMPT_BATCH = PromptTemplate(
+    "evaluate_prompt_batch",
+    static="""**Role:** You are a hyper-critical and objective AI prompt evaluator. Your task is to score several independent prompts, each against its own set of predefined criteria, and provide a detailed justification for your scores. You must be impartial, rigorous, and analytical.
+
+**Task:**
+For each item below, independently of the other items:
+1.  **Evaluate Against Each Criterion:** For each individual criterion in the item's list, perform the following:
+    a.  Carefully assess how well the item's prompt satisfies that specific criterion.
+    b.  Assign a score from 1 (fails completely) to 10 (perfectly satisfies). A score of 5 means it partially addresses the criterion but has significant room for improvement.
+    c.  Write a brief, one-sentence justification for your score, citing specific evidence from the prompt text or noting its absence.
+2.  **Provide Holistic Feedback:** After scoring all of the item's criteria, write a short paragraph of overall qualitative feedback. Summarize the prompt's main strengths and weaknesses. Point out any unintended side effects and suggest the most important area for the next improvement.
+
+**Instructions:**
+- Your output must be a single, valid JSON object that strictly adheres to the following Pydantic schema:
+  `class CriterionScore(BaseModel): criterion: str; score: int; justification: str`
+  `class EvaluationResult(BaseModel): scores: List; qualitative_feedback: str`
+  `class BatchEvaluationItem(BaseModel): item_id: int; evaluation: EvaluationResult`
+  `class BatchEvaluationResult(BaseModel): results: List`
+- Return exactly one result per item, with its `item_id` copied from the item's header, and one score per criterion of that item, in order.
+- Be strict and consistent in your scoring. Do not give high scores easily. Your justification is more important than the score itself.
+""",
+    dynamic="""
+**Items:**
+
+{items}
+
+**Perform your evaluation now.**
+""",
+)
+
+SYNTHESIZE_REFLECTION = PromptTemplate(
+    "synthesize_reflection",
+    static="""**Role:** You are a master strategist and learning algorithm. Your task is to analyze an evaluation report and synthesize a single, powerful insight that will guide the next action. You are performing the "Orient" step of the OODA loop.
+
+**Task:**
+1.  **Analyze the Data:** Look at the scores (especially the lowest ones) and the qualitative feedback.
+2.  **Identify the Core Pattern:** What is the most important story the data is telling? Did one change improve some criteria but hurt others? Was the main change ineffective? What is the root cause of the lowest scores?
+3.  **Synthesize a Reflection:** Distill your analysis into a single, concise, and actionable sentence. This reflection should state what was learned and clearly imply what should be done differently in the next iteration. It must be a directive for the `PromptGenerator`.
+
+**Example:**
+- **Evaluation Result:** Scores for 'clarity' went up to 8, but scores for 'creativity' went down to 3. Feedback mentions the prompt is now "too rigid and formulaic."
+- **Your Synthesized Reflection (as JSON):**
+  ```json
+  {
+    "summary": "The attempt to add structure made the prompt too restrictive, stifling creativity; the next iteration must introduce more flexibility, perhaps by adding an 'out-of-the-box ideas' section, while maintaining the new-found clarity."
+  }
+  ```
+
+**Instructions:**
+- Generate ONLY the summary string.
+- Your output must be a single, valid JSON object that strictly adheres to the following Pydantic schema:
+  `class Reflection(BaseModel): summary: str`
+""",
+    dynamic="""
+**Context:**
+- The most recent prompt was just evaluated. The results are: "{evaluation_result}"
+
+**Perform your synthesis now.**
+""",
+)
+
+# Every node prompt, by template name
+TEMPLATES: Dict[str, PromptTemplate] = {template.name: template for template in (
+    DECOMPOSE_GOAL, FORMULATE_STRATEGY, GENERATE_PROMPT, EVALUATE_PROMPT, EVALUATE_PROMPT_BATCH,
+    SYNTHESIZE_REFLECTION,
+)}
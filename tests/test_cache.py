@@ -0,0 +1,95 @@
+import time
+
+import cache as cache_module
+from cache import ResponseCache
+from routing import ModelRouter
+from state import DecomposedGoal, ImprovementPlan
+from templates import DECOMPOSE_GOAL
+from tools import P3RO_Agent_Tools
+
+
+def _key(prompt: str, model: str = "fast") -> str:
+    return ResponseCache.make_key(model, 0.0, ImprovementPlan, prompt)
+
+
+def _plan(text: str) -> ImprovementPlan:
+    return ImprovementPlan(plan=text)
+
+
+def test_make_key_covers_every_input():
+    keys = {_key("p"), _key("q"), _key("p", model="strong"), ResponseCache.make_key("fast", 1.0, ImprovementPlan, "p"),
+            ResponseCache.make_key("fast", 0.0, DecomposedGoal, "p")}
+    assert len(keys) == 5 and _key("p") == _key("p")
+
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = ResponseCache(max_memory_entries=2)
+    cache.put(_key("a"), _plan("a"))
+    cache.put(_key("b"), _plan("b"))
+    assert cache.get(_key("a"), ImprovementPlan).plan == "a"
+    cache.put(_key("c"), _plan("c"))
+    assert cache.get(_key("b"), ImprovementPlan) is None
+    assert [cache.get(_key(k), ImprovementPlan).plan for k in "ac"] == ["a", "c"]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (3, 1, 1) and stats["hit_rate"] == 0.75
+
+
+def test_sqlite_tier_survives_restart(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    cache = ResponseCache(db_path)
+    cache.put(_key("a"), _plan("a"))
+    cache.close()
+    reopened = ResponseCache(db_path)
+    assert reopened.get(_key("a"), ImprovementPlan) == _plan("a")
+    assert reopened.get(_key("a"), ImprovementPlan) == _plan("a")
+    stats = reopened.stats()
+    assert (stats["disk_hits"], stats["memory_hits"]) == (1, 1)
+
+
+def test_sqlite_tier_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"), max_memory_entries=1, max_disk_entries=2)
+    cache.put(_key("a"), _plan("a"))
+    time.sleep(0.01)
+    cache.put(_key("b"), _plan("b"))
+    time.sleep(0.01)
+    cache.put(_key("c"), _plan("c"))
+    assert cache.get(_key("a"), ImprovementPlan) is None
+    assert cache.get(_key("b"), ImprovementPlan).plan == "b"
+
+
+def test_entries_expire_in_both_tiers(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, "time", lambda: now[0])
+    cache = ResponseCache(str(tmp_path / "cache.db"), ttl_seconds=10)
+    cache.put(_key("a"), _plan("a"))
+    cache.put(_key("b"), _plan("b"))
+    now[0] += 5
+    assert cache.get(_key("a"), ImprovementPlan).plan == "a"
+    now[0] += 10
+    assert cache.get(_key("a"), ImprovementPlan) is None
+    # Only the entry that was never read again is still on disk
+    assert cache.purge_expired() == 1
+    assert cache.get(_key("b"), ImprovementPlan) is None
+
+
+class _BrokenModel:
+    """A model whose every call fails, so its node escalates."""
+
+    def with_structured_output(self, schema, include_raw=False):
+        return self
+
+    def invoke(self, prompt):
+        raise ValueError("permission denied")
+
+
+def test_escalated_response_is_cached_under_the_escalation_model():
+    cache = ResponseCache()
+    router = ModelRouter("fast", escalation_model="strong", escalate_nodes=("decompose_goal",))
+    tools = P3RO_Agent_Tools(backend="fake", cache=cache, model_router=router, models={"fast": _BrokenModel()})
+    prompt = DECOMPOSE_GOAL.render(goal="Make it exciting.", past_runs="")
+    response = tools._invoke_llm_for_json(prompt, DecomposedGoal, node="decompose_goal")
+    assert response is not None
+    key = lambda model: ResponseCache.make_key(model, tools.temperature, DecomposedGoal, prompt.cache_text)
+    assert cache.get(key("fast"), DecomposedGoal) is None
+    assert cache.get(key("strong"), DecomposedGoal) == response
+
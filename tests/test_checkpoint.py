@@ -0,0 +1,111 @@
+import sqlite3
+
+import pytest
+
+from agents import P3RO_Graph
+from checkpoint import RunJournal
+from policy import FixedPolicy
+from state import Attempt, PromptHistory, create_initial_state
+
+
+def _graph(journal: RunJournal) -> P3RO_Graph:
+    return P3RO_Graph(journal=journal, backend="fake", policy=FixedPolicy(max_iterations=2))
+
+
+def _initial_state(run_id: str):
+    return create_initial_state("Write a tweet.", "Make it exciting.", run_id=run_id)
+
+
+def test_new_run_with_journaled_id_is_rejected(tmp_path):
+    db_path = str(tmp_path / "runs.db")
+    first = RunJournal(db_path)
+    _graph(first).compile_graph().invoke(_initial_state("r1"))
+    first.finish_run("r1")
+    steps = len(list(first.replay("r1")))
+    # A new process, or the same one after the run finished or failed, starting over under the same id
+    for journal in (RunJournal(db_path), first):
+        with pytest.raises(ValueError, match="already holds a run"):
+            _graph(journal).compile_graph().invoke(_initial_state("r1"))
+    assert len(list(first.replay("r1"))) == steps
+
+
+def test_resume_in_new_process_continues_step_numbering(tmp_path):
+    db_path = str(tmp_path / "runs.db")
+    first = RunJournal(db_path)
+    graph = _graph(first)
+    state = _initial_state("r1")
+    # A process that crashed right after the first node
+    first.start_run("r1", state)
+    first.record_step("r1", "decompose_goal", graph.tools.decompose_goal(state))
+    first.finish_run("r1", status="failed")
+
+    second = RunJournal(db_path)
+    resumed = _graph(second).resume_state("r1")
+    assert resumed["resume_node"] == "formulate_strategy"
+    final_state = _graph(second).compile_graph().invoke(resumed)
+    nodes = [node for node, _ in second.replay("r1")]
+    assert nodes[:3] == ["decompose_goal", "formulate_strategy", "generate_prompt"]
+    assert nodes[-1] == "decide_next_step" and final_state["iteration_count"] == 2
+
+
+def _attempt(iteration: int, score: int) -> Attempt:
+    return Attempt(f"prompt {iteration}", iteration=iteration).with_evaluation(
+        {"scores": [{"criterion": "c", "score": score, "justification": ""}], "qualitative_feedback": ""})
+
+
+def test_replay_applies_append_and_replace_deltas(tmp_path):
+    journal = RunJournal(str(tmp_path / "runs.db"))
+    journal.start_run("r1", _initial_state("r1"))
+    journal.record_step("r1", "evaluate_prompt", {"prompt_history": [_attempt(0, 5)], "candidates": [_attempt(0, 5)]})
+    journal.record_step("r1", "evaluate_prompt", {"prompt_history": [_attempt(1, 7), _attempt(1, 6)]})
+    journal.record_step("r1", "decide_next_step", {"iteration_count": 2, "route": "REVISE_STRATEGY"})
+    journal.record_step("r1", "resume", {"prompt_history": PromptHistory([_attempt(0, 9)])})
+
+    states = [(node, state["prompt_history"], state.get("route")) for node, state in journal.replay("r1")]
+    assert [node for node, _, _ in states] == ["evaluate_prompt", "evaluate_prompt", "decide_next_step", "resume"]
+    # Each yielded history keeps its length although later steps extend or replace it
+    assert [len(history) for _, history, _ in states] == [1, 3, 3, 1]
+    assert states[1][1].best.average_score == 7 and states[3][1].best.average_score == 9
+    assert states[2][2] == "REVISE_STRATEGY"
+    state, last_node = journal.load("r1")
+    assert last_node == "resume" and state["iteration_count"] == 2
+    assert isinstance(state["candidates"][0], Attempt) and state["candidates"][0].average_score == 5
+
+
+def test_load_without_steps_returns_the_initial_state(tmp_path):
+    journal = RunJournal(str(tmp_path / "runs.db"))
+    journal.start_run("r1", _initial_state("r1"))
+    state, last_node = journal.load("r1")
+    assert last_node is None and state["goal"] == "Make it exciting." and len(state["prompt_history"]) == 0
+    assert _graph(journal).resume_state("r1")["resume_node"] == "decompose_goal"
+    with pytest.raises(KeyError):
+        journal.load("unknown")
+
+
+def _summary(state):
+    return (state["iteration_count"], [attempt.to_dict() for attempt in state["prompt_history"]],
+            state["final_prompt"], state["route"])
+
+
+def test_resume_after_every_node_reaches_the_same_result(tmp_path):
+    db_path = str(tmp_path / "runs.db")
+    journal = RunJournal(db_path)
+    expected = _summary(_graph(journal).compile_graph().invoke(_initial_state("r1")))
+    journal.finish_run("r1")
+    nodes = [node for node, _ in journal.replay("r1")]
+    assert _graph(journal).resume_state("r1") is None
+
+    for completed in range(len(nodes) - 1):
+        # A copy of the run as it was when the process crashed after `completed` nodes
+        crashed_path = str(tmp_path / f"crashed-{completed}.db")
+        with sqlite3.connect(db_path) as source, sqlite3.connect(crashed_path) as target:
+            source.backup(target)
+            target.execute("DELETE FROM steps WHERE seq >= ?", (completed,))
+            target.execute("UPDATE runs SET status = 'failed'")
+        crashed = RunJournal(crashed_path)
+        graph = _graph(crashed)
+        state = graph.resume_state("r1")
+        assert state["resume_node"] == nodes[completed]
+        assert _summary(graph.compile_graph().invoke(state)) == expected
+        assert [node for node, _ in crashed.replay("r1")] == nodes
+        crashed.close()
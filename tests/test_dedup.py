@@ -0,0 +1,93 @@
+import pytest
+
+from dedup import EvaluationIndex, normalize_prompt
+
+CRITERIA = ["Be short.", "Be loud."]
+# A 40-word prompt; appending one word keeps 38 of its 39 word trigrams
+BASE = " ".join(f"word{i}" for i in range(40))
+
+
+def _estimated_similarity(index: EvaluationIndex, a: str, b: str) -> float:
+    first, second = index._signature(normalize_prompt(a)), index._signature(normalize_prompt(b))
+    return sum(x == y for x, y in zip(first, second)) / index.num_perm
+
+
+def test_normalize_prompt():
+    assert normalize_prompt("  Write a TWEET,\n about  SyncFlow! ") == "write a tweet about syncflow"
+
+
+def test_exact_match_ignores_case_punctuation_and_whitespace():
+    index = EvaluationIndex()
+    index.add("run", CRITERIA, "Write a tweet about SyncFlow.", {"score": 1})
+    assert index.lookup("run", CRITERIA, "write a tweet   about syncflow!") == ("exact", {"score": 1})
+    assert index.stats()["exact_hits"] == 1
+
+
+def test_near_match_respects_threshold():
+    index = EvaluationIndex(threshold=0.9)
+    index.add("run", CRITERIA, BASE, {"score": 1})
+    appended, replaced = BASE + " extra", BASE.replace("word20", "changed")
+    assert _estimated_similarity(index, BASE, appended) >= 0.9
+    assert index.lookup("run", CRITERIA, appended) == ("near", {"score": 1})
+    # One replaced word changes three trigrams: similar, but below the threshold
+    assert 0.8 < _estimated_similarity(index, BASE, replaced) < 0.9
+    assert index.lookup("run", CRITERIA, replaced) is None
+    lenient = EvaluationIndex(threshold=0.8)
+    lenient.add("run", CRITERIA, BASE, {"score": 1})
+    assert lenient.lookup("run", CRITERIA, replaced) == ("near", {"score": 1})
+
+
+def test_unrelated_prompt_does_not_match():
+    index = EvaluationIndex(threshold=0.5)
+    index.add("run", CRITERIA, BASE, {"score": 1})
+    assert index.lookup("run", CRITERIA, " ".join(f"other{i}" for i in range(40))) is None
+
+
+def test_short_prompts():
+    index = EvaluationIndex()
+    index.add("run", CRITERIA, "Hi", {"score": 1})
+    assert index.lookup("run", CRITERIA, "hi!") == ("exact", {"score": 1})
+    assert index.lookup("run", CRITERIA, "Bye") is None
+
+
+def test_scopes_by_run_and_criteria():
+    index = EvaluationIndex()
+    index.add("a", CRITERIA, BASE, {"score": 1})
+    assert index.lookup("b", CRITERIA, BASE) is None
+    assert index.lookup("a", ["Other."], BASE) is None
+    assert index.has_scope("a", CRITERIA) and not index.has_scope("b", CRITERIA)
+
+    shared = EvaluationIndex(shared=True)
+    shared.add("a", CRITERIA, BASE, {"score": 1})
+    assert shared.lookup("b", CRITERIA, BASE) == ("exact", {"score": 1})
+
+
+def test_first_evaluation_of_a_prompt_is_kept():
+    index = EvaluationIndex()
+    index.add("run", CRITERIA, BASE, {"score": 1})
+    index.add("run", CRITERIA, BASE + ".", {"score": 2})
+    assert index.lookup("run", CRITERIA, BASE) == ("exact", {"score": 1})
+
+
+def test_evicts_oldest_entries_and_their_buckets():
+    index = EvaluationIndex(max_entries=2)
+    prompts = [" ".join(f"p{n}w{i}" for i in range(10)) for n in range(3)]
+    for n, prompt in enumerate(prompts):
+        index.add("run", CRITERIA, prompt, {"score": n})
+    assert index.lookup("run", CRITERIA, prompts[0]) is None
+    assert index.lookup("run", CRITERIA, prompts[2]) == ("exact", {"score": 2})
+    scope = index._scopes[next(iter(index._scopes))]
+    assert len(scope["signatures"]) == 2
+    assert all(keys <= set(scope["exact"]) for keys in scope["buckets"].values())
+
+
+def test_evicts_oldest_scope():
+    index = EvaluationIndex(max_scopes=1)
+    index.add("a", CRITERIA, BASE, {"score": 1})
+    index.add("b", CRITERIA, BASE, {"score": 2})
+    assert not index.has_scope("a", CRITERIA) and index.has_scope("b", CRITERIA)
+
+
+def test_bands_must_divide_permutations():
+    with pytest.raises(ValueError):
+        EvaluationIndex(num_perm=64, bands=10)
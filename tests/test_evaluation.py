@@ -0,0 +1,156 @@
+import threading
+
+import pytest
+
+from evaluation import BatchEvaluator, EvaluationConfig, SampledEvaluator, aggregate_evaluations
+from fake_llm import DEFAULT_CRITERIA, FakeChatModel
+from routing import ModelRouter
+from state import BatchEvaluationItem, BatchEvaluationResult, CriterionScore, EvaluationResult
+from tools import P3RO_Agent_Tools
+
+CRITERIA = ["Be short.", "Be loud."]
+
+
+def _evaluation(scores, criteria=CRITERIA, feedback: str = "") -> EvaluationResult:
+    return EvaluationResult(scores=[CriterionScore(criterion=c, score=s, justification="") for c, s in
+                                    zip(criteria, scores)], qualitative_feedback=feedback)
+
+
+def _batch_evaluate(respond, prompts=("a", "b")):
+    """Evaluates `prompts` concurrently in one batch answered by `respond(items)`; returns results and singles."""
+    singles = []
+
+    def evaluate_single(text, criteria):
+        singles.append(text)
+        return _evaluation([1, 1], feedback="single")
+
+    evaluator = BatchEvaluator(render_batch=lambda items: items,
+                               invoke=lambda items, weights: BatchEvaluationResult(results=respond(items)),
+                               evaluate_single=evaluate_single, batch_size=len(prompts), max_wait_s=5)
+    results = {}
+    threads = [threading.Thread(target=lambda p=p: results.update({p: evaluator.evaluate(p, CRITERIA)}))
+               for p in prompts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, sorted(singles), evaluator.stats()
+
+
+def test_batch_results_go_to_their_items():
+    results, singles, stats = _batch_evaluate(lambda items: [
+        BatchEvaluationItem(item_id=i, evaluation=_evaluation([7, 8], feedback=text)) for i, text, _ in items])
+    assert {p: r.qualitative_feedback for p, r in results.items()} == {"a": "a", "b": "b"}
+    assert singles == [] and (stats["batches"], stats["batched_items"]) == (1, 2)
+
+
+def test_batch_result_with_wrong_criteria_falls_back():
+    def respond(items):
+        wrong = {"a": ["Be loud.", "Be short."], "b": ["Be short.", "Be quiet."]}
+        return [BatchEvaluationItem(item_id=i, evaluation=_evaluation([7, 8], wrong[text])) for i, text, _ in items]
+
+    results, singles, stats = _batch_evaluate(respond)
+    assert singles == ["a", "b"] and stats["fallback_items"] == 2
+    assert all(result.qualitative_feedback == "single" for result in results.values())
+
+
+def test_batch_result_criteria_compared_ignoring_case_and_spacing():
+    results, singles, _ = _batch_evaluate(lambda items: [
+        BatchEvaluationItem(item_id=i, evaluation=_evaluation([7, 8], ["be  short.", " Be loud. "]))
+        for i, _, _ in items])
+    assert singles == [] and results["a"].scores[0].score == 7
+
+
+def test_missing_and_unknown_items_fall_back():
+    results, singles, _ = _batch_evaluate(lambda items: [
+        BatchEvaluationItem(item_id=5, evaluation=_evaluation([7, 8])),
+        BatchEvaluationItem(item_id=[i for i, text, _ in items if text == "b"][0], evaluation=_evaluation([7, 8]))])
+    assert singles == ["a"] and results["b"].scores[1].score == 8
+
+
+def test_config_rejects_batching_with_sampling():
+    assert EvaluationConfig(batch_size=4).sampled is False
+    assert EvaluationConfig(samples=3).sampled and EvaluationConfig(max_samples=4).sampled
+    for sampling in ({"samples": 3}, {"max_samples": 4}):
+        with pytest.raises(ValueError):
+            EvaluationConfig(batch_size=4, **sampling)
+
+
+def test_aggregate_single_sample_is_unchanged():
+    assert aggregate_evaluations([_evaluation([7, 8], feedback="f")]) == _evaluation([7, 8], feedback="f").dict()
+
+
+def test_aggregate_mean_and_dispersion():
+    samples = [_evaluation([6, 8], feedback="low"), _evaluation([8, 8], feedback="mid"),
+               _evaluation([10, 5], feedback="high")]
+    evaluation = aggregate_evaluations(samples)
+    assert [score["score"] for score in evaluation["scores"]] == [8, 7]
+    assert [score["sd"] for score in evaluation["scores"]] == [2.0, pytest.approx(1.732)]
+    # Averages of 7, 8 and 7.5 around an aggregated average of 7.5
+    assert evaluation["samples"] == 3 and evaluation["average_sd"] == 0.5
+    assert evaluation["qualitative_feedback"] == "high"
+
+
+def test_aggregate_median_takes_justification_of_closest_sample():
+    samples = [EvaluationResult(scores=[CriterionScore(criterion="c", score=s, justification=f"j{s}")],
+                                qualitative_feedback="") for s in (2, 7, 9)]
+    scores = aggregate_evaluations(samples, "median")["scores"]
+    assert scores == [{"criterion": "c", "score": 7, "justification": "j7", "sd": pytest.approx(3.606)}]
+
+
+def _sampled(scores, **kwargs):
+    """A sampled evaluator whose draws score every criterion with the next of `scores`, None being a failed draw."""
+    draws = iter(scores)
+
+    def draw(text, criteria):
+        score = next(draws)
+        return None if score is None else _evaluation([score, score])
+
+    return SampledEvaluator(draw=draw, run_concurrently=lambda fn, items: [fn(item) for item in items], **kwargs)
+
+
+def test_sampled_evaluator_draws_more_samples_near_a_threshold():
+    evaluator = _sampled([6, 8, 7, 7, 7, 7, 7, 7], samples=2, max_samples=8)
+    evaluation = evaluator.evaluate("p", CRITERIA, thresholds=[7.5])
+    assert evaluation["samples"] == 8 and evaluation["scores"][0]["score"] == 7
+    assert evaluator.stats()["escalations"] == 1
+    # Once the interval clears every threshold, the initial samples are enough
+    evaluator = _sampled([7, 7, 7], samples=3, max_samples=8)
+    assert evaluator.evaluate("p", CRITERIA, thresholds=[7.5])["samples"] == 3
+
+
+def test_sampled_evaluator_counts_failed_samples():
+    evaluator = _sampled([None, 6, None], samples=3)
+    assert evaluator.evaluate("p", CRITERIA)["scores"][0]["score"] == 6
+    assert _sampled([None, None], samples=2).evaluate("p", CRITERIA) is None
+    stats = evaluator.stats()
+    assert (stats["samples"], stats["failed_samples"], stats["samples_per_evaluation"]) == (1, 2, 1.0)
+
+
+def test_sampled_evaluator_rejects_invalid_settings():
+    for settings in ({"samples": 0}, {"samples": 3, "max_samples": 2}, {"samples": 1, "max_samples": 4},
+                     {"aggregate": "mode"}):
+        with pytest.raises(ValueError):
+            _sampled([], **settings)
+
+
+def _tools(stdev_threshold: float) -> P3RO_Agent_Tools:
+    model = FakeChatModel(resample=True, score_noise=3.0)
+    router = ModelRouter("fast", escalation_model="strong", sample_stdev_threshold=stdev_threshold)
+    return P3RO_Agent_Tools(model=model, model_router=router, evaluation=EvaluationConfig(samples=4))
+
+
+def test_sampled_candidate_with_agreeing_samples_keeps_the_aggregate():
+    tools = _tools(stdev_threshold=100)
+    evaluation = tools._evaluate_candidate("Write a tweet. [revision 2]", DEFAULT_CRITERIA, [])
+    assert evaluation["samples"] == 4 and all("sd" in score for score in evaluation["scores"])
+    assert tools.model_router.stats()["evaluate_prompt"]["escalations"] == 0
+
+
+def test_sampled_candidate_with_disagreeing_samples_is_escalated():
+    tools = _tools(stdev_threshold=0.1)
+    evaluation = tools._evaluate_candidate("Write a tweet. [revision 2]", DEFAULT_CRITERIA, [])
+    # The escalation model's single judgement replaces the aggregate
+    assert "samples" not in evaluation and len(evaluation["scores"]) == len(DEFAULT_CRITERIA)
+    stats = tools.model_router.stats()["evaluate_prompt"]
+    assert (stats["calls"], stats["escalations"]) == (4, 1)
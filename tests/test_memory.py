@@ -0,0 +1,51 @@
+from memory import StrategyMemory
+from state import Attempt, PromptHistory, create_initial_state
+
+GOALS = ("Make the tweet more exciting.", "Write exciting tweets about launches.", "Summarize legal contracts.",
+         "Translate support emails to German.", "Classify customer reviews by sentiment.")
+
+
+def _state(goal: str, score: int):
+    state = create_initial_state("Write something.", goal)
+    state["prompt_history"] = PromptHistory([Attempt("p").with_evaluation(
+        {"scores": [{"criterion": "c", "score": score, "justification": ""}], "qualitative_feedback": ""})])
+    return state
+
+
+def _memory(tmp_path, goals=GOALS, score=8):
+    memory = StrategyMemory(str(tmp_path / "memory.db"))
+    for i, goal in enumerate(goals):
+        memory.record(f"run-{i}", _state(goal, score))
+    return memory
+
+
+def test_similar_matches_terms_shared_by_past_goals(tmp_path):
+    memory = _memory(tmp_path)
+    runs = memory.similar("Make the tweets more exciting")
+    assert [run["run_id"] for run in runs] == ["run-1", "run-0"]
+    assert runs[1]["trajectory"] == [8.0] and runs[1]["best_score"] == 8.0
+    assert [run["run_id"] for run in memory.similar("Make the tweets more exciting", exclude_run_id="run-0")] \
+        == ["run-1"]
+
+
+def test_similar_skips_unsuccessful_runs(tmp_path):
+    memory = _memory(tmp_path, score=5)
+    assert memory.similar("Make the tweets more exciting") == []
+
+
+def test_rerecorded_run_replaces_its_index_entry(tmp_path):
+    memory = _memory(tmp_path)
+    memory.record("run-0", _state("Summarize board minutes.", 9))
+    assert [run["run_id"] for run in memory.similar("exciting tweet")] == ["run-1"]
+    assert memory.similar("board minutes")[0]["run_id"] == "run-0"
+
+
+def test_stats_count_every_query(tmp_path):
+    memory = _memory(tmp_path)
+    empty = memory.stats()
+    memory.similar("")
+    memory.similar("the and of")
+    memory.similar("exciting tweet")
+    stats = memory.stats()
+    assert set(empty) == set(stats) == {"records", "queries", "hits", "mean_query_ms"}
+    assert (stats["records"], stats["queries"], stats["hits"]) == (5, 3, 1)
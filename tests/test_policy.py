@@ -0,0 +1,155 @@
+import json
+
+import pytest
+
+from agents import P3RO_Graph
+from policy import AdaptivePolicy, FixedPolicy, RunStatistics, create_policy, parse_settings
+from state import Attempt, PromptHistory, create_initial_state
+
+CRITERIA = ("Be short.", "Be loud.")
+
+
+def _attempt(iteration: int, scores, prompt: str = None) -> Attempt:
+    return Attempt(prompt or f"prompt {iteration} {list(scores)}", iteration=iteration).with_evaluation(
+        {"scores": [{"criterion": c, "score": s, "justification": ""} for c, s in zip(CRITERIA, scores)],
+         "qualitative_feedback": ""})
+
+
+class Run:
+    """Feeds rounds to a policy the way decide_next_step does, carrying the state between decisions."""
+
+    def __init__(self, policy, run_id: str = "", **stop_policy):
+        self.policy = policy
+        self.state = create_initial_state("Write a tweet.", "Make it exciting.", run_id=run_id,
+                                          stop_policy=stop_policy)
+
+    def round(self, *scores, tokens: int = 0):
+        iteration = self.state["iteration_count"]
+        self.state["prompt_history"] = self.state["prompt_history"].appended(
+            [_attempt(iteration, round_scores) for round_scores in scores])
+        usage = dict(self.state["run_usage"])
+        usage["tokens"] += tokens
+        self.state.update(iteration_count=iteration + 1, run_usage=usage)
+        route, reason, stats = self.policy.decide(self.state)
+        # Statistics travel through the (journaled) state as plain JSON
+        self.state.update(route=route, route_reason=reason, policy_stats=json.loads(json.dumps(stats)))
+        return route, reason
+
+
+def test_fixed_policy():
+    run = Run(FixedPolicy(target_score=8.5, max_iterations=5))
+    assert run.round((6, 6))[0] == "CONTINUE_PROBING"
+    route, reason = run.round((5, 6))
+    assert route == "REVISE_STRATEGY" and "stalled" in reason
+    assert run.round((7, 7))[0] == "CONTINUE_PROBING"
+    assert run.round((9, 9))[0] == "FINISH"
+
+
+def test_fixed_policy_stops_at_max_iterations():
+    run = Run(FixedPolicy(max_iterations=2))
+    run.round((5, 5))
+    assert run.round((6, 6))[0] == "FINISH"
+
+
+def test_adaptive_policy_finishes_at_target():
+    run = Run(AdaptivePolicy(target_score=8.5))
+    assert run.round((9, 8))[0] == "FINISH"
+
+
+def test_adaptive_policy_revises_once_on_plateau_then_finishes():
+    run = Run(AdaptivePolicy(max_iterations=10, min_iterations=3, patience=1, score_noise=0.5,
+                                   min_expected_gain=0.3))
+    assert run.round((6, 6))[0] == "CONTINUE_PROBING"
+    assert run.round((7, 7))[0] == "CONTINUE_PROBING"
+    route, reason = run.round((7, 7))
+    assert route == "REVISE_STRATEGY" and "no gain above noise" in reason
+    # Already revised since the last improvement, so the plateau does not trigger another revision
+    route, reason = run.round((7, 7))
+    assert route == "FINISH" and "low expected improvement" in reason
+
+
+def test_adaptive_policy_revises_when_gains_are_within_noise():
+    run = Run(AdaptivePolicy(max_iterations=10, min_iterations=10, score_noise=2.0))
+    run.round((6, 6))
+    route, reason = run.round((7, 7))
+    assert route == "REVISE_STRATEGY" and "margin 2.00" in reason
+
+
+def test_adaptive_policy_revises_on_regressing_criterion():
+    run = Run(AdaptivePolicy(max_iterations=10, min_iterations=10, patience=5, score_noise=0.1))
+    run.round((5, 8))
+    run.round((7, 7))
+    route, reason = run.round((9, 6))
+    assert route == "REVISE_STRATEGY" and "Be loud." in reason
+
+
+def test_adaptive_policy_token_budget():
+    run = Run(AdaptivePolicy(min_iterations=10), token_budget=2500)
+    assert run.round((5, 5), tokens=1000)[0] == "CONTINUE_PROBING"
+    route, reason = run.round((6, 6), tokens=1000)
+    assert route == "FINISH" and reason.startswith("token budget")
+
+
+def test_run_without_id_keeps_statistics():
+    policy = AdaptivePolicy(max_iterations=10, min_iterations=10, patience=1, score_noise=0.5)
+    routes = {}
+    for run_id in ("", "abc"):
+        run = Run(policy)
+        run.state["run_id"] = run_id
+        routes[run_id] = [run.round((6, 6))[0], run.round((6, 6))[0], run.round((6, 6))[0]]
+    assert routes[""] == routes["abc"] == ["CONTINUE_PROBING", "REVISE_STRATEGY", "CONTINUE_PROBING"]
+
+
+def test_statistics_round_trip_and_noise_estimate():
+    stats = RunStatistics()
+    history = PromptHistory([_attempt(0, (5, 5), "same"), _attempt(1, (7, 7), "same"),
+                             _attempt(2, (6, 6), "other")])
+    stats.observe(history, {"tokens": 300, "elapsed_s": 3.0})
+    assert stats.rounds == 3 and stats.best == 7 and stats.last_round_best == 6
+    assert stats.tokens_per_round == 100
+    restored = RunStatistics.from_state_dict(json.loads(json.dumps(stats.state_dict())))
+    assert restored.as_dict() == stats.as_dict()
+    assert restored.noise_sd(prior=9.0) == 9.0  # a single repeat is not enough to estimate the noise
+    restored.observe(history.appended([_attempt(3, (6, 6), "other")]))
+    assert restored.rounds == 4 and restored.noise_sd(prior=9.0) == pytest.approx(1.0)
+
+
+def test_statistics_reset_on_rewound_history():
+    stats = RunStatistics()
+    stats.observe(PromptHistory([_attempt(0, (5, 5)), _attempt(1, (6, 6))]))
+    stats.observe(PromptHistory([_attempt(0, (8, 8))]))
+    assert stats.rounds == 1 and stats.best == 8
+
+
+def test_decision_thresholds():
+    policy = AdaptivePolicy(target_score=8.5, score_noise=0.5, noise_z=1.0)
+    run = Run(policy)
+    assert policy.decision_thresholds(run.state) == [8.5]
+    run.round((6, 6))
+    assert policy.decision_thresholds(run.state) == [8.5, 6.5]
+
+
+def test_stop_policy_overrides():
+    run = Run(AdaptivePolicy(), target_score=5)
+    assert run.round((5, 5))[0] == "FINISH"
+    with pytest.raises(ValueError):
+        Run(AdaptivePolicy(), no_such_setting=1).round((5, 5))
+    # Settings of the other policy are accepted, so one job file can be replayed under either
+    assert Run(FixedPolicy(), patience=2).round((5, 5))[0] == "CONTINUE_PROBING"
+
+
+def test_create_policy():
+    policy = create_policy("adaptive:token_budget=20000,noise_z=1.5,latency_budget_s=none")
+    assert (policy.token_budget, policy.noise_z, policy.latency_budget_s) == (20000, 1.5, None)
+    assert parse_settings(["a=2", "b=2.0"]) == {"a": 2, "b": 2.0}
+    for spec in ("unknown", "fixed:patience=2", "adaptive:token_budget"):
+        with pytest.raises(ValueError):
+            create_policy(spec)
+
+
+def test_token_budget_stops_run_created_without_id():
+    graph = P3RO_Graph(backend="fake", policy=AdaptivePolicy(max_iterations=10, min_iterations=10))
+    state = graph.compile_graph().invoke(create_initial_state("Write a tweet.", "Make it exciting.",
+                                                              stop_policy={"token_budget": 3000}))
+    assert state["run_id"] and state["run_usage"]["tokens"] > 0
+    assert state["route_reason"].startswith("token budget") and state["iteration_count"] < 10
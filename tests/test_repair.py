@@ -0,0 +1,117 @@
+import json
+
+import pytest
+from langchain_core.messages import AIMessage
+
+from fake_llm import FakeChatModel
+from repair import StructuredOutputRepair, extract_json, message_text, repair_json
+from state import CriterionScore, EvaluationResult
+
+EVALUATION = {"scores": [{"criterion": "Be short.", "score": 8, "justification": "It is."}],
+              "qualitative_feedback": "Fine."}
+
+
+def test_extract_json_from_prose_and_fence():
+    text = f"Here is the result:\n```json\n{json.dumps(EVALUATION)}\n```\nAnything else?"
+    assert json.loads(extract_json(text)) == EVALUATION
+    assert extract_json('Sure! Here\'s what I found: {"a": 1} hope that\'s useful') == '{"a": 1}'
+
+
+def test_extract_json_skips_fences_without_json():
+    assert extract_json('```\nnot json\n```\n```json\n{"a": 1}\n```') == '{"a": 1}'
+
+
+def test_extract_json_ignores_fence_inside_string():
+    text = 'Result:\n```json\n{"a": "wrap code in ```python``` fences"}\n```'
+    assert json.loads(extract_json(text)) == {"a": "wrap code in ```python``` fences"}
+
+
+def test_extract_json_ignores_brackets_inside_strings():
+    assert extract_json('{"a": "}]", "b": [1]} trailing') == '{"a": "}]", "b": [1]}'
+
+
+def test_extract_json_returns_rest_of_truncated_text():
+    assert extract_json('Answer: {"a": [1, 2') == '{"a": [1, 2'
+    assert extract_json("no json here") is None
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("{'a': 'b', 'c': True, 'd': None, 'e': False}", {"a": "b", "c": True, "d": None, "e": False}),
+    ('{"a": [1, 2,], "b": {"c": 3,},}', {"a": [1, 2], "b": {"c": 3}}),
+    ("{'a': 'it\\'s'}", {"a": "it's"}),
+    ("{'note': 'don't panic', 'b': 'rock 'n' roll'}", {"note": "don't panic", "b": "rock 'n' roll"}),
+    ("{'a': 'say \"hi\"'}", {"a": 'say "hi"'}),
+    ("{'a': 'line\\nbreak'}", {"a": "line\nbreak"}),
+    ('{"a": "it\'s True, None",}', {"a": "it's True, None"}),
+    ("{'a': ''}", {"a": ""}),
+])
+def test_repair_json(text, expected):
+    assert json.loads(repair_json(text)) == expected
+
+
+def test_repair_leaves_valid_json_untouched():
+    text = json.dumps(EVALUATION)
+    assert repair_json(text) == text
+
+
+def test_repair_tiers():
+    repair = StructuredOutputRepair()
+    fenced = AIMessage(content=f"```json\n{json.dumps(EVALUATION)}\n```")
+    assert repair.repair(fenced, EvaluationResult)[1] == "extracted"
+    literal = AIMessage(content=repr(EVALUATION)[:-1] + ",}")
+    obj, tier, _ = repair.repair(literal, EvaluationResult)
+    assert tier == "repaired" and obj.scores[0].score == 8
+    smart = AIMessage(content=json.dumps(EVALUATION).replace('"', "“", 1))
+    assert repair.repair(smart, EvaluationResult)[1] == "repaired"
+
+
+def test_repair_uses_tool_call_arguments():
+    raw = AIMessage(content="", tool_calls=[{"name": "EvaluationResult", "args": EVALUATION, "id": "1"}])
+    obj, tier, _ = StructuredOutputRepair().repair(raw, EvaluationResult)
+    assert tier == "extracted" and obj.qualitative_feedback == "Fine."
+
+
+def test_repair_does_not_complete_truncated_output():
+    # A truncated evaluation may be missing criteria, so it is re-asked rather than guessed
+    text = json.dumps(EVALUATION)
+    obj, tier, error = StructuredOutputRepair().repair(AIMessage(content=text[:len(text) // 2]), EvaluationResult)
+    assert obj is None and tier == "failed" and error
+
+
+def test_repair_reports_missing_json():
+    obj, tier, error = StructuredOutputRepair().repair(AIMessage(content="I cannot help."), EvaluationResult)
+    assert obj is None and tier == "failed" and "Invalid JSON" in error
+    assert StructuredOutputRepair().repair(AIMessage(content=""), EvaluationResult)[2] == \
+        "no JSON found in the response"
+
+
+def test_repair_recovers_fake_model_malformed_output():
+    model = FakeChatModel(malformed_rate=1.0)
+    response = EvaluationResult(**EVALUATION)
+    repair = StructuredOutputRepair()
+    tiers = set()
+    for i in range(30):
+        text = model.malformed_text(f"prompt {i}", response)
+        obj, tier, _ = repair.repair(AIMessage(content=text), EvaluationResult)
+        if obj is not None:
+            assert obj == response
+        tiers.add(tier)
+    assert tiers == {"extracted", "repaired", "failed"}
+
+
+def test_stats_ratio():
+    repair = StructuredOutputRepair()
+    for tier in ("direct", "extracted", "repaired", "failed"):
+        repair.record(tier)
+    stats = repair.stats()
+    assert stats["failed"] == 1 and stats["recovered_locally_ratio"] == 0.5
+    assert StructuredOutputRepair().stats()["recovered_locally_ratio"] == 0.0
+
+
+def test_message_text_joins_parts():
+    assert message_text(AIMessage(content=["a", {"type": "text", "text": "b"}])) == "ab"
+
+
+@pytest.mark.parametrize("value, expected", [("8/10", 8), (" 7 out of 10", 7), (7.5, 8), (6.4, 6), (9, 9)])
+def test_score_coercion(value, expected):
+    assert CriterionScore(criterion="c", score=value, justification="j").score == expected
@@ -0,0 +1,115 @@
+import json
+
+import pytest
+
+from state import (Attempt, PromptHistory, append_attempts, confidence_half_width, create_initial_state,
+                   encode_state_value, find_best_prompt)
+
+
+def _attempt(iteration: int, *scores, prompt: str = None) -> Attempt:
+    attempt = Attempt(prompt or f"prompt {iteration} {scores}", "why", iteration=iteration)
+    if not scores:
+        return attempt
+    return attempt.with_evaluation({"scores": [{"criterion": f"c{i}", "score": s, "justification": "ok"}
+                                               for i, s in enumerate(scores)],
+                                    "qualitative_feedback": "fine"})
+
+
+def test_reducer_appends_attempts_and_dicts():
+    first = append_attempts(None, [_attempt(0, 5)])
+    second = append_attempts(first, [_attempt(1, 7).to_dict(), _attempt(1, 6)])
+    assert len(first) == 1 and len(second) == 3
+    assert isinstance(second[1], Attempt) and second[1].average_score == 7
+    assert len(append_attempts(second, [])) == 3 and len(append_attempts(None, [])) == 0
+
+
+def test_reducer_replaces_with_history():
+    current = append_attempts(None, [_attempt(0, 5), _attempt(1, 6)])
+    replacement = PromptHistory([_attempt(0, 9)])
+    assert append_attempts(current, replacement) is replacement
+
+
+def test_appending_shares_storage_and_keeps_older_views():
+    base = PromptHistory([_attempt(0, 5)])
+    longer = base.appended([_attempt(1, 8)])
+    assert len(base) == 1 and base.best.average_score == 5
+    assert longer[0] is base[0] and longer.best.average_score == 8
+    # Appending to the older view copies its prefix instead of overwriting the longer view's attempts
+    branch = base.appended([_attempt(1, 3)])
+    assert [a.average_score for a in branch] == [5, 3] and [a.average_score for a in longer] == [5, 8]
+    assert branch.best.average_score == 5 and longer.best.average_score == 8
+
+
+def test_indexing():
+    history = PromptHistory([_attempt(0, 1), _attempt(1, 2)]).appended([_attempt(2, 3)])
+    assert history[-1].average_score == 3 and [a.average_score for a in history[:2]] == [1, 2]
+    with pytest.raises(IndexError):
+        history[3]
+    assert history[:2][-1] is history[1]
+
+
+def test_best_and_round_bests():
+    history = PromptHistory([_attempt(0, 5), _attempt(0, 6), _attempt(1, 9, 1), _attempt(1, 4, 4),
+                             _attempt(2, 5, 5)])
+    # Best by total score, rounds by average score
+    assert history.best_index == 2
+    assert history.round_best().total_score == 10
+    assert history.round_best(1).scores_by_criterion() == {"c0": 9, "c1": 1}
+    assert history.round_best(2).average_score == 6
+    assert history.round_best(3) is None
+    assert [a.average_score for a in history.round_bests()] == [6, 5, 5]
+
+
+def test_unevaluated_attempts():
+    history = PromptHistory([_attempt(0), _attempt(0)])
+    assert history.best is None and history.best_index is None
+    assert history.round_best() is None and history.round_bests() == []
+    assert find_best_prompt(history) == (history[-1].prompt_text, -1)
+    history = history.appended([_attempt(1, 4), _attempt(2)])
+    assert history.best.average_score == 4
+    assert history.round_best() is None and history.round_best(1).average_score == 4
+    assert find_best_prompt(history) == (history[2].prompt_text, 4)
+    assert find_best_prompt(None) == ("", -1)
+
+
+def test_attempt_round_trip_with_samples():
+    evaluation = {"scores": [{"criterion": "c0", "score": 7.5, "justification": "a", "sd": 0.5},
+                             {"criterion": "c1", "score": 6, "justification": "b", "sd": 1.0}],
+                  "qualitative_feedback": "fine", "samples": 3, "average_sd": 0.6}
+    attempt = Attempt("p", "r", 2, 1).with_evaluation(evaluation, reused=True)
+    restored = Attempt.from_dict(json.loads(json.dumps(attempt.to_dict())))
+    assert restored.to_dict() == attempt.to_dict()
+    assert restored.evaluation_dict() == evaluation
+    assert (restored.samples, restored.reused, restored.average_score) == (3, True, 6.75)
+    assert restored.average_ci == pytest.approx(confidence_half_width(0.6, 3))
+
+
+def test_single_sample_evaluation_has_no_spread():
+    attempt = _attempt(0, 5, 6)
+    assert attempt.evaluation_dict() == {"scores": [{"criterion": "c0", "score": 5, "justification": "ok"},
+                                                    {"criterion": "c1", "score": 6, "justification": "ok"}],
+                                         "qualitative_feedback": "fine"}
+    assert attempt.average_ci == 0.0
+    assert "evaluation" not in Attempt("p").to_dict()
+
+
+def test_encode_state_value():
+    history = PromptHistory([_attempt(0, 5)])
+    encoded = json.loads(json.dumps({"history": history, "last": history[0]}, default=encode_state_value))
+    assert encoded["history"] == history.as_dicts() and encoded["last"] == history[0].to_dict()
+    assert PromptHistory.from_dicts(encoded["history"])[0].to_dict() == history[0].to_dict()
+    with pytest.raises(TypeError):
+        json.dumps({"value": object()}, default=encode_state_value)
+
+
+def test_confidence_half_width():
+    assert confidence_half_width(1.0, 1) == 0.0
+    assert confidence_half_width(1.0, 2) == pytest.approx(12.706 / 2 ** 0.5)
+    assert confidence_half_width(2.0, 4) == pytest.approx(3.182)
+    assert confidence_half_width(1.0, 100) == pytest.approx(0.196)
+
+
+def test_every_run_gets_an_id():
+    first, second = create_initial_state("p", "g"), create_initial_state("p", "g")
+    assert first["run_id"] and first["run_id"] != second["run_id"]
+    assert create_initial_state("p", "g", run_id="abc")["run_id"] == "abc"
@@ -0,0 +1,78 @@
+import threading
+
+import templates
+from templates import ContextCacheRegistry, PromptTemplate, is_missing_context_cache_error
+
+SHORT = PromptTemplate("short", "static", "{value}")
+OTHER = PromptTemplate("other", "other static", "{value}")
+
+
+def test_render_and_cache_text():
+    prompt = SHORT.render(value=3)
+    assert prompt.text == "static3" and prompt.cache_text == f"short@{SHORT.fingerprint}\n3"
+
+
+def test_handles_are_created_once_per_model_and_template():
+    created = []
+    registry = ContextCacheRegistry(lambda model, template: created.append((model, template.name)) or
+                                    f"{model}/{template.name}")
+    assert registry.handle("m", SHORT) == registry.handle("m", SHORT) == "m/short"
+    assert registry.handle("n", SHORT) == "n/short"
+    assert created == [("m", "short"), ("n", "short")]
+    assert ContextCacheRegistry(lambda model, template: "h", min_tokens=10_000).handle("m", SHORT) is None
+
+
+def test_slow_creation_blocks_only_its_own_key():
+    release = threading.Event()
+    calls = []
+
+    def create(model, template):
+        calls.append(template.name)
+        if template is SHORT:
+            release.wait(5)
+        return template.name
+
+    registry = ContextCacheRegistry(create)
+    waiting = [threading.Thread(target=registry.handle, args=("m", SHORT)) for _ in range(3)]
+    for thread in waiting:
+        thread.start()
+    # Another template is served while the first one's handle is still being created
+    assert registry.handle("m", OTHER) == "other"
+    release.set()
+    for thread in waiting:
+        thread.join()
+    assert calls.count("short") == 1 and registry.handle("m", SHORT) == "short"
+
+
+def test_handles_are_refreshed_before_expiry_and_after_invalidation(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(templates.time, "monotonic", lambda: now[0])
+    handles = iter(["h1", "h2", "h3"])
+    registry = ContextCacheRegistry(lambda model, template: next(handles), ttl_s=600, refresh_before_s=60)
+    assert registry.handle("m", SHORT) == "h1"
+    now[0] += 539
+    assert registry.handle("m", SHORT) == "h1"
+    now[0] += 1
+    assert registry.handle("m", SHORT) == "h2"
+    registry.invalidate("m", SHORT, "h1")
+    assert registry.handle("m", SHORT) == "h2"
+    registry.invalidate("m", SHORT, "h2")
+    assert registry.handle("m", SHORT) == "h3"
+
+
+def test_failed_creation_is_not_retried_on_every_call():
+    calls = []
+
+    def create(model, template):
+        calls.append(model)
+        raise RuntimeError("quota exceeded")
+
+    registry = ContextCacheRegistry(create)
+    assert registry.handle("m", SHORT) is None and registry.handle("m", SHORT) is None
+    assert calls == ["m"]
+
+
+def test_is_missing_context_cache_error():
+    assert is_missing_context_cache_error(RuntimeError("404 CachedContent not found"))
+    assert not is_missing_context_cache_error(RuntimeError("404 model not found"))
+    assert not is_missing_context_cache_error(RuntimeError("cached content too small"))
@@ -1,240 +1,544 @@
+import contextvars
 import json
-from typing import Dict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Type
 
-from langchain_google_genai import ChatGoogleGenerativeAI
 from pydantic import BaseModel
 
-from state import AgentState, DecomposedGoal, ImprovementPlan, GeneratedPrompt, EvaluationResult, Reflection
+from backends import close_chat_model, create_chat_model
+from cache import ResponseCache
+from compaction import HistoryCompactor, estimate_tokens
+from dedup import EvaluationIndex, normalize_prompt
+from evaluation import ITEM_HEADER, BatchEvaluator, EvaluationConfig, EvaluationItem, SampledEvaluator
+from instrumentation import Instrumentation, usage_tokens
+from memory import StrategyMemory
+from ratelimit import RateLimiter, RetryPolicy, is_throttling_error
+from repair import REASK_INSTRUCTIONS, StructuredOutputRepair, message_text
+from routing import ModelRouter, estimate_cost
+from state import (AgentState, DecomposedGoal, ImprovementPlan, GeneratedPrompt, EvaluationResult, Reflection,
+                   BatchEvaluationResult, Attempt)
+from templates import (DECOMPOSE_GOAL, EVALUATE_PROMPT, EVALUATE_PROMPT_BATCH, FORMULATE_STRATEGY, GENERATE_PROMPT,
+                       SYNTHESIZE_REFLECTION, ContextCacheRegistry, PromptTemplate, RenderedPrompt,
+                       is_missing_context_cache_error)
 
 
 class P3RO_Agent_Tools:
     """A class to encapsulate all the tools for the P³RO agent."""
 
-    def __init__(self, llm_model_name="gemini-2.5-pro"):
-        """Initializes the toolset with a specific Gemini model."""
-        self.model = ChatGoogleGenerativeAI(model=llm_model_name, temperature=1.0)
-        print(f"--- Tools initialized with model: {llm_model_name} ---")
-
-    def _invoke_llm_for_json(self, prompt: str, pydantic_class: BaseModel):
+    def __init__(self, llm_model_name="gemini-2.5-pro", cache: Optional[ResponseCache] = None,
+                 cache_bypass_nodes: Iterable[str] = ("generate_prompt",), beam_width: int = 1,
+                 beam_top_k: int = 1, history_compactor: Optional[HistoryCompactor] = None,
+                 instrumentation: Optional[Instrumentation] = None, model=None, backend: str = "gemini",
+                 evaluation: Optional[EvaluationConfig] = None,
+                 rate_limiter: Optional[RateLimiter] = None, retry_policy: Optional[RetryPolicy] = None,
+                 model_router: Optional[ModelRouter] = None, models: Optional[Dict[str, object]] = None,
+                 dedup_index: Optional[EvaluationIndex] = None, dedup_max_regenerations: int = 1,
+                 strategy_memory: Optional[StrategyMemory] = None,
+                 context_caches: Optional[ContextCacheRegistry] = None,
+                 decision_thresholds: Optional[Callable[[AgentState], List[float]]] = None):
+        """Initializes the toolset with the router's models, or with a prebuilt chat `model` for all of them.
+
+        Each optional component enables the feature its own module describes. `evaluation` sets how candidates
+        are scored, and `decision_thresholds(state)` gives the scores a sampled evaluation must clear.
+        """
+        if beam_width < 1 or not 1 <= beam_top_k <= beam_width:
+            raise ValueError("beam_width must be at least 1 and beam_top_k must be between 1 and beam_width.")
+        self.llm_model_name = llm_model_name
+        self.temperature = 1.0
+        self.evaluation = evaluation or EvaluationConfig()
+        self.eval_temperature = self.temperature if self.evaluation.temperature is None else \
+            self.evaluation.temperature
+        self.backend = backend
+        self.model_router = model_router or ModelRouter(default_model=llm_model_name)
+        # A prebuilt `model` serves every model name the router asks for, unless `models` maps that name
+        self._models: Dict[str, object] = ({name: model for name in self.model_router.models()}
+                                           if model is not None else {})
+        self._models.update(models or {})
+        self._prebuilt_models = set(self._models)
+        # Structured-output bindings, keyed by model key and schema
+        self._structured_models: Dict[Tuple, object] = {}
+        self._models_lock = threading.Lock()
+        self.output_repair = StructuredOutputRepair()
+        self.context_caches = context_caches
+        # Handle last used per (model, template), so models bound to a replaced handle can be dropped
+        self._context_handles: Dict[Tuple[str, str], str] = {}
+        self.cache = cache
+        self.cache_bypass_nodes = set(cache_bypass_nodes)
+        self.beam_width = beam_width
+        self.beam_top_k = beam_top_k
+        self.history_compactor = history_compactor
+        self.instrumentation = instrumentation or Instrumentation()
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.estimated_output_tokens = 512
+        self.dedup_index = dedup_index
+        self.dedup_max_regenerations = dedup_max_regenerations
+        self.strategy_memory = strategy_memory
+        self.decision_thresholds = decision_thresholds
+        self.sampled_evaluator = None
+        if self.evaluation.sampled:
+            # Samples are separate requests, since copies of one prompt in a shared batch are not independent
+            self.sampled_evaluator = SampledEvaluator(draw=self._evaluate_single,
+                                                      run_concurrently=self._run_concurrently,
+                                                      samples=self.evaluation.samples,
+                                                      max_samples=self.evaluation.max_samples,
+                                                      aggregate=self.evaluation.aggregate)
+            # Repeated samples of one prompt must not be served from the response cache
+            self.cache_bypass_nodes.add("evaluate_prompt")
+        self.batch_evaluator = None
+        if self.evaluation.batch_size > 1:
+            self.batch_evaluator = BatchEvaluator(
+                render_batch=self._batch_evaluation_prompt,
+                invoke=self._invoke_batch_evaluation,
+                evaluate_single=self._evaluate_single,
+                batch_size=self.evaluation.batch_size,
+                max_wait_s=self.evaluation.max_wait_s,
+            )
+        print(f"--- Tools initialized with models: {', '.join(self.model_router.models())} ---")
+
+    def close(self):
+        """Closes the HTTP clients of the models created by the tools; prebuilt models belong to the caller.
+
+        Models are created once and reused by every run, so this is only needed when the tools are discarded.
+        """
+        with self._models_lock:
+            created = [model for key, model in self._models.items() if key not in self._prebuilt_models]
+            self._models = {key: model for key, model in self._models.items() if key in self._prebuilt_models}
+            self._structured_models.clear()
+        for model in created:
+            try:
+                close_chat_model(model)
+            except Exception as e:
+                # Shutdown continues regardless; a leaked connection is not worth failing over
+                print(f"Failed to close model client: {e}")
+
+    def _chat_model(self, model_name: str, cached_content: Optional[str] = None,
+                    temperature: Optional[float] = None, schema: Optional[Type[BaseModel]] = None):
+        """Returns the chat model for `model_name`, bound to a context-cache handle and sampling temperature if
+        given; created on first use. Prebuilt models keep their own temperature.
+
+        With a `schema`, returns the model bound to that structured output instead. Binding builds the schema's
+        tool definition and output parser, so it is done once per model and schema and then reused.
+        """
+        if temperature is None or model_name in self._prebuilt_models:
+            temperature = self.temperature
+        key = model_name
+        if cached_content or temperature != self.temperature:
+            key = (model_name, cached_content, temperature)
+        with self._models_lock:
+            if key not in self._models:
+                extra = {"cached_content": cached_content} if cached_content else {}
+                self._models[key] = create_chat_model(model_name, temperature, self.backend, **extra)
+            if schema is None:
+                return self._models[key]
+            structured = self._structured_models.get((key, schema))
+            if structured is None:
+                structured = self._models[key].with_structured_output(schema, include_raw=True)
+                self._structured_models[(key, schema)] = structured
+            return structured
+
+    def _context_handle(self, model_name: str, template: PromptTemplate) -> Optional[str]:
+        """Returns the context-cache handle for a template's static prefix, dropping the models bound to the
+        handle it replaces, e.g. one refreshed before its expiry."""
+        if self.context_caches is None or model_name in self._prebuilt_models:
+            return None
+        handle = self.context_caches.handle(model_name, template)
+        with self._models_lock:
+            previous = self._context_handles.get((model_name, template.fingerprint))
+            if handle:
+                self._context_handles[(model_name, template.fingerprint)] = handle
+            if previous and previous != handle:
+                # Other threads may still be using these models; they are left to the garbage collector
+                self._models = {key: model for key, model in self._models.items()
+                                if not (isinstance(key, tuple) and key[1] == previous)}
+                self._structured_models = {key: model for key, model in self._structured_models.items()
+                                           if not (isinstance(key[0], tuple) and key[0][1] == previous)}
+        return handle
+
+    def _invoke_llm_for_json(self, prompt: RenderedPrompt, pydantic_class: BaseModel, node: Optional[str] = None):
         """A helper function to invoke the LLM and parse its structured output."""
+        model_name = self.model_router.model_for(node)
+        temperature = self.eval_temperature if node == "evaluate_prompt" else self.temperature
+        use_cache = self.cache is not None and node not in self.cache_bypass_nodes
+        if use_cache:
+            cached = self.cache.get(ResponseCache.make_key(model_name, temperature, pydantic_class,
+                                                           prompt.cache_text), pydantic_class)
+            if cached is not None:
+                print(f"Cache hit for {pydantic_class.__name__}")
+                return cached
+
+        response_obj = self._call_model(prompt, pydantic_class, node, model_name, temperature)
+        escalation_model = self.model_router.escalation_for(node)
+        escalated = escalation_model is not None and self.model_router.should_escalate(response_obj)
+        escalation_failed = False
+        if escalated:
+            print(f"Escalating {pydantic_class.__name__} from {model_name} to {escalation_model}")
+            escalated_obj = self._call_model(prompt, pydantic_class, node, escalation_model, temperature)
+            escalation_failed = escalated_obj is None
+            if escalated_obj is not None:
+                response_obj, model_name = escalated_obj, escalation_model
+        self.model_router.record(node, escalated=escalated, escalation_failed=escalation_failed)
+
+        if use_cache and response_obj is not None:
+            # Keyed by the model that produced it, so a fast model's key never returns a strong model's output
+            self.cache.put(ResponseCache.make_key(model_name, temperature, pydantic_class, prompt.cache_text),
+                           response_obj)
+        return response_obj
+
+    def _call_model(self, prompt: RenderedPrompt, pydantic_class: BaseModel, node: Optional[str], model_name: str,
+                    temperature: Optional[float] = None, reask: bool = True):
+        """Makes one timed structured call to `model_name`, retrying retryable failures.
+
+        Output the model's parser rejects is first repaired locally; if that fails and `reask` is set, the model
+        is asked once more with the validation error.
+        """
+        tier = "failed"
         try:
-            structured_llm = self.model.with_structured_output(pydantic_class)
-            response_obj = structured_llm.invoke(prompt)
+            with self.instrumentation.llm_call(node, pydantic_class.__name__, model_name) as record:
+                # With a context-cache handle the static prefix lives provider-side and only the suffix is sent
+                handle = self._context_handle(model_name, prompt.template)
+                text = prompt.dynamic if handle else prompt.text
+                record.static_prefix_tokens = prompt.template.static_tokens
+                structured_llm = self._chat_model(model_name, cached_content=handle, temperature=temperature,
+                                                  schema=pydantic_class)
+                estimated_tokens = estimate_tokens(text) + self.estimated_output_tokens
+                attempt = 1
+                while True:
+                    if self.rate_limiter is not None:
+                        record.wait_time_s += self.rate_limiter.acquire(estimated_tokens)
+                    response, failure = None, None
+                    try:
+                        response = structured_llm.invoke(text)
+                        for key, value in usage_tokens(response.get("raw")).items():
+                            setattr(record, key, value)
+                    except Exception as e:
+                        failure = e
+                    finally:
+                        # Released however the call ended, so a failure never leaks a concurrency slot
+                        if self.rate_limiter is not None:
+                            actual_tokens = record.input_tokens + record.output_tokens if failure is None else 0
+                            self.rate_limiter.release(throttled=failure is not None and is_throttling_error(failure),
+                                                      estimated_tokens=estimated_tokens,
+                                                      actual_tokens=actual_tokens or None)
+                    if failure is None:
+                        break
+                    if handle and is_missing_context_cache_error(failure):
+                        # The provider dropped the cache early; send the full prompt this time
+                        print(f"Context cache for template '{prompt.template.name}' is gone; retrying without it.")
+                        self.context_caches.invalidate(model_name, prompt.template, handle)
+                        handle, text = None, prompt.text
+                        structured_llm = self._chat_model(model_name, temperature=temperature, schema=pydantic_class)
+                        estimated_tokens = estimate_tokens(text) + self.estimated_output_tokens
+                        continue
+                    if self.retry_policy.should_retry(failure, attempt):
+                        delay = self.retry_policy.backoff(attempt)
+                        print(f"Retryable error calling LLM for {pydantic_class.__name__} (attempt {attempt}); "
+                              f"retrying in {delay:.1f}s: {failure}")
+                        time.sleep(delay)
+                        record.retries += 1
+                        record.wait_time_s += delay
+                        attempt += 1
+                        continue
+                    print(f"Error calling LLM or parsing output for {pydantic_class.__name__}: {failure}")
+                    record.success = False
+                    record.error = f"{type(failure).__name__}: {failure}"
+                    return None
+
+                if handle and not record.cached_input_tokens:
+                    # Some providers leave the cached prefix out of the reported usage; count it as cached input
+                    record.cached_input_tokens = prompt.template.static_tokens
+                    record.input_tokens += prompt.template.static_tokens
+                record.cost_usd = estimate_cost(model_name, record.input_tokens, record.output_tokens,
+                                                record.cached_input_tokens)
+                response_obj, tier = response.get("parsed"), "direct"
+                if response_obj is None:
+                    response_obj, tier, repair_error = self.output_repair.repair(response.get("raw"), pydantic_class)
+                    error = response.get("parsing_error") or repair_error
+                    if response_obj is not None:
+                        print(f"Recovered unparseable {pydantic_class.__name__} output locally ({tier}): {error}")
+                    else:
+                        print(f"Error calling LLM or parsing output for {pydantic_class.__name__}: {error}")
+                        record.success = False
+                        # The parser's exception, or the repair's message when there was none
+                        record.error = error if isinstance(error, str) else f"{type(error).__name__}: {error}"
+
+            if response_obj is None and reask:
+                # A targeted re-ask costs a round-trip, but far less than the run that fails without it
+                print(f"Asking {model_name} again for valid {pydantic_class.__name__} output.")
+                correction = REASK_INSTRUCTIONS.format(error=str(error)[:1000],
+                                                       previous=message_text(response.get("raw"))[:2000])
+                response_obj = self._call_model(RenderedPrompt(prompt.template, prompt.dynamic + correction),
+                                                pydantic_class, node, model_name, temperature, reask=False)
+                tier = "reasked" if response_obj is not None else "failed"
             return response_obj
-        except Exception as e:
-            print(f"Error calling LLM or parsing output for {pydantic_class.__name__}: {e}")
-            # Fallback or retry logic could be implemented here
-            return None
+        finally:
+            # Every outcome is counted, including calls that failed before any output came back
+            if reask:
+                self.output_repair.record(tier)
 
     def decompose_goal(self, state: AgentState) -> Dict:
         """Translates the user's goal into concrete criteria."""
         print("\n>>> EXECUTING NODE: DecomposeGoal")
         goal = state["goal"]
-        prompt = f"""
-        **Role:** You are a meticulous requirements analyst and prompt engineering expert. Your task is to decompose a user's high-level, often vague, goal for a prompt into a set of specific, orthogonal, and actionable criteria. These criteria will be used to objectively evaluate future versions of the prompt.
-
-        **Context:**
-        - The user wants to improve an initial prompt.
-        - The user has provided the following goal: "{goal}"
-
-        **Task:**
-        1.  **Analyze the Goal:** Deeply analyze the user's goal. Identify the core intent and the key qualities the user is seeking in the final prompt's output. Consider aspects like tone, structure, persona, constraints, and desired output format.
-        2.  **Decompose into Criteria:** Break down the goal into 3-5 distinct, measurable criteria. Each criterion should be a concise statement describing a specific quality or characteristic.
-        3.  **Ensure Actionability:** Each criterion must be something that can be reasonably judged or measured when comparing two prompts. Avoid vague terms like "make it better." Instead, use precise language like "Increase the use of sensory details," "Adopt a more formal and academic tone," or "Ensure the output is structured as a JSON object with 'name' and 'description' keys."
-
-        **Example:**
-        - **User Goal:** "I want a prompt for a marketing copywriter that is more creative and engaging."
-        - **Your Decomposed Criteria Output (as JSON):**
-          ```json
-          {{
-            "criteria": [
-              "Evoke a sense of urgency in the target audience.",
-              "Incorporate at least two power words related to exclusivity.",
-              "Use a conversational and slightly humorous tone.",
-              "End with a clear and compelling call-to-action."
-            ]
-          }}
-          ```
-
-        **Instructions:**
-        - Generate ONLY the list of criteria.
-        - Your output must be a single, valid JSON object that strictly adheres to the following Pydantic schema:
-          `class DecomposedGoal(BaseModel): criteria: List[str]`
-
-        **User Goal to Decompose:**
-        "{goal}"
-        """
-        result = self._invoke_llm_for_json(prompt, DecomposedGoal)
+        past_runs = ""
+        for run in self._similar_runs(state):
+            past_runs += f"\n  - Goal: \"{run['goal']}\" (best score {run['best_score']}): {run['criteria']}"
+        if past_runs:
+            past_runs = ("\n- Criteria used by similar past goals that reached high scores (adapt them to this goal "
+                         f"rather than copying them):{past_runs}")
+        prompt = DECOMPOSE_GOAL.render(goal=goal, past_runs=past_runs)
+        result = self._invoke_llm_for_json(prompt, DecomposedGoal, node="decompose_goal")
         if not result:
             raise ValueError("Failed to decompose goals.")
         
         print(f"Decomposed Criteria: {result.criteria}")
         return {"decomposed_criteria": result.criteria}
 
+    def _similar_runs(self, state: AgentState) -> List[Dict]:
+        """Returns the most similar successful past runs from the strategy memory, if one is configured."""
+        if self.strategy_memory is None:
+            return []
+        runs = self.strategy_memory.similar(state["goal"], exclude_run_id=state.get("run_id", ""))
+        if runs:
+            print(f"Seeding from {len(runs)} similar past run(s)")
+        return runs
+
+    def _strategy_prompt(self, state: AgentState, history_context: str, past_runs: str = "") -> RenderedPrompt:
+        """Renders the StrategyFormulator prompt with the given history context and past successful plans."""
+        return FORMULATE_STRATEGY.render(initial_prompt=state["initial_prompt"], criteria=state["decomposed_criteria"],
+                                         history_context=history_context, past_runs=past_runs)
+
     def formulate_strategy(self, state: AgentState) -> Dict:
         """Creates a high-level improvement plan."""
         print("\n>>> EXECUTING NODE: FormulateStrategy")
-        prompt = f"""
-        **Role:** You are an expert AI strategist and master prompt engineer. Your task is to devise a high-level, ordered plan to improve a given prompt based on a set of specific criteria. If this is a revision, you must learn from past failures.
-
-        **Context:**
-        - Initial Prompt: "{state['initial_prompt']}"
-        - Improvement Criteria: {state['decomposed_criteria']}
-        - History of Past Attempts (if any): "{state['prompt_history']}"
-
-        **Task:**
-        1.  **Analyze the Gap:** Compare the Initial Prompt with the Improvement Criteria. Identify the biggest gaps and areas for improvement. If a history of past attempts exists, analyze why the previous strategy failed. The last entry in the history contains the most relevant feedback.
-        2.  **Formulate a Strategy:** Create a logical, step-by-step plan to address these gaps. The plan should be a sequence of general approaches. Think about the order of operations. It might be best to fix the structure first, then the tone, then the specific details. If revising a failed strategy, explicitly state a *new* approach.
-        3.  **Output the Plan:** Write the plan as a concise, multi-line string, formatted as a numbered list.
-
-        **Example (First Pass):**
-        - **Initial Prompt:** "Write about our new shoes."
-        - **Improvement Criteria:**
-        - **Your Formulated Plan Output (as JSON):**
-          ```json
-          {{
-            "plan": "1. First, I will rewrite the prompt to explicitly establish the persona of a professional athlete.\\n2. Second, I will add specific instructions to focus on the 'ultralight foam' technology and its benefits.\\n3. Finally, I will adjust the language to be more energetic and use slang appropriate for a young, active audience."
-          }}
-          ```
-
-        **Instructions:**
-        - Generate ONLY the plan string.
-        - Your output must be a single, valid JSON object that strictly adheres to the following Pydantic schema:
-          `class ImprovementPlan(BaseModel): plan: str`
-
-        **Your Task:**
-        - Initial Prompt: "{state['initial_prompt']}"
-        - Improvement Criteria: {state['decomposed_criteria']}
-        - History of Past Attempts: "{state['prompt_history']}"
-        """
-        result = self._invoke_llm_for_json(prompt, ImprovementPlan)
+        past_runs = ""
+        for run in self._similar_runs(state):
+            past_runs += (f"\n  - Goal: \"{run['goal']}\" reached {run['best_score']} in {run['iterations']} "
+                          f"iterations with the plan: \"{run['plan']}\"")
+        if past_runs:
+            past_runs = f"\n- Plans that succeeded for similar past goals (use what transfers):{past_runs}"
+        if self.history_compactor is None:
+            prompt = self._strategy_prompt(state, str(state["prompt_history"].as_dicts()), past_runs)
+        else:
+            prompt = self._strategy_prompt(state, self.history_compactor.compact(state["prompt_history"]), past_runs)
+            metric = self.history_compactor.record(
+                self._strategy_prompt(state, str(state["prompt_history"].as_dicts()), past_runs).text, prompt.text)
+            print(f"History compaction: ~{metric['raw_tokens']} -> ~{metric['compacted_tokens']} prompt tokens")
+
+        result = self._invoke_llm_for_json(prompt, ImprovementPlan, node="formulate_strategy")
         if not result:
             raise ValueError("Failed to formulate strategy.")
         
         print(f"Formulated Plan:\n{result.plan}")
         return {"high_level_plan": result.plan}
 
+    def _run_concurrently(self, fn: Callable, items: List) -> List:
+        """Applies `fn` to every item on a thread pool, preserving order."""
+        if len(items) <= 1:
+            return [fn(item) for item in items]
+        # Each worker runs in a copy of the caller's context so that LLM calls stay attributed to this run
+        with ThreadPoolExecutor(max_workers=len(items)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, fn, item) for item in items]
+            return [future.result() for future in futures]
+
+    def _generate_candidate(self, state: AgentState, base_prompt_context: str) -> Optional[GeneratedPrompt]:
+        """Asks the model for a single new prompt derived from `base_prompt_context`."""
+        prompt = GENERATE_PROMPT.render(plan=state["high_level_plan"], base_prompt_context=base_prompt_context,
+                                        reflection=state["current_reflection"])
+        return self._invoke_llm_for_json(prompt, GeneratedPrompt, node="generate_prompt")
+
+    def _known_evaluation(self, state: AgentState, prompt_text: str) -> Optional[Tuple[str, Dict]]:
+        """Looks a prompt up in the dedup index, first indexing the run's history if the index has not seen it."""
+        run_id, criteria = state.get("run_id", ""), state["decomposed_criteria"]
+        if not self.dedup_index.has_scope(run_id, criteria):
+            # E.g. after resuming a journaled run in a new process
+            for attempt in state["prompt_history"]:
+                if attempt.evaluated:
+                    self.dedup_index.add(run_id, criteria, attempt.prompt_text, attempt.evaluation_dict())
+        return self.dedup_index.lookup(run_id, criteria, prompt_text)
+
+    def _generate_distinct_candidate(self, state: AgentState, base_prompt_context: str) -> Optional[GeneratedPrompt]:
+        """Generates a candidate, asking again while it duplicates an already evaluated prompt."""
+        result = self._generate_candidate(state, base_prompt_context)
+        if self.dedup_index is None:
+            return result
+        for _ in range(self.dedup_max_regenerations):
+            if result is None or self._known_evaluation(state, result.prompt_text) is None:
+                break
+            print("Generated prompt duplicates an already evaluated one; asking for a different change.")
+            self.dedup_index.record_regeneration()
+            retry_context = (f"{base_prompt_context}\n- Your previous suggestion, \"{result.prompt_text}\", is "
+                             f"(nearly) identical to a prompt that was already evaluated. Make a substantively "
+                             f"different change.")
+            result = self._generate_candidate(state, retry_context) or result
+        return result
+
     def generate_prompt(self, state: AgentState) -> Dict:
-        """Generates a new, improved version of the prompt."""
+        """Generates a new, improved version of the prompt.
+
+        In beam mode, `beam_width` candidates are generated concurrently, each derived from one of the current
+        top-k beam members in turn.
+        """
         print("\n>>> EXECUTING NODE: GeneratePrompt")
+        history = state["prompt_history"]
 
-        # Determine the prompt to improve upon
-        if not state["prompt_history"]:
-            base_prompt_context = f"The initial prompt to improve is: {state['initial_prompt']}"
+        # Determine the prompt(s) to improve upon
+        if self.beam_width > 1:
+            parents = state.get("beam") or [None]
+        elif history:
+            parents = [len(history) - 1]
         else:
-            last_prompt = state["prompt_history"][-1]["prompt_text"]
-            base_prompt_context = f"The most recent prompt to improve is: {last_prompt}"
-
-        prompt = f"""
-        **Role:** You are a creative and meticulous prompt engineer executing one step of a larger plan. Your task is to generate a single, new version of a prompt that attempts to improve upon the previous version, guided by a high-level plan and specific reflections from the last attempt.
+            parents = [None]
+
+        requests = []
+        for i in range(self.beam_width):
+            parent = parents[i % len(parents)]
+            if parent is None:
+                base_prompt_context = f"The initial prompt to improve is: {state['initial_prompt']}"
+            else:
+                base_prompt_context = f"The most recent prompt to improve is: {history[parent].prompt_text}"
+            if self.beam_width > 1:
+                base_prompt_context += (f"\n- This is candidate {i + 1} of {self.beam_width} generated in "
+                                        f"parallel; explore a different change than the other candidates would.")
+            requests.append((parent, base_prompt_context))
+
+        results = self._run_concurrently(lambda request: self._generate_distinct_candidate(state, request[1]),
+                                         requests)
+        if not any(results):
+            raise ValueError("Failed to generate prompt.")
 
-        **Context:**
-        - The overall strategic plan is: "{state['high_level_plan']}"
-        - {base_prompt_context}
-        - The key takeaway from the last evaluation (your primary focus for this iteration) is: "{state['current_reflection']}"
+        # The new prompt(s) and their reasoning wait in `candidates` until they are evaluated
+        candidates = []
+        for (parent, _), result in zip(requests, results):
+            if not result:
+                continue
+            print(f"Generator Reasoning: {result.reasoning}")
+            print(f"Generated Prompt:\n---\n{result.prompt_text}\n---")
+            candidates.append(Attempt(result.prompt_text, result.reasoning, state.get("iteration_count", 0), parent))
 
-        **Task:**
-        1.  **Synthesize Context:** Review the entire context. Understand the main goal, what has been tried, and what the most recent analysis concluded. 
-        2.  **Formulate a Thought (Reasoning):** Based on the `current_reflection`, decide on the *single most impactful change* you can make to the most recent prompt. This could be rephrasing a sentence, adding a constraint, changing the persona, or adding an example. State this thought process clearly and concisely. This will be your `reasoning`.
-        3.  **Generate the New Prompt:** Write the complete text of the new, improved prompt. Do not just write the changed part; provide the full prompt from beginning to end.
+        return {"candidates": candidates}
 
-        **Instructions:**
-        - Your output must be a single, valid JSON object that strictly adheres to the following Pydantic schema:
-          `class GeneratedPrompt(BaseModel): prompt_text: str; reasoning: str`
-        - The `reasoning` field should contain your thought process for this specific iteration.
-        - The `prompt_text` field should contain the full text of the newly generated prompt.
+    def _evaluate_candidate(self, new_prompt_text: str, decomposed_criteria: List[str],
+                            thresholds: List[float]) -> Optional[Dict]:
+        """Scores a prompt and returns the serialized evaluation.
 
-        **Perform your task now based on the provided context.**
+        With sampling enabled, several samples are aggregated; if they disagree, the escalation model scores
+        the prompt instead. Otherwise the prompt is scored once, through the micro-batcher if one is set.
         """
-        result = self._invoke_llm_for_json(prompt, GeneratedPrompt)
-        if not result:
-            raise ValueError("Failed to generate prompt.")
-        
-        print(f"Generator Reasoning: {result.reasoning}")
-        print(f"Generated Prompt:\n---\n{result.prompt_text}\n---")
-
-        # Update history with the new prompt and its reasoning
-        history = state["prompt_history"]
-        history.append({"prompt_text": result.prompt_text, "reasoning": result.reasoning})
-
-        return {"prompt_history": history}
+        if self.sampled_evaluator is not None:
+            evaluation = self.sampled_evaluator.evaluate(new_prompt_text, decomposed_criteria, thresholds)
+            escalation_model = self.model_router.escalation_for("evaluate_prompt")
+            if evaluation and escalation_model and self.model_router.samples_disagree(evaluation):
+                print(f"Evaluator samples disagree; escalating the evaluation to {escalation_model}")
+                prompt = EVALUATE_PROMPT.render(prompt_text=new_prompt_text, criteria=decomposed_criteria)
+                result = self._call_model(prompt, EvaluationResult, "evaluate_prompt", escalation_model,
+                                          self.eval_temperature)
+                self.model_router.record("evaluate_prompt", escalated=True, escalation_failed=result is None, calls=0)
+                if result is not None:
+                    evaluation = result.dict()
+            return evaluation
+        if self.batch_evaluator is not None:
+            result = self.batch_evaluator.evaluate(new_prompt_text, decomposed_criteria)
+        else:
+            result = self._evaluate_single(new_prompt_text, decomposed_criteria)
+        return result.dict() if result else None
+
+    def _evaluate_single(self, new_prompt_text: str, decomposed_criteria: List[str]) -> Optional[EvaluationResult]:
+        """Scores a single prompt against the criteria."""
+        prompt = EVALUATE_PROMPT.render(prompt_text=new_prompt_text, criteria=decomposed_criteria)
+        return self._invoke_llm_for_json(prompt, EvaluationResult, node="evaluate_prompt")
+
+    def _invoke_batch_evaluation(self, prompt: RenderedPrompt,
+                                 weights: Dict[str, float]) -> Optional[BatchEvaluationResult]:
+        """Sends one batched evaluation, billing its usage to the runs in the batch in proportion to `weights`."""
+        with self.instrumentation.shared(weights):
+            return self._invoke_llm_for_json(prompt, BatchEvaluationResult, node="evaluate_prompt")
+
+    def _batch_evaluation_prompt(self, items: List[EvaluationItem]) -> RenderedPrompt:
+        """Renders one PromptEvaluator request covering several (prompt, criteria) items."""
+        rendered_items = "\n\n".join(
+            f"{ITEM_HEADER.format(item_id=item_id)}\n"
+            f"- The prompt to be evaluated is: \"{prompt_text}\"\n"
+            f"- The evaluation criteria are: {criteria}"
+            for item_id, prompt_text, criteria in items
+        )
+        return EVALUATE_PROMPT_BATCH.render(items=rendered_items)
 
     def evaluate_prompt(self, state: AgentState) -> Dict:
-        """Evaluates the latest prompt against the criteria."""
-        print("\n>>> EXECUTING NODE: EvaluatePrompt")
-        new_prompt_text = state["prompt_history"][-1]["prompt_text"]
-        decomposed_criteria = state["decomposed_criteria"]
+        """Evaluates the pending candidates against the criteria and appends them to the history.
 
-        prompt = f"""
-        **Role:** You are a hyper-critical and objective AI prompt evaluator. Your task is to score a new prompt against a set of predefined criteria and provide a detailed justification for your scores. You must be impartial, rigorous, and analytical.
-
-        **Context:**
-        - The new prompt to be evaluated is: "{new_prompt_text}"
-        - The evaluation criteria are: {decomposed_criteria}
-
-        **Task:**
-        1.  **Evaluate Against Each Criterion:** For each individual criterion in the list, perform the following:
-            a.  Carefully assess how well the `new_prompt_text` satisfies that specific criterion.
-            b.  Assign a score from 1 (fails completely) to 10 (perfectly satisfies). A score of 5 means it partially addresses the criterion but has significant room for improvement.
-            c.  Write a brief, one-sentence justification for your score, citing specific evidence from the prompt text or noting its absence.
-        2.  **Provide Holistic Feedback:** After scoring all criteria, write a short paragraph of overall qualitative feedback. Summarize the prompt's main strengths and weaknesses. Point out any unintended side effects of the changes and suggest the most important area for the next improvement.
-
-        **Instructions:**
-        - Your output must be a single, valid JSON object that strictly adheres to the following Pydantic schema:
-          `class CriterionScore(BaseModel): criterion: str; score: int; justification: str`
-          `class EvaluationResult(BaseModel): scores: List; qualitative_feedback: str`
-        - Be strict and consistent in your scoring. Do not give high scores easily. Your justification is more important than the score itself.
-
-        **Perform your evaluation now.**
+        In beam mode the candidates are scored concurrently and the top-k are kept as the new beam.
         """
-        result = self._invoke_llm_for_json(prompt, EvaluationResult)
-        if not result:
-            raise ValueError("Failed to evaluate prompt.")
-
-        # Update the last entry in history with its evaluation
+        print("\n>>> EXECUTING NODE: EvaluatePrompt")
         history = state["prompt_history"]
-        history[-1]["evaluation"] = result.dict()
-
-        print("Evaluation Results:")
-        for score in result.scores:
-            print(f"  - {score.criterion}: {score.score}/10 ({score.justification})")
-        print(f"Qualitative Feedback: {result.qualitative_feedback}")
+        candidates = state.get("candidates") or []
+        decomposed_criteria = state["decomposed_criteria"]
+        pending = list(range(len(candidates)))
+        evaluated: Dict[int, Attempt] = {}
+
+        # Duplicates of earlier prompts reuse their evaluation, and duplicates within the round are scored once
+        if self.dedup_index is not None:
+            for i in list(pending):
+                match = self._known_evaluation(state, candidates[i].prompt_text)
+                if match is not None:
+                    print(f"Reusing the evaluation of an {match[0]} duplicate for candidate {i}.")
+                    evaluated[i] = candidates[i].with_evaluation(match[1], reused=True)
+                    pending.remove(i)
+        reused = len(evaluated)
+        groups: Dict[str, List[int]] = {}
+        for i in pending:
+            groups.setdefault(normalize_prompt(candidates[i].prompt_text), []).append(i)
+        unique = [members[0] for members in groups.values()]
+
+        thresholds = self.decision_thresholds(state) if self.decision_thresholds is not None else []
+        results = self._run_concurrently(
+            lambda i: self._evaluate_candidate(candidates[i].prompt_text, decomposed_criteria, thresholds), unique)
+        if not reused and not any(results):
+            raise ValueError("Failed to evaluate prompt.")
 
-        return {"prompt_history": history}
+        # Candidates that could not be scored are dropped
+        for members, evaluation in zip(groups.values(), results):
+            if not evaluation:
+                continue
+            for position, i in enumerate(members):
+                evaluated[i] = candidates[i].with_evaluation(evaluation, reused=position > 0)
+            if self.dedup_index is not None:
+                self.dedup_index.add(state.get("run_id", ""), decomposed_criteria, candidates[members[0]].prompt_text,
+                                     evaluation)
+
+            samples = evaluation.get("samples", 1)
+            print("Evaluation Results:" if samples == 1 else
+                  f"Evaluation Results ({self.sampled_evaluator.aggregate} of {samples} samples):")
+            for score in evaluation["scores"]:
+                spread = f" ± {score['sd']:.2f} sd" if samples > 1 else ""
+                print(f"  - {score['criterion']}: {score['score']}/10{spread} ({score['justification']})")
+            print(f"Qualitative Feedback: {evaluation['qualitative_feedback']}")
+        new_attempts = [evaluated[i] for i in sorted(evaluated)]
+
+        update = {"prompt_history": new_attempts, "candidates": []}
+        if self.beam_width > 1:
+            update["beam"] = self._select_beam(len(history), new_attempts)
+            print(f"Beam (top {self.beam_top_k}): {update['beam']}")
+        return update
+
+    def _select_beam(self, offset: int, attempts: List[Attempt]) -> List[int]:
+        """Returns the history indices of the top-k of a round's attempts, best first."""
+        ranked = sorted(range(len(attempts)), key=lambda i: attempts[i].average_score, reverse=True)
+        return [offset + i for i in ranked[:self.beam_top_k]]
 
     def synthesize_reflection(self, state: AgentState) -> Dict:
         """Analyzes evaluation results to produce an actionable insight."""
         print("\n>>> EXECUTING NODE: SynthesizeReflection")
-        evaluation_result = state["prompt_history"][-1]["evaluation"]
-
-        prompt = f"""
-        **Role:** You are a master strategist and learning algorithm. Your task is to analyze an evaluation report and synthesize a single, powerful insight that will guide the next action. You are performing the "Orient" step of the OODA loop.
-
-        **Context:**
-        - The most recent prompt was just evaluated. The results are: "{evaluation_result}"
-
-        **Task:**
-        1.  **Analyze the Data:** Look at the scores (especially the lowest ones) and the qualitative feedback.
-        2.  **Identify the Core Pattern:** What is the most important story the data is telling? Did one change improve some criteria but hurt others? Was the main change ineffective? What is the root cause of the lowest scores?
-        3.  **Synthesize a Reflection:** Distill your analysis into a single, concise, and actionable sentence. This reflection should state what was learned and clearly imply what should be done differently in the next iteration. It must be a directive for the `PromptGenerator`.
-
-        **Example:**
-        - **Evaluation Result:** Scores for 'clarity' went up to 8, but scores for 'creativity' went down to 3. Feedback mentions the prompt is now "too rigid and formulaic."
-        - **Your Synthesized Reflection (as JSON):**
-          ```json
-          {{
-            "summary": "The attempt to add structure made the prompt too restrictive, stifling creativity; the next iteration must introduce more flexibility, perhaps by adding an 'out-of-the-box ideas' section, while maintaining the new-found clarity."
-          }}
-          ```
-
-        **Instructions:**
-        - Generate ONLY the summary string.
-        - Your output must be a single, valid JSON object that strictly adheres to the following Pydantic schema:
-          `class Reflection(BaseModel): summary: str`
-
-        **Perform your synthesis now.**
-        """
-        result = self._invoke_llm_for_json(prompt, Reflection)
+        history = state["prompt_history"]
+        if self.beam_width > 1:
+            evaluation_result = [history[i].evaluation_dict() for i in state.get("beam", [])]
+        else:
+            evaluation_result = history[-1].evaluation_dict()
+
+        prompt = SYNTHESIZE_REFLECTION.render(evaluation_result=evaluation_result)
+        result = self._invoke_llm_for_json(prompt, Reflection, node="synthesize_reflection")
         if not result:
             raise ValueError("Failed to synthesize reflection.")
         
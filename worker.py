@@ -0,0 +1,351 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import signal
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, IO, Iterable, Optional
+
+from batch import BatchRunner, add_graph_arguments, build_graph, close_graph, validate_job
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+class ShuttingDown(Exception):
+    """Raised when a job is submitted after shutdown has begun."""
+
+
+def latency_percentiles(samples: Iterable[float], percentiles: Iterable[int] = (50, 90, 99)) -> Dict[str, float]:
+    """Returns nearest-rank percentiles of the samples, e.g. {"p50": ..., "p90": ..., "p99": ...}."""
+    ordered = sorted(samples)
+    if not ordered:
+        return {f"p{p}": 0.0 for p in percentiles}
+    return {f"p{p}": round(ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)], 3) for p in percentiles}
+
+
+class Worker:
+    """Runs refinement jobs from an internal queue through one long-lived batch runner.
+
+    The runner's compiled graph and model clients stay warm across jobs, so only the first job pays for them.
+    `submit` may be called from any thread. Up to `concurrency` jobs run at once and up to `max_queue` more
+    wait; the outcome of the most recent `max_results` jobs can be looked up by id, and each finished record is
+    also passed to `on_result`. Latency percentiles are computed over the most recent `latency_window` jobs.
+    """
+
+    def __init__(self, runner, concurrency: int = 4, max_queue: int = 1000, max_results: int = 10_000,
+                 latency_window: int = 10_000, on_result: Optional[Callable[[Dict], None]] = None):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1.")
+        self.runner = runner
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_results = max_results
+        self.on_result = on_result
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._consumers = []
+        self._lock = threading.Condition()
+        self._accepting = False
+        self._queued = 0
+        self._running = 0
+        self._results: "OrderedDict[str, Dict]" = OrderedDict()
+        self._latencies = {name: deque(maxlen=latency_window) for name in ("total", "queue_wait", "run")}
+        self._counts = {"submitted": 0, "ok": 0, "error": 0, "cancelled": 0, "rejected": 0}
+        self._started_at = time.time()
+
+    async def start(self):
+        """Starts the consumers on the running event loop."""
+        self._loop = asyncio.get_running_loop()
+        # Graph nodes are synchronous, so `ainvoke` runs them in the loop's default executor; see BatchRunner.run
+        self._loop.set_default_executor(ThreadPoolExecutor(max_workers=self.concurrency))
+        self._queue = asyncio.Queue()
+        self._consumers = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
+        with self._lock:
+            self._accepting = True
+
+    def submit(self, job: Dict, block: bool = False) -> str:
+        """Queues a job and returns its id.
+
+        Raises `QueueFull` when the queue is at capacity, unless `block` is set, in which case it waits for room;
+        raises `ShuttingDown` once shutdown has begun. Jobs need `initial_prompt` and `goal`, like batch jobs.
+        """
+        job = dict(validate_job(job))
+        job["job_id"] = str(job.get("job_id") or uuid.uuid4().hex)
+        with self._lock:
+            while self._accepting and self._queued >= self.max_queue:
+                if not block:
+                    self._counts["rejected"] += 1
+                    raise QueueFull(f"The queue already holds {self._queued} jobs.")
+                self._lock.wait()
+            if not self._accepting:
+                self._counts["rejected"] += 1
+                raise ShuttingDown("The worker is shutting down.")
+            self._queued += 1
+            self._counts["submitted"] += 1
+            self._remember(job["job_id"], {"job_id": job["job_id"], "status": "queued"})
+            # Scheduled under the lock, so every accepted job is queued before shutdown's end-of-queue markers
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, (job, time.perf_counter()))
+        return job["job_id"]
+
+    def _remember(self, job_id: str, record: Dict):
+        """Stores a job's latest status; must be called with the lock held."""
+        self._results[job_id] = record
+        self._results.move_to_end(job_id)
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+
+    def result(self, job_id: str) -> Optional[Dict]:
+        """Returns a job's result record, or its status while it is queued or running; None if unknown."""
+        with self._lock:
+            record = self._results.get(job_id)
+            return dict(record) if record is not None else None
+
+    async def _consume(self):
+        """Runs queued jobs one at a time until shutdown."""
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            job, enqueued_at = item
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._remember(job["job_id"], {"job_id": job["job_id"], "status": "running"})
+                self._lock.notify()
+            try:
+                record = await self.runner.run_job(job, enqueued_at)
+            except asyncio.CancelledError:
+                self._finish({"job_id": job["job_id"], "status": "cancelled"}, enqueued_at)
+                raise
+            self._finish(record, enqueued_at)
+
+    def _finish(self, record: Dict, enqueued_at: float, started: bool = True):
+        """Records the outcome and latency of a job that ran, or was dropped from the queue, and hands it on."""
+        with self._lock:
+            if started:
+                self._running -= 1
+            else:
+                self._queued -= 1
+            self._counts[record["status"]] += 1
+            self._remember(record["job_id"], record)
+            if record["status"] != "cancelled":
+                self._latencies["total"].append(time.perf_counter() - enqueued_at)
+                self._latencies["queue_wait"].append(record.get("queue_wait_s", 0.0))
+                self._latencies["run"].append(record.get("elapsed_s", 0.0))
+        if self.on_result is not None:
+            self.on_result(record)
+
+    async def shutdown(self, drain_timeout: Optional[float] = None):
+        """Stops accepting jobs and finishes the queued and running ones.
+
+        Jobs still unfinished after `drain_timeout` seconds are cancelled; with a journal, their runs can be
+        resumed later by submitting them again with the same `run_id`.
+        """
+        with self._lock:
+            self._accepting = False
+            self._lock.notify_all()
+        await asyncio.sleep(0)
+        for _ in self._consumers:
+            self._queue.put_nowait(None)
+        _, pending = await asyncio.wait(self._consumers, timeout=drain_timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        # Jobs that no consumer picked up before the cancellation
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                self._finish({"job_id": item[0]["job_id"], "status": "cancelled"}, item[1], started=False)
+
+    def stats(self) -> Dict:
+        """Returns queue depth, jobs in flight, outcome counts and latency percentiles in seconds."""
+        with self._lock:
+            return {
+                "accepting": self._accepting,
+                "queue_depth": self._queued,
+                "in_flight": self._running,
+                "uptime_s": round(time.time() - self._started_at, 3),
+                **self._counts,
+                "latency_s": {name: latency_percentiles(samples) for name, samples in self._latencies.items()},
+            }
+
+    def to_prometheus(self) -> str:
+        """Renders the worker's gauges, counters and latency quantiles in the Prometheus text format."""
+        stats = self.stats()
+        lines = ["# HELP p3ro_worker_queue_depth Jobs waiting in the queue.", "# TYPE p3ro_worker_queue_depth gauge",
+                 f"p3ro_worker_queue_depth {stats['queue_depth']}",
+                 "# HELP p3ro_worker_jobs_in_flight Jobs currently running.", "# TYPE p3ro_worker_jobs_in_flight gauge",
+                 f"p3ro_worker_jobs_in_flight {stats['in_flight']}",
+                 "# HELP p3ro_worker_jobs_total Jobs by outcome.", "# TYPE p3ro_worker_jobs_total counter"]
+        lines += [f'p3ro_worker_jobs_total{{status="{status}"}} {stats[status]}'
+                  for status in ("submitted", "ok", "error", "cancelled", "rejected")]
+        lines += ["# HELP p3ro_worker_latency_seconds Job latency quantiles by phase over recent jobs.",
+                  "# TYPE p3ro_worker_latency_seconds summary"]
+        lines += [f'p3ro_worker_latency_seconds{{phase="{phase}",quantile="{int(key[1:]) / 100}"}} {value}'
+                  for phase, quantiles in stats["latency_s"].items() for key, value in quantiles.items()]
+        return "\n".join(lines) + "\n"
+
+
+def _http_handler(worker: Worker, loop: asyncio.AbstractEventLoop, stop: asyncio.Event):
+    """Builds the request handler class of the HTTP front end."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, payload, content_type: str = "application/json"):
+            body = payload if isinstance(payload, str) else json.dumps(payload)
+            data = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            if status == 503:
+                self.send_header("Retry-After", "1")
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if self.path == "/shutdown":
+                loop.call_soon_threadsafe(stop.set)
+                return self._reply(202, {"status": "shutting down"})
+            if self.path != "/jobs":
+                return self._reply(404, {"error": "not found"})
+            try:
+                job = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"null")
+                job_id = worker.submit(job)
+            except (ValueError, json.JSONDecodeError) as e:
+                return self._reply(400, {"error": str(e)})
+            except (QueueFull, ShuttingDown) as e:
+                return self._reply(503, {"error": str(e)})
+            self._reply(202, {"job_id": job_id, "queue_depth": worker.stats()["queue_depth"]})
+
+        def do_GET(self):
+            if self.path.startswith("/jobs/"):
+                record = worker.result(self.path[len("/jobs/"):])
+                return self._reply(200, record) if record else self._reply(404, {"error": "unknown job"})
+            if self.path == "/stats":
+                return self._reply(200, worker.stats())
+            if self.path == "/metrics":
+                metrics = worker.to_prometheus() + worker.runner.graph.instrumentation.to_prometheus()
+                return self._reply(200, metrics, content_type="text/plain; version=0.0.4")
+            if self.path == "/healthz":
+                healthy = worker.stats()["accepting"]
+                return self._reply(200 if healthy else 503, {"status": "ok" if healthy else "draining"})
+            self._reply(404, {"error": "not found"})
+
+        def log_message(self, format, *args):
+            # Keep access logs off stdout, where the agent's progress is printed
+            sys.stderr.write(f"{self.address_string()} - {format % args}\n")
+
+    return Handler
+
+
+def _read_jobs(worker: Worker, stream: IO[str], emit: Callable[[Dict], None], loop: asyncio.AbstractEventLoop,
+               stop: asyncio.Event):
+    """Submits each JSONL line of `stream` as a job, blocking while the queue is full; stops the worker at EOF.
+
+    A line `{"op": "stats"}` writes the worker's stats instead.
+    """
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+            if isinstance(job, dict) and job.get("op") == "stats":
+                emit({"op": "stats", **worker.stats()})
+                continue
+            if isinstance(job, dict):
+                job.setdefault("job_id", str(line_number))
+            worker.submit(job, block=True)
+        except ShuttingDown:
+            break
+        except ValueError as e:
+            emit({"job_id": str(line_number), "status": "rejected", "error": str(e)})
+    loop.call_soon_threadsafe(stop.set)
+
+
+async def serve(worker: Worker, http_address: Optional[str], drain_timeout: Optional[float]):
+    """Runs the worker behind the HTTP front end or on stdin until EOF, a signal or a shutdown request."""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(signum, stop.set)
+    await worker.start()
+
+    server = None
+    if http_address:
+        host, _, port = http_address.rpartition(":")
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), _http_handler(worker, loop, stop))
+        threading.Thread(target=server.serve_forever, name="p3ro-http", daemon=True).start()
+        print(f"--- Worker listening on http://{host or '127.0.0.1'}:{server.server_address[1]} ---", file=sys.stderr)
+    else:
+        # A daemon thread, so a blocking read cannot hold up the process once shutdown has finished
+        threading.Thread(target=_read_jobs, args=(worker, sys.stdin, worker.on_result, loop, stop),
+                         name="p3ro-stdin", daemon=True).start()
+
+    await stop.wait()
+    stats = worker.stats()
+    print(f"--- Draining {stats['queue_depth']} queued and {stats['in_flight']} running jobs ---", file=sys.stderr)
+    # The HTTP server keeps answering status requests while draining; new jobs are rejected
+    await worker.shutdown(drain_timeout)
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve P³RO refinement jobs from a long-running worker that keeps "
+                                                 "the compiled graph and model clients warm.")
+    parser.add_argument("--http", metavar="[HOST:]PORT",
+                        help="Accept jobs over HTTP (POST /jobs, GET /jobs/ID, /stats, /metrics, /healthz). "
+                             "Without it, jobs are read as JSONL from stdin and results written as JSONL to stdout.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of jobs in flight.")
+    parser.add_argument("--max-queue", type=int, default=1000, help="Jobs allowed to wait before new ones are "
+                                                                      "rejected (HTTP) or reading pauses (stdin).")
+    parser.add_argument("--drain-timeout", type=float, default=300.0,
+                        help="Seconds to let queued and running jobs finish on shutdown before cancelling them.")
+    parser.add_argument("--results", help="Also append every result as JSONL to this file.")
+    add_graph_arguments(parser)
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    # Results go to stdout in stdin mode, so the agent's progress output is moved to stderr below
+    output = sys.stdout
+    results_file = open(args.results, "a", encoding="utf-8") if args.results else None
+    write_lock = threading.Lock()
+
+    def emit(record: Dict):
+        with write_lock:
+            line = json.dumps(record) + "\n"
+            if not args.http:
+                output.write(line)
+                output.flush()
+            if results_file is not None:
+                results_file.write(line)
+                results_file.flush()
+
+    with contextlib.redirect_stdout(sys.stderr):
+        graph = build_graph(args, args.concurrency)
+        worker = Worker(BatchRunner(graph=graph, concurrency=args.concurrency), concurrency=args.concurrency,
+                        max_queue=args.max_queue, on_result=emit)
+        try:
+            asyncio.run(serve(worker, args.http, args.drain_timeout))
+        finally:
+            print(f"Worker stats: {json.dumps(worker.stats())}")
+            close_graph(graph, args)
+            if results_file is not None:
+                results_file.close()
+
+
+if __name__ == "__main__":
+    main()